@@ -0,0 +1,350 @@
+# A python module for week-over-week and rolling-window bed analytics
+import numpy as np
+import pandas as pd
+
+# weekly_logs columns held in the matrix
+MEASURES = [
+    'adult_beds_available_avg',
+    'adult_beds_occupied_avg',
+    'pediatric_beds_available_avg',
+    'pediatric_beds_occupied_avg',
+    'icu_beds_available_avg',
+    'icu_beds_occupied_avg',
+    'confirmed_covid_hospitalized_avg',
+    'confirmed_covid_icu_avg',
+]
+
+# Metric columns produced by state_metrics and hospital_metrics
+METRIC_COLUMNS = [
+    'beds_used',
+    'beds_used_wow',
+    'beds_used_4wk_avg',
+    'fraction_used',
+    'fraction_used_wow',
+    'fraction_used_z',
+]
+
+# Weeks averaged by the rolling metrics
+ROLLING_WEEKS = 4
+
+
+class WeekMatrix:
+    """A wide (hospital x week) matrix of weekly_logs measures
+
+    Each measure is a float32 array with one row per hospital and one column
+    per collection week, holding NaN where a value is missing or no record
+    was loaded. The matrix is loaded once and then extended with `update`
+    as new weeks arrive, so analytics never re-read history. `update` and
+    `drop_weeks` change the matrix in place: a matrix shared between threads
+    is never changed, but copied, updated and published in its place (see
+    `cube.ReportCube.refresh`).
+    """
+
+    def __init__(self):
+        self.hospitals = pd.Index([], dtype=object)
+        self.weeks = []
+        self.state = np.array([], dtype=object)
+        self.present = np.zeros((0, 0), dtype=bool)
+        self.values = {
+            m: np.zeros((0, 0), dtype=np.float32) for m in MEASURES
+        }
+
+    @classmethod
+    def from_frame(cls, df):
+        """Build a matrix from long-format weekly_logs rows
+
+        Parameters
+        ----------
+        df : DataFrame
+            A Pandas DataFrame with `hospital_pk`, `state`,
+            `collection_week` and all `MEASURES` columns
+
+        Returns
+        -------
+        WeekMatrix
+            The loaded matrix
+        """
+        matrix = cls()
+        matrix.update(df)
+        return matrix
+
+    def copy(self):
+        """A copy of the matrix to update while this one is being read"""
+        other = WeekMatrix()
+        other.hospitals = self.hospitals
+        other.weeks = list(self.weeks)
+        other.state = self.state.copy()
+        other.present = self.present.copy()
+        other.values = {m: a.copy() for m, a in self.values.items()}
+        return other
+
+    @property
+    def latest_week(self):
+        return self.weeks[-1] if self.weeks else None
+
+    def _grow(self, n_hospitals, n_weeks):
+        pad = ((0, n_hospitals), (0, n_weeks))
+        self.present = np.pad(self.present, pad, constant_values=False)
+        for m in MEASURES:
+            self.values[m] = np.pad(self.values[m], pad,
+                                    constant_values=np.nan)
+
+    def update(self, df):
+        """Add or overwrite weeks of long-format weekly_logs rows
+
+        Parameters
+        ----------
+        df : DataFrame
+            A Pandas DataFrame with `hospital_pk`, `state`,
+            `collection_week` and all `MEASURES` columns
+        """
+        if len(df) == 0:
+            return
+        new_hospitals = pd.Index(df['hospital_pk'].unique()).difference(
+            self.hospitals
+        )
+        new_weeks = sorted(set(df['collection_week']) - set(self.weeks))
+        self._grow(len(new_hospitals), len(new_weeks))
+        self.hospitals = self.hospitals.append(new_hospitals)
+        self.state = np.concatenate(
+            (self.state, np.full(len(new_hospitals), None, dtype=object))
+        )
+        self.weeks = self.weeks + new_weeks
+
+        # keep weeks in order if an older week was loaded late
+        order = np.argsort(np.array(self.weeks, dtype='datetime64[D]'),
+                           kind='stable')
+        if (order != np.arange(len(order))).any():
+            self.weeks = [self.weeks[i] for i in order]
+            self.present = self.present[:, order]
+            for m in MEASURES:
+                self.values[m] = self.values[m][:, order]
+
+        rows = self.hospitals.get_indexer(df['hospital_pk'])
+        cols = pd.Index(self.weeks).get_indexer(df['collection_week'])
+        self.present[rows, cols] = True
+        for m in MEASURES:
+            self.values[m][rows, cols] = pd.to_numeric(
+                df[m], errors='coerce'
+            ).to_numpy(dtype=np.float32, na_value=np.nan)
+        self.state[rows] = df['state'].to_numpy(dtype=object)
+
+    def set_states(self, df):
+        """Set the state of the hospitals in the matrix
+
+        `update` takes a hospital's state from the rows it reads, so the
+        state of a hospital whose ZIP code changed is only current once it
+        is set from the hospital table
+
+        Parameters
+        ----------
+        df : DataFrame
+            A Pandas DataFrame with `hospital_pk` and `state`; hospitals not
+            in the matrix are skipped
+        """
+        rows = self.hospitals.get_indexer(df['hospital_pk'])
+        found = rows >= 0
+        self.state[rows[found]] = df['state'].to_numpy(dtype=object)[found]
+
+    def drop_weeks(self, weeks):
+        """Remove the given collection weeks from the matrix"""
+        weeks = set(weeks)
+        keep = [i for i, w in enumerate(self.weeks) if w not in weeks]
+        self.weeks = [self.weeks[i] for i in keep]
+        self.present = self.present[:, keep]
+        for m in MEASURES:
+            self.values[m] = self.values[m][:, keep]
+
+    def beds_used(self, rows=slice(None), cols=slice(None)):
+        """Total adult, pediatric and ICU beds occupied per hospital-week
+
+        `rows` and `cols` select the hospitals and weeks to sum, all of them
+        by default
+        """
+        v = self.values
+        return (v['adult_beds_occupied_avg'][rows, cols]
+                + v['pediatric_beds_occupied_avg'][rows, cols]
+                + v['icu_beds_occupied_avg'][rows, cols])
+
+    def beds_available(self, rows=slice(None), cols=slice(None)):
+        """Total adult, pediatric and ICU beds available per hospital-week
+
+        `rows` and `cols` select the hospitals and weeks to sum, all of them
+        by default
+        """
+        v = self.values
+        return (v['adult_beds_available_avg'][rows, cols]
+                + v['pediatric_beds_available_avg'][rows, cols]
+                + v['icu_beds_available_avg'][rows, cols])
+
+    def state_totals(self, arr):
+        """Sum a (hospital x week) array to a (state x week) array
+
+        Parameters
+        ----------
+        arr : ndarray
+            A (hospital x week) array; NaN values are skipped
+
+        Returns
+        -------
+        tuple of (list, ndarray)
+            The state names and the (state x week) float64 totals, NaN for a
+            state-week without values, as SQL's SUM
+        """
+        codes, states = pd.factorize(self.state, sort=True)
+        totals = np.zeros((len(states), arr.shape[1]))
+        counts = np.zeros((len(states), arr.shape[1]), dtype=np.int64)
+        keep = codes >= 0
+        values = arr[keep].astype(np.float64)
+        valid = ~np.isnan(values)
+        np.add.at(totals, codes[keep], np.where(valid, values, 0))
+        np.add.at(counts, codes[keep], valid)
+        totals[counts == 0] = np.nan
+        return list(states), totals
+
+
+def week_over_week(arr, weeks=None):
+    """Change from the previous week along the last axis
+
+    The first week has no previous week and is NaN. With the collection
+    `weeks` of the columns, so is a week whose previous column is not the
+    week 7 days before, as around a week missing from the matrix.
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    delta = np.full(arr.shape, np.nan)
+    delta[..., 1:] = arr[..., 1:] - arr[..., :-1]
+    if weeks is not None:
+        days = np.diff(np.array(weeks, dtype='datetime64[D]'))
+        delta[..., 1:][..., days != np.timedelta64(7, 'D')] = np.nan
+    return delta
+
+
+def rolling_mean(arr, window=ROLLING_WEEKS):
+    """Trailing mean over `window` weeks along the last axis
+
+    NaN values are skipped; a window with no values is NaN
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    valid = ~np.isnan(arr)
+    zero = np.zeros(arr.shape[:-1] + (1,))
+    sums = np.concatenate((zero, np.cumsum(np.where(valid, arr, 0), -1)), -1)
+    counts = np.concatenate((zero, np.cumsum(valid, -1)), -1)
+    start = np.maximum(np.arange(arr.shape[-1]) + 1 - window, 0)
+    end = np.arange(arr.shape[-1]) + 1
+    window_sum = sums[..., end] - sums[..., start]
+    window_count = counts[..., end] - counts[..., start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(window_count > 0, window_sum / window_count, np.nan)
+
+
+def zscore(arr, axis=0):
+    """Standard score of each value against the others along `axis`
+
+    NaN values are skipped; with no spread the score is NaN
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nanmean(arr, axis=axis, keepdims=True)
+        std = np.nanstd(arr, axis=axis, keepdims=True)
+        return np.where(std > 0, (arr - mean) / std, np.nan)
+
+
+def fraction(numerator, denominator):
+    """Element-wise ratio, NaN where the denominator is 0 or missing"""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator != 0, numerator / denominator, np.nan)
+
+
+def state_metrics(matrix):
+    """Week-over-week, rolling and z-score metrics per state and week
+
+    Parameters
+    ----------
+    matrix : WeekMatrix
+        The loaded (hospital x week) matrix
+
+    Returns
+    -------
+    DataFrame
+        One row per state and week with `beds_used`, `beds_used_wow`,
+        `beds_used_4wk_avg`, `fraction_used`, `fraction_used_wow` and
+        `fraction_used_z` (z-score of the state's fraction against all states
+        that week)
+    """
+    used = matrix.beds_used()
+    available = matrix.beds_available()
+    # only hospitals reporting both totals count towards the state fraction
+    both = ~np.isnan(used) & ~np.isnan(available)
+    states, used_total = matrix.state_totals(used)
+    _, used_both = matrix.state_totals(np.where(both, used, np.nan))
+    _, available_both = matrix.state_totals(np.where(both, available, np.nan))
+    frac = fraction(used_both, available_both)
+    used = used_total
+    return _long_frame(
+        'state', states, matrix.weeks,
+        beds_used=used,
+        beds_used_wow=week_over_week(used, matrix.weeks),
+        beds_used_4wk_avg=rolling_mean(used),
+        fraction_used=frac,
+        fraction_used_wow=week_over_week(frac, matrix.weeks),
+        fraction_used_z=zscore(frac, axis=0),
+    )
+
+
+def hospital_metrics(matrix, week):
+    """Week-over-week, rolling and z-score metrics per hospital for one week
+
+    Parameters
+    ----------
+    matrix : WeekMatrix
+        The loaded (hospital x week) matrix
+    week : date
+        The collection week to report
+
+    Returns
+    -------
+    DataFrame
+        One row per hospital with a record that week, with the same metric
+        columns as `state_metrics`, where `fraction_used_z` compares the
+        hospital against all hospitals that week
+    """
+    if week not in matrix.weeks:
+        return pd.DataFrame(columns=['hospital_pk', 'state', 'week']
+                            + METRIC_COLUMNS)
+    col = matrix.weeks.index(week)
+    # only the hospitals with a record that week and the weeks of its rolling
+    # window, which include the previous week, enter the metrics
+    rows = np.flatnonzero(matrix.present[:, col])
+    cols = slice(max(0, col + 1 - ROLLING_WEEKS), col + 1)
+    used = matrix.beds_used(rows, cols).astype(np.float64)
+    frac = fraction(used, matrix.beds_available(rows, cols))
+    columns = {
+        'beds_used': used,
+        'beds_used_wow': week_over_week(used, matrix.weeks[cols]),
+        'beds_used_4wk_avg': rolling_mean(used),
+        'fraction_used': frac,
+        'fraction_used_wow': week_over_week(frac, matrix.weeks[cols]),
+        'fraction_used_z': zscore(frac, axis=0),
+    }
+    df = pd.DataFrame({
+        'hospital_pk': matrix.hospitals[rows],
+        'state': matrix.state[rows],
+        'week': week,
+    })
+    for name, arr in columns.items():
+        df[name] = arr[:, -1]
+    return df
+
+
+def _long_frame(key_name, key_values, weeks, **arrays):
+    """Reshape (key x week) arrays to a long DataFrame"""
+    n_keys, n_weeks = len(key_values), len(weeks)
+    df = pd.DataFrame({
+        key_name: np.repeat(np.asarray(key_values, dtype=object), n_weeks),
+        'week': np.tile(np.asarray(weeks, dtype=object), n_keys),
+    })
+    for name, arr in arrays.items():
+        df[name] = np.asarray(arr).reshape(-1)
+    return df
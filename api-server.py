@@ -0,0 +1,34 @@
+# Python script running the read-only aggregate API
+import argparse
+from api import AggregateApi, api_server
+
+parser = argparse.ArgumentParser(
+    description="Serve the weekly report aggregates as JSON and Arrow IPC")
+parser.add_argument("--host", default="127.0.0.1",
+                    help="address to listen on")
+parser.add_argument("--port", type=int, default=8000,
+                    help="port to listen on")
+parser.add_argument("--check-interval", type=float, default=5.0,
+                    help="seconds between checks of the data version")
+parser.add_argument("--cache-size", type=int, default=256,
+                    help="maximum number of cached responses")
+args = parser.parse_args()
+
+
+def main():
+    api = AggregateApi(check_interval=args.check_interval,
+                       cache_size=args.cache_size)
+    api.snapshot()
+    server = api_server(api, host=args.host, port=args.port)
+    print(f"Serving the report aggregates at "
+          f"http://{args.host}:{args.port}/api/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
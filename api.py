@@ -0,0 +1,297 @@
+# A python module serving the weekly report aggregates over HTTP as JSON and
+# Arrow IPC, answered from the in-memory report cube
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import pandas as pd
+import analytics
+import cube
+from snapshots import dates_to_str
+
+# Report queries served by the API, and whether each takes a week
+QUERIES = {
+    'weekly_records_summary': False,
+    'bed_summary_5_weeks': True,
+    'beds_fraction_by_quality': True,
+    'beds_used_over_time': True,
+    'avg_quality_by_state': False,
+    'covid_by_ownership': True,
+    'beds_by_emergency_services': True,
+    'icu_capacity_by_hospital': True,
+}
+
+# Lists served as one-column tables, and their column name
+LISTS = {
+    'weeks': 'week',
+    'states': 'state',
+    'ownership_types': 'type_of_ownership',
+}
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+class ApiError(Exception):
+    """A request the API cannot answer, with its HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def to_json(df):
+    """Encode a table as a JSON list of records, dates as YYYY-MM-DD"""
+    return dates_to_str(df).to_json(orient='records').encode()
+
+
+def to_arrow(df):
+    """Encode a table as an Arrow IPC stream"""
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class AggregateApi:
+    """Answer report queries from a shared cube, with cached responses
+
+    The data version is read from the database at most once every
+    `check_interval` seconds, however many clients poll, and the cube is
+    refreshed in the background only when it changed. Each request is
+    answered from one cube snapshot, and its ETag is derived from that
+    snapshot's data version, so a body always matches its ETag. Encoded
+    responses are cached by query, week and format for the current data
+    version, so a conditional GET from a client that is up to date is
+    answered without encoding anything.
+
+    Parameters
+    ----------
+    check_interval : float, optional
+        Seconds between data version checks
+    cache_size : int, optional
+        Maximum number of encoded responses kept
+    """
+
+    def __init__(self, check_interval=5.0, cache_size=256):
+        self.cube = cube.ReportCube()
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self.data = None
+        self.version = None
+        self.checked_at = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def snapshot(self):
+        """The cube snapshot to answer from, checked at most every interval
+
+        Only the first request waits for the cube to load. Later refreshes
+        run in the cube's background thread while requests are answered
+        from the previous snapshot, and the lock is only held to swap the
+        snapshot and clear the cached responses.
+
+        Returns
+        -------
+        cube.CubeSnapshot
+            The snapshot of the latest data version the cube holds
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = (self.checked_at is None
+                   or now - self.checked_at >= self.check_interval)
+            if due:
+                self.checked_at = now
+            loaded = self.data is not None
+        if not loaded:
+            self.cube.refresh()
+        elif due:
+            self.cube.refresh_in_background()
+        with self.lock:
+            data = self.cube.snapshot()
+            if data is not self.data:
+                if data.version != self.version:
+                    self.cache.clear()
+                    self.version = data.version
+                self.data = data
+            return data
+
+    def etag(self, version, name, week, fmt):
+        """Entity tag of a response for a data version"""
+        key = json.dumps([[str(s), int(v)] for s, v in version])
+        key += f"|{name}|{week}|{fmt}"
+        return '"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+    def table(self, data, name, week):
+        """The result of a query or list on a cube snapshot as a DataFrame"""
+        if name in LISTS:
+            values = getattr(data, name)()
+            return pd.DataFrame({LISTS[name]: values})
+        if name == 'state_trends':
+            return analytics.state_metrics(data.matrix)
+        method = getattr(data, name)
+        return method(week) if QUERIES[name] else method()
+
+    def parse_week(self, data, name, week):
+        """The week parameter of a request, defaulting to the latest week"""
+        if not QUERIES.get(name):
+            return None
+        weeks = data.weeks()
+        if week is None:
+            if not weeks:
+                raise ApiError(404, "no data has been loaded")
+            return weeks[0]
+        try:
+            week = date.fromisoformat(week)
+        except ValueError:
+            raise ApiError(400, "week must be a YYYY-MM-DD date") from None
+        if week not in weeks:
+            raise ApiError(404, f"no data for the week of {week}")
+        return week
+
+    def get(self, name, fmt='json', week=None, if_none_match=None):
+        """Answer one request
+
+        Parameters
+        ----------
+        name : str
+            A key of `QUERIES` or `LISTS`, or 'state_trends'
+        fmt : str, optional
+            'json' or 'arrow'
+        week : str, optional
+            Collection week (YYYY-MM-DD) of queries that take one
+        if_none_match : str, optional
+            The If-None-Match header of the request
+
+        Returns
+        -------
+        tuple of (int, str, bytes or None)
+            HTTP status (200 or 304), ETag and body (None for 304)
+        """
+        if name not in QUERIES and name not in LISTS \
+                and name != 'state_trends':
+            raise ApiError(404, f"unknown query {name}")
+        if fmt not in CONTENT_TYPES:
+            raise ApiError(404, f"unknown format {fmt}")
+
+        data = self.snapshot()
+        version = data.version
+        week = self.parse_week(data, name, week)
+        etag = self.etag(version, name, week, fmt)
+        if if_none_match is not None and etag in [
+            tag.strip() for tag in if_none_match.split(',')
+        ]:
+            with self.lock:
+                self.not_modified += 1
+            return 304, etag, None
+
+        key = (name, week, fmt)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] == etag:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return 200, etag, cached[1]
+            self.misses += 1
+
+        df = self.table(data, name, week)
+        body = to_json(df) if fmt == 'json' else to_arrow(df)
+        with self.lock:
+            if self.version == version:
+                self.cache[key] = (etag, body)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return 200, etag, body
+
+    def stats(self):
+        """Cache statistics served at /api/stats"""
+        with self.lock:
+            return {
+                "data_version": [[str(s), int(v)]
+                                 for s, v in self.version or ()],
+                "cached_responses": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+            }
+
+
+def api_server(api, host='127.0.0.1', port=8000):
+    """Create an HTTP server for the aggregate API
+
+    Serves GET /api/<query>.json and /api/<query>.arrow, with an optional
+    `week=YYYY-MM-DD` parameter for queries that take a week, and
+    /api/stats with the cache statistics
+
+    Parameters
+    ----------
+    api : AggregateApi
+        The API answering the requests
+    host : str, optional
+        Address to listen on; local only by default
+    port : int, optional
+        Port to listen on
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The server; call `serve_forever` to start it
+    """
+    class ApiHandler(BaseHTTPRequestHandler):
+        def send_body(self, status, content_type, body, etag=None):
+            self.send_response(status)
+            if etag is not None:
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+            if body is None:
+                self.end_headers()
+                return
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            path = url.path.rstrip('/')
+            if path == '/api/stats':
+                body = json.dumps(api.stats()).encode()
+                self.send_body(200, CONTENT_TYPES['json'], body)
+                return
+            if not path.startswith('/api/'):
+                self.send_error(404)
+                return
+            name, _, fmt = path[len('/api/'):].partition('.')
+            week = parse_qs(url.query).get('week', [None])[0]
+            try:
+                status, etag, body = api.get(
+                    name, fmt or 'json', week,
+                    self.headers.get('If-None-Match')
+                )
+            except ApiError as e:
+                body = json.dumps({"error": str(e)}).encode()
+                self.send_body(e.status, CONTENT_TYPES['json'], body)
+                return
+            except Exception as e:
+                body = json.dumps({"error": f"{type(e).__name__}: {e}"})
+                self.send_body(500, CONTENT_TYPES['json'], body.encode())
+                return
+            self.send_body(status, CONTENT_TYPES[fmt or 'json'], body, etag)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), ApiHandler)
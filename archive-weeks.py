@@ -0,0 +1,37 @@
+# Python script moving old weekly_logs weeks to Parquet archive files
+import argparse
+import time
+from archive import ARCHIVE_DIR, archive_weeks
+from utils import get_connection
+
+parser = argparse.ArgumentParser(
+    description="Move weekly_logs weeks older than a horizon to compressed "
+    "Parquet files, keeping per-state and per-ownership totals in the "
+    "database")
+parser.add_argument("--keep-weeks", type=int, default=26,
+                    help="number of latest weeks to keep in weekly_logs")
+parser.add_argument("--archive-dir", default=ARCHIVE_DIR,
+                    help="directory the archive files are written to")
+args = parser.parse_args()
+
+
+def main():
+    if args.keep_weeks < 0:
+        parser.error("--keep-weeks must not be negative")
+    start = time.perf_counter()
+    conn = get_connection()
+    try:
+        archived = archive_weeks(conn, args.keep_weeks, args.archive_dir)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+
+    for week, moved, size in archived:
+        print(f"{week}: moved {moved} rows ({size / 1024:.0f} KiB)")
+    rows = sum(moved for _, moved, _ in archived)
+    print(f"Archived {len(archived)} weeks ({rows} rows) to "
+          f"{args.archive_dir} in {elapsed:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
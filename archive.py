@@ -0,0 +1,358 @@
+# A python module moving old weekly_logs weeks to Parquet files and reading
+# them back. Each archived week is one zstd-compressed Parquet file holding
+# the week's rows, while the weekly_logs_archive and
+# weekly_logs_archive_ownership tables keep per-state and per-ownership
+# totals so history queries can answer most charts without reading the
+# files. A week is either in weekly_logs or archived, never both: loads of
+# an archived week restore it to weekly_logs first.
+import os
+import pandas as pd
+from analytics import MEASURES
+from schema import to_db
+from utils import advisory_lock, bump_data_version
+
+ARCHIVE_DIR = 'archive'
+
+# Tables holding the totals of archived weeks
+ARCHIVE_TOTALS = ['weekly_logs_archive', 'weekly_logs_archive_ownership']
+
+# Columns of an archive file, as returned by
+# dashboard_queries.weekly_logs_for_weeks
+ARCHIVE_COLUMNS = ['hospital_pk', 'state', 'collection_week'] + MEASURES
+
+
+def archive_schema():
+    """Arrow schema of an archive file
+
+    pyarrow is imported here rather than at module level so the report only
+    pays for it once archived weeks are read
+    """
+    import pyarrow as pa
+    return pa.schema(
+        [('hospital_pk', pa.string()),
+         ('state', pa.string()),
+         ('collection_week', pa.date32())]
+        + [(m, pa.float64()) for m in MEASURES]
+    )
+
+
+def archive_path(week, directory=ARCHIVE_DIR):
+    """Path of the archive file for a collection week"""
+    return os.path.join(directory, f"weekly_logs-{week}.parquet")
+
+
+def write_week(df, week, directory=ARCHIVE_DIR):
+    """Write the rows of one week to its archive file
+
+    The file is written next to its final path and then renamed, so readers
+    never see a partially written file
+
+    Parameters
+    ----------
+    df : DataFrame
+        A Pandas DataFrame with `ARCHIVE_COLUMNS`
+    week : date
+        The collection week of the rows
+    directory : str, optional
+        The archive directory
+
+    Returns
+    -------
+    int
+        The size of the written file in bytes
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(week, directory)
+    table = pa.Table.from_pandas(df[ARCHIVE_COLUMNS], schema=archive_schema(),
+                                 preserve_index=False)
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp, compression='zstd')
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def read_weeks(weeks, directory=ARCHIVE_DIR):
+    """Read the rows of archived weeks
+
+    Parameters
+    ----------
+    weeks : list of date
+        The archived collection weeks to read
+    directory : str, optional
+        The archive directory
+
+    Returns
+    -------
+    DataFrame
+        A Pandas DataFrame with `ARCHIVE_COLUMNS`, the same columns as
+        dashboard_queries.weekly_logs_for_weeks
+    """
+    if not weeks:
+        return pd.DataFrame(columns=ARCHIVE_COLUMNS)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = archive_schema()
+    tables = [pq.read_table(archive_path(week, directory), schema=schema)
+              for week in weeks]
+    return pa.concat_tables(tables).to_pandas()
+
+
+def rollup(df):
+    """Per-state totals of archived rows, stored in weekly_logs_archive
+
+    Parameters
+    ----------
+    df : DataFrame
+        A Pandas DataFrame with `ARCHIVE_COLUMNS`
+
+    Returns
+    -------
+    DataFrame
+        One row per collection week and state with the number of records,
+        the sum of each measure and the sum of total beds used, NaN where
+        SQL SUM would be NULL
+    """
+    df = df.assign(beds_used=df['adult_beds_occupied_avg']
+                   + df['pediatric_beds_occupied_avg']
+                   + df['icu_beds_occupied_avg'])
+    groups = df.groupby(['collection_week', 'state'], sort=True)
+    out = groups[MEASURES + ['beds_used']].sum(min_count=1)
+    out.insert(0, 'records', groups.size())
+    return out.reset_index()
+
+
+def rollup_ownership(df, ownership):
+    """Per-ownership totals of archived rows, in weekly_logs_archive_ownership
+
+    Parameters
+    ----------
+    df : DataFrame
+        A Pandas DataFrame with `ARCHIVE_COLUMNS`
+    ownership : DataFrame
+        `hospital_pk` and `type_of_ownership` of the hospitals with a current
+        quality version, as returned by `current_ownership`; like
+        dashboard_queries.covid_by_ownership, other hospitals are left out
+
+    Returns
+    -------
+    DataFrame
+        One row per collection week and ownership type (None for hospitals
+        rated without one) with the number of records and the sum of
+        confirmed COVID hospitalizations, NaN where SQL SUM would be NULL
+    """
+    df = df.merge(ownership, on='hospital_pk')
+    groups = df.groupby(['collection_week', 'type_of_ownership'],
+                        sort=True, dropna=False)
+    out = groups[['confirmed_covid_hospitalized_avg']].sum(min_count=1)
+    out.insert(0, 'records', groups.size())
+    out = out.reset_index()
+    out['type_of_ownership'] = out['type_of_ownership'].astype(object)
+    return out
+
+
+def current_ownership(cursor):
+    """Current ownership type of each hospital with a quality version"""
+    cursor.execute(
+        "SELECT hospital_pk, type_of_ownership "
+        "FROM hospital_quality_as_of('infinity')"
+    )
+    return pd.DataFrame(cursor.fetchall(),
+                        columns=['hospital_pk', 'type_of_ownership'])
+
+
+def _insert_totals(cursor, table, totals):
+    """Insert the rows of a totals DataFrame into an archive totals table"""
+    columns = list(totals.columns)
+    cursor.executemany(
+        f"""
+        INSERT INTO {table} ({', '.join(columns)})
+        VALUES ({', '.join(['%s'] * len(columns))})
+        """,
+        [tuple(to_db(value) for value in row)
+         for row in totals.itertuples(index=False, name=None)]
+    )
+
+
+def hot_weeks(cursor):
+    """Collection weeks in weekly_logs, latest first"""
+    cursor.execute(
+        "SELECT DISTINCT collection_week FROM weekly_logs "
+        "ORDER BY collection_week DESC"
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def archive_week(cursor, week, directory=ARCHIVE_DIR):
+    """Move one week of weekly_logs to its archive file
+
+    The rows are written to Parquet, the week's totals replace its rows in
+    weekly_logs_archive and weekly_logs_archive_ownership (each hospital
+    counted under its current ownership type) and the rows are deleted from
+    weekly_logs. If the week also has archived totals, which loads before
+    `restore_week` could leave, the rows are merged into the existing
+    file. Run inside a transaction: if it fails, the
+    database is unchanged and a written file is overwritten on the next run.
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor
+    week : date
+        The collection week to archive
+    directory : str, optional
+        The archive directory
+
+    Returns
+    -------
+    tuple of (int, int)
+        The number of rows moved and the size of the archive file in bytes
+    """
+    # wait for loads of the week in progress, so their rows are archived too
+    advisory_lock(cursor, f"weekly_logs:{week}")
+    cursor.execute(
+        f"""
+        SELECT wl.hospital_pk, l.state, wl.collection_week,
+            {', '.join('wl.' + m for m in MEASURES)}
+        FROM weekly_logs wl
+        JOIN hospital h ON wl.hospital_pk = h.hospital_pk
+        JOIN locations l ON h.zipcode = l.zipcode
+        WHERE wl.collection_week = %s
+        """, (week,)
+    )
+    rows = pd.DataFrame(cursor.fetchall(), columns=ARCHIVE_COLUMNS)
+    rows[MEASURES] = rows[MEASURES].astype('float64')
+
+    cursor.execute(
+        "SELECT COUNT(*) FROM weekly_logs_archive WHERE collection_week = %s",
+        (week,)
+    )
+    if cursor.fetchone()[0] > 0:
+        archived = read_weeks([week], directory)
+        archived = archived[~archived['hospital_pk'].isin(rows['hospital_pk'])]
+        rows = pd.concat([archived, rows], ignore_index=True)
+
+    size = write_week(rows, week, directory)
+    for table in ARCHIVE_TOTALS:
+        cursor.execute(f"DELETE FROM {table} WHERE collection_week = %s",
+                       (week,))
+    _insert_totals(cursor, 'weekly_logs_archive', rollup(rows))
+    _insert_totals(cursor, 'weekly_logs_archive_ownership',
+                   rollup_ownership(rows, current_ownership(cursor)))
+    cursor.execute("DELETE FROM weekly_logs WHERE collection_week = %s",
+                   (week,))
+    return cursor.rowcount, size
+
+
+def archived_among(cursor, weeks):
+    """The weeks of a list that are archived"""
+    cursor.execute(
+        "SELECT DISTINCT collection_week FROM weekly_logs_archive "
+        "WHERE collection_week = ANY(%s) ORDER BY collection_week",
+        (list(weeks),)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def restore_week(cursor, week, directory=ARCHIVE_DIR):
+    """Move the rows of an archived week back into weekly_logs
+
+    Loads call this for each archived week of their file before inserting
+    its rows, so the week is then loaded like any other week in
+    weekly_logs, and history queries never count it both from its rows
+    and from its archived totals. The archive file is left in place and
+    overwritten when the week is archived again. Run inside a transaction
+    holding the week's advisory lock.
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor, inside a transaction
+    week : date
+        The archived collection week
+    directory : str, optional
+        The archive directory
+
+    Returns
+    -------
+    int
+        The number of rows restored
+    """
+    rows = read_weeks([week], directory)
+    columns = ['collection_week', 'hospital_pk'] + MEASURES
+    with cursor.copy(
+        f"COPY weekly_logs ({', '.join(columns)}) FROM STDIN"
+    ) as copy:
+        for row in rows[columns].itertuples(index=False, name=None):
+            copy.write_row(tuple(to_db(value) for value in row))
+    for table in ARCHIVE_TOTALS:
+        cursor.execute(f"DELETE FROM {table} WHERE collection_week = %s",
+                       (week,))
+    return len(rows)
+
+
+def backfill_ownership(cursor, directory=ARCHIVE_DIR):
+    """Add the ownership totals of archived weeks that have none
+
+    Weeks archived before weekly_logs_archive_ownership existed get their
+    totals from their archive files, with the current ownership types
+
+    Returns
+    -------
+    list of date
+        The weeks filled in
+    """
+    cursor.execute(
+        """
+        SELECT DISTINCT wa.collection_week
+        FROM weekly_logs_archive wa
+        WHERE NOT EXISTS (
+            SELECT 1 FROM weekly_logs_archive_ownership wo
+            WHERE wo.collection_week = wa.collection_week
+        )
+        ORDER BY wa.collection_week
+        """
+    )
+    weeks = [row[0] for row in cursor.fetchall()]
+    if weeks:
+        _insert_totals(cursor, 'weekly_logs_archive_ownership',
+                       rollup_ownership(read_weeks(weeks, directory),
+                                        current_ownership(cursor)))
+    return weeks
+
+
+def archive_weeks(conn, keep_weeks, directory=ARCHIVE_DIR):
+    """Archive every weekly_logs week but the latest `keep_weeks`
+
+    Each week is archived in its own transaction, so an interrupted run
+    keeps the weeks it finished. Archived weeks without ownership totals get
+    them first (see `backfill_ownership`).
+
+    Parameters
+    ----------
+    conn : psycopg.Connection
+        An open database connection
+    keep_weeks : int
+        Number of latest weeks to keep in weekly_logs
+    directory : str, optional
+        The archive directory
+
+    Returns
+    -------
+    list of tuple
+        (week, rows moved, file size in bytes) for each archived week
+    """
+    with conn.transaction(), conn.cursor() as cursor:
+        if backfill_ownership(cursor, directory):
+            bump_data_version(cursor, "archive")
+        weeks = hot_weeks(cursor)[keep_weeks:]
+    archived = []
+    for week in sorted(weeks):
+        with conn.transaction(), conn.cursor() as cursor:
+            moved, size = archive_week(cursor, week, directory)
+            bump_data_version(cursor, "archive")
+        archived.append((week, moved, size))
+    return archived
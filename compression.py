@@ -0,0 +1,205 @@
+# A python module opening plain and compressed data files as byte streams,
+# so the CSV parser reads .gz, .zip and .zst files without an uncompressed
+# copy on disk
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import time
+import zipfile
+
+# File name suffixes of the supported compressed formats
+COMPRESSIONS = {'.gz': 'gzip', '.zip': 'zip', '.zst': 'zstd'}
+
+# Decompressors run as a separate process when installed, so decompression
+# runs on another core while the parser works through the previous block
+EXTERNAL_DECOMPRESSORS = {
+    'gzip': ['pigz', '-dc'],
+    'zstd': ['zstd', '-dcq'],
+}
+
+# Size of the reads issued to the decompressed stream
+BUFFER_SIZE = 1 << 20
+
+
+def split_compression(filename):
+    """Split a compression suffix off a file name
+
+    Parameters
+    ----------
+    filename : str
+        A file name such as `2022-01-07-hhs-data.csv.zst`
+
+    Returns
+    -------
+    tuple of (str, str or None)
+        The file name without the suffix and the compression ('gzip', 'zip'
+        or 'zstd'), or the unchanged name and None for other files
+    """
+    for suffix, compression in COMPRESSIONS.items():
+        if filename.lower().endswith(suffix):
+            return filename[:-len(suffix)], compression
+    return filename, None
+
+
+class MeteredReader(io.RawIOBase):
+    """A binary stream recording the bytes read and the time spent waiting"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+        self.wait_seconds = 0.0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        n = self.raw.readinto(buffer)
+        now = time.perf_counter()
+        self.wait_seconds += now - start
+        if n:
+            self.bytes += n
+        elif self.finished is None:
+            self.finished = now
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+class DataSource:
+    """A data file opened for reading, decompressed on the fly
+
+    .gz and .zst files are decompressed by `pigz` or `zstd` in a separate
+    process when those commands are installed, and in-process otherwise
+    (.zst then needs the `zstandard` package). A .zip file must hold
+    exactly one CSV file. Use as a context manager, and read `stream`.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to a .csv file, or to a .csv.gz, .zip or .csv.zst file
+
+    Attributes
+    ----------
+    name : str
+        File name of the CSV data: the name of the file inside a .zip, or
+        the file name without its compression suffix
+    compression : str or None
+        'gzip', 'zip', 'zstd' or None
+    stream : io.BufferedReader
+        The uncompressed CSV bytes
+    """
+
+    def __init__(self, filepath):
+        self.path = filepath
+        self.name, self.compression = split_compression(
+            os.path.basename(filepath)
+        )
+        self.compressed_bytes = os.path.getsize(filepath)
+        self.decompressor = None
+        self._process = None
+        self._archive = None
+        self.reader = MeteredReader(self._open())
+        self.stream = io.BufferedReader(self.reader, BUFFER_SIZE)
+
+    def _open(self):
+        if self.compression is None:
+            return open(self.path, 'rb')
+
+        if self.compression == 'zip':
+            self._archive = zipfile.ZipFile(self.path)
+            members = [
+                m for m in self._archive.infolist()
+                if not m.is_dir() and m.filename.lower().endswith('.csv')
+            ]
+            if len(members) != 1:
+                self._archive.close()
+                raise ValueError(f"{self.path} holds {len(members)} CSV "
+                                 "files; expected exactly one")
+            self.name = os.path.basename(members[0].filename)
+            self.decompressor = 'zipfile'
+            return self._archive.open(members[0])
+
+        command = EXTERNAL_DECOMPRESSORS[self.compression]
+        if shutil.which(command[0]):
+            self.decompressor = command[0]
+            self._process = subprocess.Popen(
+                command + [self.path], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, bufsize=BUFFER_SIZE
+            )
+            return self._process.stdout
+
+        if self.compression == 'gzip':
+            self.decompressor = 'gzip'
+            return gzip.open(self.path, 'rb')
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("reading .zst files needs the zstd command or "
+                               "the zstandard package") from None
+        self.decompressor = 'zstandard'
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(self.path, 'rb'), closefd=True
+        )
+
+    def close(self, failed=False):
+        """Close the stream; raise if the decompressor failed"""
+        self.stream.close()
+        if self._archive is not None:
+            self._archive.close()
+        if self._process is not None:
+            if failed:
+                self._process.kill()
+            self._process.wait()
+            error = self._process.stderr.read().decode(errors='replace')
+            self._process.stderr.close()
+            if not failed and self._process.returncode != 0:
+                raise OSError(f"{self.decompressor} failed on {self.path}: "
+                              f"{error.strip()}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(failed=exc_type is not None)
+
+    def stats(self):
+        """Read statistics of the file
+
+        The time spent inside the reads of the decompressed stream is the
+        decompression time of an in-process decompressor (or the read time
+        of an uncompressed file). An external decompressor runs alongside
+        the parser, so for it this is only the time the parser waited for
+        data, and `mb_per_s` is an upper bound on its throughput.
+
+        Returns
+        -------
+        dict
+            `compression`, `decompressor`, `external` (whether the
+            decompressor ran in a separate process), `compressed_bytes`,
+            `bytes` (uncompressed), `seconds` the end-to-end read time from
+            opening the file to the end of the data, parsing included,
+            `wait_seconds` spent inside the reads of the decompressed
+            stream, and `mb_per_s` (uncompressed megabytes per second of
+            `wait_seconds`)
+        """
+        reader = self.reader
+        end = reader.finished or time.perf_counter()
+        wait = reader.wait_seconds
+        return {
+            "compression": self.compression,
+            "decompressor": self.decompressor,
+            "external": self._process is not None,
+            "compressed_bytes": self.compressed_bytes,
+            "bytes": reader.bytes,
+            "seconds": end - reader.started,
+            "wait_seconds": wait,
+            "mb_per_s": reader.bytes / 1e6 / wait if wait else None,
+        }
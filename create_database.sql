@@ -2,6 +2,12 @@ DROP TABLE IF EXISTS locations CASCADE;
 DROP TABLE IF EXISTS hospital CASCADE;
 DROP TABLE IF EXISTS weekly_logs CASCADE;
 DROP TABLE IF EXISTS hospital_quality CASCADE;
+DROP TABLE IF EXISTS weekly_logs_rejects CASCADE;
+DROP TABLE IF EXISTS weekly_logs_archive CASCADE;
+DROP TABLE IF EXISTS weekly_logs_archive_ownership CASCADE;
+DROP TABLE IF EXISTS hospital_sample CASCADE;
+DROP TABLE IF EXISTS data_version CASCADE;
+DROP FUNCTION IF EXISTS hospital_quality_as_of(DATE);
 DROP TYPE IF EXISTS quality CASCADE;
 
 CREATE TABLE locations (
@@ -31,6 +37,29 @@ CREATE TABLE weekly_logs (
     confirmed_covid_hospitalized_avg FLOAT8 CHECK (confirmed_covid_hospitalized_avg >=0),
     confirmed_covid_icu_avg FLOAT8 CHECK (confirmed_covid_icu_avg >=0),
     hospital_pk TEXT NOT NULL REFERENCES hospital(hospital_pk),
+    -- Occupancy metrics derived from the measures when a row is written, so
+    -- dashboard queries read them instead of recomputing them per request.
+    -- Totals are NULL if any bed type is missing, fractions if no beds are
+    -- available.
+    beds_used FLOAT8 GENERATED ALWAYS AS (
+        adult_beds_occupied_avg + pediatric_beds_occupied_avg
+        + icu_beds_occupied_avg) STORED,
+    beds_available FLOAT8 GENERATED ALWAYS AS (
+        adult_beds_available_avg + pediatric_beds_available_avg
+        + icu_beds_available_avg) STORED,
+    adult_fraction_used FLOAT8 GENERATED ALWAYS AS (
+        adult_beds_occupied_avg
+        / NULLIF(adult_beds_available_avg, 0)) STORED,
+    pediatric_fraction_used FLOAT8 GENERATED ALWAYS AS (
+        pediatric_beds_occupied_avg
+        / NULLIF(pediatric_beds_available_avg, 0)) STORED,
+    icu_fraction_used FLOAT8 GENERATED ALWAYS AS (
+        icu_beds_occupied_avg / NULLIF(icu_beds_available_avg, 0)) STORED,
+    fraction_used FLOAT8 GENERATED ALWAYS AS (
+        (adult_beds_occupied_avg + pediatric_beds_occupied_avg
+         + icu_beds_occupied_avg)
+        / NULLIF(adult_beds_available_avg + pediatric_beds_available_avg
+                 + icu_beds_available_avg, 0)) STORED,
     PRIMARY KEY (hospital_pk, collection_week),
     CHECK(adult_beds_occupied_avg <= adult_beds_available_avg),
     CHECK(pediatric_beds_occupied_avg <= pediatric_beds_available_avg),
@@ -38,6 +67,62 @@ CREATE TABLE weekly_logs (
     CHECK(confirmed_covid_icu_avg <= confirmed_covid_hospitalized_avg)
 );
 
+-- Single-week dashboard queries and the hospital drill-down filter on week
+CREATE INDEX weekly_logs_week_idx ON weekly_logs (collection_week, hospital_pk);
+
+-- Lets the beds-used history be summed with an index-only scan instead of
+-- reading every full weekly_logs row
+CREATE INDEX weekly_logs_beds_used_idx ON weekly_logs (collection_week)
+    INCLUDE (beds_used, confirmed_covid_hospitalized_avg);
+
+-- Orders the hospital drill-down by occupancy (the sort key of
+-- dashboard_queries.hospital_page_by_occupancy), so a page is read from the
+-- index starting at its cursor
+CREATE INDEX weekly_logs_occupancy_idx ON weekly_logs (
+    (-COALESCE(fraction_used, -1)), hospital_pk, collection_week);
+
+-- Looks up the weeks of each sampled hospital of the approximate report
+-- mode, covering the columns it sums, so the sample is read with an
+-- index-only scan instead of every row of the weeks
+CREATE INDEX weekly_logs_hospital_idx
+    ON weekly_logs (hospital_pk, collection_week)
+    INCLUDE (beds_used, confirmed_covid_hospitalized_avg);
+
+-- Per-state totals of the weeks moved out of weekly_logs by archive-weeks.py.
+-- The rows of an archived week are kept in its Parquet file; a week is either
+-- in weekly_logs or in this table, and history queries union the two.
+CREATE TABLE weekly_logs_archive (
+    collection_week DATE NOT NULL,
+    state TEXT NOT NULL,
+    records INTEGER NOT NULL,
+    adult_beds_available_avg FLOAT8,
+    adult_beds_occupied_avg FLOAT8,
+    pediatric_beds_available_avg FLOAT8,
+    pediatric_beds_occupied_avg FLOAT8,
+    icu_beds_available_avg FLOAT8,
+    icu_beds_occupied_avg FLOAT8,
+    confirmed_covid_hospitalized_avg FLOAT8,
+    confirmed_covid_icu_avg FLOAT8,
+    -- sum of adult, pediatric and ICU beds occupied, NULL rows excluded
+    beds_used FLOAT8,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (collection_week, state)
+);
+
+-- COVID totals of archived weeks by ownership type, for the history by
+-- ownership. Each hospital is counted under the ownership type of its
+-- current quality version when the week was archived; hospitals without one
+-- are left out, and a NULL type groups rated hospitals without an ownership.
+CREATE TABLE weekly_logs_archive_ownership (
+    collection_week DATE NOT NULL,
+    type_of_ownership TEXT,
+    records INTEGER NOT NULL,
+    confirmed_covid_hospitalized_avg FLOAT8
+);
+
+CREATE INDEX weekly_logs_archive_ownership_week_idx
+    ON weekly_logs_archive_ownership (collection_week);
+
 CREATE TYPE quality AS ENUM ('1', '2', '3', '4', '5', 'Not Available');
 
 CREATE TABLE hospital_quality (
@@ -47,5 +132,66 @@ CREATE TABLE hospital_quality (
     type_of_ownership TEXT,
     emergency_services BOOLEAN,
     hospital_pk TEXT NOT NULL REFERENCES hospital(hospital_pk),
+    -- A row is a version of a hospital's attributes, valid from date_updated
+    -- until valid_to (NULL for the current version). load-quality.py only
+    -- writes a new version when the attributes change.
+    valid_to DATE CHECK (valid_to > date_updated),
     PRIMARY KEY (hospital_pk, date_updated)
-);
\ No newline at end of file
+);
+
+-- At most one current version per hospital
+CREATE UNIQUE INDEX hospital_quality_current_idx
+    ON hospital_quality (hospital_pk) WHERE valid_to IS NULL;
+
+-- The version of each hospital's quality attributes valid on a date, or the
+-- current versions with 'infinity'. Being a single SQL statement, the
+-- function is inlined into the calling query by the planner.
+CREATE FUNCTION hospital_quality_as_of(as_of DATE)
+RETURNS SETOF hospital_quality
+LANGUAGE sql STABLE
+AS $$
+    SELECT *
+    FROM hospital_quality
+    WHERE date_updated <= as_of
+        AND (valid_to IS NULL OR valid_to > as_of)
+$$;
+
+-- Rows rejected by the server-side validation mode of load-hhs.py
+CREATE TABLE weekly_logs_rejects (
+    reject_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    rejected_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    source_row INTEGER,
+    reason TEXT NOT NULL,
+    collection_week DATE,
+    adult_beds_available_avg FLOAT8,
+    pediatric_beds_available_avg FLOAT8,
+    adult_beds_occupied_avg FLOAT8,
+    pediatric_beds_occupied_avg FLOAT8,
+    icu_beds_available_avg FLOAT8,
+    icu_beds_occupied_avg FLOAT8,
+    confirmed_covid_hospitalized_avg FLOAT8,
+    confirmed_covid_icu_avg FLOAT8,
+    hospital_pk TEXT
+);
+
+
+-- Stratified sample of hospitals for the approximate report mode, redrawn by
+-- the loaders when hospitals or quality ratings change (see sampling.py).
+-- A stratum is a state and current quality rating, of stratum_size
+-- hospitals of which sample_size are sampled.
+CREATE TABLE hospital_sample (
+    hospital_pk TEXT PRIMARY KEY REFERENCES hospital(hospital_pk),
+    stratum TEXT NOT NULL,
+    stratum_size INTEGER NOT NULL CHECK (stratum_size > 0),
+    sample_size INTEGER NOT NULL
+        CHECK (sample_size > 0 AND sample_size <= stratum_size)
+);
+
+
+-- One counter per data source, bumped by every successful load so that
+-- dashboard caches know when to refresh
+CREATE TABLE data_version (
+    source TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
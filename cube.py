@@ -0,0 +1,436 @@
+# A python module holding an in-memory data cube for the weekly report
+import os
+import pickle
+import threading
+import numpy as np
+import pandas as pd
+import analytics
+import archive
+import dashboard_queries as queries
+import dashboard_utils as utils
+
+# Order of the quality ENUM in the database
+QUALITY_ORDER = ['1', '2', '3', '4', '5', 'Not Available']
+
+
+def group_sum(codes, n_groups, arr):
+    """Sum the rows of an array by group
+
+    Parameters
+    ----------
+    codes : ndarray
+        Group code of each row; rows with a negative code are ignored
+    n_groups : int
+        Number of groups
+    arr : ndarray
+        A (row x ...) array; NaN values are skipped
+
+    Returns
+    -------
+    tuple of (ndarray, ndarray)
+        The (group x ...) sums, NaN where a group has no values like SQL SUM,
+        and the (group x ...) number of non-NaN values
+    """
+    keep = codes >= 0
+    onehot = np.zeros((n_groups, len(codes)))
+    onehot[codes[keep], np.flatnonzero(keep)] = 1.0
+    arr = np.asarray(arr, dtype=np.float64)
+    valid = ~np.isnan(arr)
+    counts = onehot @ valid
+    sums = onehot @ np.where(valid, arr, 0.0)
+    return np.where(counts > 0, sums, np.nan), counts
+
+
+class CubeSnapshot:
+    """The report data of one data version, answering every report query
+
+    A snapshot is never changed once published by `ReportCube.refresh`, so
+    a request that captures one snapshot and answers all of its queries
+    from it sees consistent data, whatever refreshes run meanwhile.
+
+    Parameters
+    ----------
+    matrix : analytics.WeekMatrix
+        The weekly_logs measures; not changed after this call
+    attributes : DataFrame
+        Each hospital's state, ownership, emergency services and latest
+        quality rating, as returned by `hospital_attributes`
+    version : tuple or None
+        The data version the snapshot reflects
+    """
+
+    def __init__(self, matrix, attributes, version):
+        self.matrix = matrix
+        self.attributes = attributes
+        self.version = version
+        self._record_counts = None
+
+    # ---- helpers ----
+
+    def _hospital_attribute(self, column, fill_value=None):
+        """An attribute aligned with the rows of the matrix"""
+        attrs = self.attributes.set_index('hospital_pk')[column]
+        attrs = attrs.reindex(self.matrix.hospitals, fill_value=fill_value)
+        return attrs.to_numpy(dtype=object)
+
+    def _rated(self):
+        """Mask of matrix rows for hospitals with a quality rating"""
+        return self._hospital_attribute('has_quality', False).astype(bool)
+
+    def _week_index(self, week):
+        return self.matrix.weeks.index(week)
+
+    def _weeks_up_to(self, week):
+        return [i for i, w in enumerate(self.matrix.weeks) if w <= week]
+
+    # ---- report queries ----
+
+    def weeks(self):
+        """Collection weeks, latest first (get_weeks)"""
+        return sorted(self.matrix.weeks, reverse=True)
+
+    def states(self):
+        """States with at least one hospital (get_states)"""
+        return sorted(self.attributes['state'].dropna().unique())
+
+    def ownership_types(self):
+        """Hospital ownership types (get_ownership_types)"""
+        return sorted(self.attributes['type_of_ownership'].dropna().unique())
+
+    def record_counts(self):
+        """(week, number of records) pairs, in week order"""
+        if self._record_counts is None:
+            counts = self.matrix.present.sum(axis=0)
+            self._record_counts = list(zip(self.matrix.weeks,
+                                           counts.tolist()))
+        return self._record_counts
+
+    def weekly_records_summary(self):
+        """Records loaded per week (query #1)"""
+        return pd.DataFrame({
+            "Collection Week": self.matrix.weeks,
+            "Count of Records Loaded": self.matrix.present.sum(axis=0),
+        })
+
+    def bed_summary_5_weeks(self, week):
+        """State bed totals for the week and the 4 weeks before (query #2)"""
+        m = self.matrix
+        cols = self._weeks_up_to(week)[-5:][::-1]
+        codes, states = pd.factorize(m.state, sort=True)
+        present, _ = group_sum(codes, len(states),
+                               np.where(m.present[:, cols], 1.0, np.nan))
+        measures = {
+            'adult_beds_available': 'adult_beds_available_avg',
+            'adult_beds_used': 'adult_beds_occupied_avg',
+            'pediatric_beds_available': 'pediatric_beds_available_avg',
+            'pediatric_beds_used': 'pediatric_beds_occupied_avg',
+            'covid_beds_used': 'confirmed_covid_hospitalized_avg',
+        }
+        df = pd.DataFrame({
+            'state': np.repeat(np.asarray(states, dtype=object), len(cols)),
+            'week': np.tile(np.array([m.weeks[c] for c in cols],
+                                     dtype=object), len(states)),
+        })
+        for name, measure in measures.items():
+            sums, _ = group_sum(codes, len(states), m.values[measure][:, cols])
+            df[name] = sums.reshape(-1)
+        df = df[~np.isnan(present.reshape(-1))]
+        return df.reset_index(drop=True)
+
+    def beds_fraction_by_quality(self, week):
+        """Average fraction of beds used by quality rating (query #3)"""
+        m = self.matrix
+        col = self._week_index(week)
+        rows = m.present[:, col] & self._rated()
+        v = {k: a[rows, col] for k, a in m.values.items()}
+        quality = self._hospital_attribute('quality_rating')[rows]
+        df = pd.DataFrame({
+            'quality_rating': quality,
+            'adult': analytics.fraction(v['adult_beds_occupied_avg'],
+                                        v['adult_beds_available_avg']),
+            'pediatric': analytics.fraction(
+                v['pediatric_beds_occupied_avg'],
+                v['pediatric_beds_available_avg']),
+            'icu': analytics.fraction(v['icu_beds_occupied_avg'],
+                                      v['icu_beds_available_avg']),
+            'total': analytics.fraction(
+                v['adult_beds_occupied_avg'] + v['pediatric_beds_occupied_avg']
+                + v['icu_beds_occupied_avg'],
+                v['adult_beds_available_avg']
+                + v['pediatric_beds_available_avg']
+                + v['icu_beds_available_avg']),
+        })
+        df['quality_rating'] = pd.Categorical(df['quality_rating'],
+                                              categories=QUALITY_ORDER,
+                                              ordered=True)
+        out = df.groupby('quality_rating', observed=True).agg(
+            adult=('adult', 'mean'),
+            pediatric=('pediatric', 'mean'),
+            icu=('icu', 'mean'),
+            total=('total', 'mean'),
+            num_hospitals=('adult', 'size'),
+        ).reset_index()
+        out['quality_rating'] = out['quality_rating'].astype(str)
+        return out
+
+    def beds_used_over_time(self, week):
+        """Total and COVID beds used per week up to the week (query #4)"""
+        m = self.matrix
+        cols = self._weeks_up_to(week)
+        used = m.beds_used()[:, cols].astype(np.float64)
+        covid = m.values['confirmed_covid_hospitalized_avg'][:, cols]
+        codes = np.zeros(len(m.hospitals), dtype=int)
+        all_sum, _ = group_sum(codes, 1, used)
+        covid_sum, _ = group_sum(codes, 1, covid)
+        return pd.DataFrame({
+            'collection_week': [m.weeks[c] for c in cols],
+            'all': all_sum[0],
+            'covid': covid_sum[0],
+        })
+
+    def avg_quality_by_state(self):
+        """Average latest quality rating by state (query #5)"""
+        attrs = self.attributes[self.attributes['has_quality'].astype(bool)]
+        rating = pd.to_numeric(attrs['quality_rating'], errors='coerce')
+        df = pd.DataFrame({
+            'state': attrs['state'],
+            'rating': rating,
+            'rated': rating.notna(),
+        })
+        out = df.groupby('state', observed=True).agg(
+            avg_quality_rating=('rating', 'mean'),
+            num_hospitals_rated=('rated', 'sum'),
+            total_hospitals=('rated', 'size'),
+        ).reset_index()
+        return out.sort_values('avg_quality_rating', ascending=False,
+                               na_position='last', kind='stable',
+                               ignore_index=True)
+
+    def covid_by_ownership(self, week):
+        """COVID patients per week and ownership type (query #6)"""
+        m = self.matrix
+        cols = self._weeks_up_to(week)
+        rated = self._rated()
+        owner = self._hospital_attribute('type_of_ownership')
+        owner = np.where(pd.isna(owner), None, owner)
+        codes, owners = pd.factorize(owner, sort=True, use_na_sentinel=False)
+        codes = np.where(rated, codes, -1)
+        covid = m.values['confirmed_covid_hospitalized_avg'][:, cols]
+        present, _ = group_sum(codes, len(owners),
+                               np.where(m.present[:, cols], 1.0, np.nan))
+        sums, _ = group_sum(codes, len(owners), covid)
+        df = pd.DataFrame({
+            'collection_week': np.tile(
+                np.array([m.weeks[c] for c in cols], dtype=object),
+                len(owners)),
+            'type_of_ownership': np.repeat(np.asarray(owners, dtype=object),
+                                           len(cols)),
+            'covid_cases': sums.reshape(-1),
+        })
+        df = df[~np.isnan(present.reshape(-1))]
+        return df.sort_values(['collection_week', 'type_of_ownership'],
+                              na_position='last', kind='stable',
+                              ignore_index=True)
+
+    def beds_by_emergency_services(self, week):
+        """Beds in use by state and emergency services (query #7)"""
+        m = self.matrix
+        col = self._week_index(week)
+        rows = m.present[:, col] & self._rated()
+        emergency = self._hospital_attribute('emergency_services')[rows]
+        df = pd.DataFrame({
+            'state': m.state[rows],
+            'emergency_services': [
+                None if pd.isna(x) else bool(x) for x in emergency
+            ],
+            'adult_beds_in_use':
+                m.values['adult_beds_occupied_avg'][rows, col],
+            'pediatric_beds_in_use':
+                m.values['pediatric_beds_occupied_avg'][rows, col],
+            'icu_beds_in_use': m.values['icu_beds_occupied_avg'][rows, col],
+            'covid_beds_in_use':
+                m.values['confirmed_covid_hospitalized_avg'][rows, col],
+        })
+        df['emergency_services'] = df['emergency_services'].astype(object)
+        out = df.groupby(['state', 'emergency_services'], dropna=False,
+                         sort=False).sum(min_count=1).reset_index()
+        # ORDER BY state, emergency_services DESC puts NULL first
+        rank = out['emergency_services'].map(
+            lambda x: 0 if x is None or pd.isna(x) else (1 if x else 2)
+        )
+        return out.assign(_rank=rank).sort_values(
+            ['state', '_rank'], kind='stable', ignore_index=True
+        ).drop(columns='_rank')
+
+    def icu_capacity_by_hospital(self, week):
+        """ICU beds per hospital for the week (icu_capacity_by_hospital)"""
+        m = self.matrix
+        col = self._week_index(week)
+        rows = m.present[:, col]
+        return pd.DataFrame({
+            'hospital_pk': m.hospitals[rows],
+            'icu_beds_available_avg':
+                m.values['icu_beds_available_avg'][rows, col],
+            'icu_beds_occupied_avg':
+                m.values['icu_beds_occupied_avg'][rows, col],
+        })
+
+
+class ReportCube:
+    """A server-wide in-memory cube answering every weekly report query
+
+    The cube holds the weekly_logs measures as an `analytics.WeekMatrix`
+    joined with each hospital's state, ownership, emergency services and
+    latest quality rating. It is refreshed when the loaders bump the
+    `data_version` table, re-reading only the weeks whose record counts
+    changed, and each report query is answered with NumPy group-bys
+    returning the same frame as the SQL in `dashboard_queries`. Weeks moved
+    out of weekly_logs by archive-weeks.py are read from their Parquet files
+    in `archive_dir`.
+
+    The data is published as a `CubeSnapshot`. A refresh updates a copy of
+    the matrix and then replaces the snapshot in one assignment, so readers
+    in other threads never see a half-updated matrix; a reader should take
+    one `snapshot()` per request.
+    """
+
+    def __init__(self, archive_dir=archive.ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self.current = CubeSnapshot(
+            analytics.WeekMatrix(),
+            pd.DataFrame(columns=['hospital_pk', 'state', 'has_quality',
+                                  'quality_rating', 'type_of_ownership',
+                                  'emergency_services']),
+            None,
+        )
+        self.lock = threading.Lock()
+        self._background = None
+        self._background_error = None
+
+    def snapshot(self):
+        """The current `CubeSnapshot`, without checking the data version"""
+        return self.current
+
+    def save(self, path):
+        """Write the matrix of the current snapshot to a file
+
+        A process that starts with `load` then reads only the weeks that
+        changed since, instead of every week of the database.
+
+        Parameters
+        ----------
+        path : str
+            The file to write
+        """
+        matrix = self.current.matrix
+        state = {
+            name: getattr(matrix, name)
+            for name in ('hospitals', 'weeks', 'state', 'present', 'values')
+        }
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """Start from a matrix written by `save`
+
+        The data version is not restored, so the next `refresh` compares the
+        record count of every week with the database and reads the weeks
+        that changed, as it does for the weeks held in memory.
+
+        Parameters
+        ----------
+        path : str
+            The file written by `save`
+
+        Returns
+        -------
+        bool
+            Whether a matrix was loaded; the cube starts empty otherwise
+        """
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        matrix = analytics.WeekMatrix()
+        for name, value in state.items():
+            setattr(matrix, name, value)
+        self.current = CubeSnapshot(matrix, self.current.attributes, None)
+        return True
+
+    def refresh_in_background(self):
+        """Bring the cube up to date in a background thread
+
+        Starts a refresh unless one is running already, and returns at once,
+        so the approximate report mode can draw estimates meanwhile. An
+        error of the background refresh is raised by the next call.
+
+        Returns
+        -------
+        bool
+            Whether the cube reflects the current data version
+        """
+        error, self._background_error = self._background_error, None
+        if error is not None:
+            raise error
+        if utils.get_data_version() == self.current.version:
+            return True
+        if self._background is None or not self._background.is_alive():
+            self._background = threading.Thread(
+                target=self._refresh_logged, daemon=True
+            )
+            self._background.start()
+        return False
+
+    def _refresh_logged(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self._background_error = e
+
+    def refresh(self):
+        """Bring the cube up to date with the database
+
+        Returns
+        -------
+        CubeSnapshot
+            The snapshot of the current data version
+        """
+        version = utils.get_data_version()
+        current = self.current
+        if version == current.version:
+            return current
+        with self.lock:
+            current = self.current
+            if version == current.version:
+                return current
+            matrix = current.matrix.copy()
+
+            db_counts = utils.run_query(queries.weekly_records_summary, {})
+            db_counts = dict(zip(db_counts['Collection Week'],
+                                 db_counts['Count of Records Loaded']))
+            cube_counts = dict(zip(matrix.weeks, matrix.present.sum(axis=0)))
+            removed = [w for w in matrix.weeks if w not in db_counts]
+            stale = [w for w, n in db_counts.items()
+                     if cube_counts.get(w) != n]
+            matrix.drop_weeks(removed + stale)
+            if stale:
+                archived = set(
+                    utils.run_query(queries.archived_weeks, {})['week']
+                )
+                hot = [w for w in stale if w not in archived]
+                cold = [w for w in stale if w in archived]
+                if hot:
+                    matrix.update(utils.run_query(
+                        queries.weekly_logs_for_weeks, {"weeks": hot}
+                    ))
+                matrix.update(archive.read_weeks(cold, self.archive_dir))
+
+            # a hospital whose ZIP code changed moves to its new state, as in
+            # the SQL queries, without its weeks being read again
+            attributes = utils.run_query(queries.hospital_attributes, {})
+            matrix.set_states(attributes)
+            self.current = CubeSnapshot(matrix, attributes, version)
+            return self.current
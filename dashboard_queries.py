@@ -1,13 +1,30 @@
 # -----------------
 # Dashboard queries
 # -----------------
+# hospital_quality_as_of('infinity') returns each hospital's current
+# hospital_quality version (see create_database.sql). Weeks moved to Parquet
+# by archive-weeks.py leave weekly_logs; the history queries union their
+# per-state totals from weekly_logs_archive, or their per-ownership totals
+# from weekly_logs_archive_ownership. A week is never in both. Queries of a
+# single week by hospital attribute (3 and 7) and per hospital (8 and 9) only
+# cover weeks in weekly_logs; the report answers them for archived weeks
+# from the cube, which reads the archive files.
 
 get_weeks = """
-SELECT DISTINCT collection_week AS week
+SELECT collection_week AS week
 FROM weekly_logs
+UNION
+SELECT collection_week
+FROM weekly_logs_archive
 ORDER BY week DESC;
 """
 
+archived_weeks = """
+SELECT DISTINCT collection_week AS week
+FROM weekly_logs_archive
+ORDER BY week;
+"""
+
 get_states = """
 SELECT DISTINCT state
 FROM locations
@@ -21,7 +38,13 @@ SELECT
     COUNT(*) AS "Count of Records Loaded"
 FROM weekly_logs
 GROUP BY collection_week
-ORDER BY collection_week;
+UNION ALL
+SELECT
+    collection_week,
+    SUM(records)
+FROM weekly_logs_archive
+GROUP BY collection_week
+ORDER BY "Collection Week";
 """
 
 # 2
@@ -30,9 +53,13 @@ bed_summary_5_weeks = """
 Return current week + previous 4 weeks, with total beds and covid usage
 */
 WITH last_weeks AS (
-    SELECT DISTINCT collection_week AS week
+    SELECT collection_week AS week
     FROM weekly_logs
     WHERE collection_week <= %(week)s
+    UNION
+    SELECT collection_week
+    FROM weekly_logs_archive
+    WHERE collection_week <= %(week)s
     ORDER BY week DESC
     LIMIT 5
 )
@@ -49,46 +76,38 @@ JOIN last_weeks lw ON wl.collection_week = lw.week
 JOIN hospital h ON wl.hospital_pk = h.hospital_pk
 JOIN locations l ON h.zipcode = l.zipcode
 GROUP BY l.state, wl.collection_week
-ORDER BY l.state, wl.collection_week DESC
+UNION ALL
+SELECT
+    wa.state,
+    wa.collection_week,
+    wa.adult_beds_available_avg,
+    wa.adult_beds_occupied_avg,
+    wa.pediatric_beds_available_avg,
+    wa.pediatric_beds_occupied_avg,
+    wa.confirmed_covid_hospitalized_avg
+FROM weekly_logs_archive wa
+JOIN last_weeks lw ON wa.collection_week = lw.week
+ORDER BY state, week DESC
 """
 
 # 3
 beds_fraction_by_quality = """
-WITH latest_quality AS (
-    SELECT DISTINCT ON (hospital_pk)
-        hospital_pk,
-        quality_rating,
-        date_updated
-    FROM hospital_quality
-    ORDER BY hospital_pk, date_updated DESC
-),
-hospital_fraction AS (
+WITH hospital_fraction AS (
     SELECT
         l.state,
         wl.hospital_pk,
         wl.collection_week,
         lq.quality_rating,
         lq.date_updated,
-        wl.adult_beds_occupied_avg
-        / NULLIF(wl.adult_beds_available_avg, 0) AS adult_fraction_used,
-        (
-            wl.pediatric_beds_occupied_avg
-            / NULLIF(wl.pediatric_beds_available_avg, 0)
-        ) AS pediatric_fraction_used,
-        wl.icu_beds_occupied_avg
-        / NULLIF(wl.icu_beds_available_avg, 0) AS icu_fraction_used,
-        (
-            wl.adult_beds_occupied_avg
-            + wl.pediatric_beds_occupied_avg
-            + wl.icu_beds_occupied_avg)
-        / NULLIF(
-            wl.adult_beds_available_avg
-            + wl.pediatric_beds_available_avg
-            + wl.icu_beds_available_avg, 0) AS fraction_used
+        wl.adult_fraction_used,
+        wl.pediatric_fraction_used,
+        wl.icu_fraction_used,
+        wl.fraction_used
     FROM weekly_logs wl
     JOIN hospital h ON wl.hospital_pk = h.hospital_pk
     JOIN locations l ON h.zipcode = l.zipcode
-    JOIN latest_quality lq ON wl.hospital_pk = lq.hospital_pk
+    JOIN hospital_quality_as_of('infinity') lq
+        ON wl.hospital_pk = lq.hospital_pk
     WHERE wl.collection_week = %(week)s
 )
 SELECT
@@ -103,32 +122,29 @@ GROUP BY quality_rating
 ORDER BY quality_rating
 """
 
-# 4
+# 4. Every weekly_logs row has a hospital with a location (foreign keys), so
+# the sums need no joins and are read from weekly_logs_beds_used_idx
 beds_used_over_time = """
 SELECT
     wl.collection_week,
-    SUM(
-        wl.adult_beds_occupied_avg
-        + wl.pediatric_beds_occupied_avg
-        + wl.icu_beds_occupied_avg) AS all,
+    SUM(wl.beds_used) AS all,
     SUM(wl.confirmed_covid_hospitalized_avg) AS covid
 FROM weekly_logs wl
-JOIN hospital h ON wl.hospital_pk = h.hospital_pk
-JOIN locations l ON h.zipcode = l.zipcode
 WHERE wl.collection_week <= %(week)s
 GROUP BY wl.collection_week
-ORDER BY wl.collection_week
+UNION ALL
+SELECT
+    collection_week,
+    SUM(beds_used),
+    SUM(confirmed_covid_hospitalized_avg)
+FROM weekly_logs_archive
+WHERE collection_week <= %(week)s
+GROUP BY collection_week
+ORDER BY collection_week
 """
 
 # 5. A map of average hospital quality by state
 avg_quality_by_state = """
-WITH latest_quality AS (
-    SELECT DISTINCT ON (hospital_pk)
-        hospital_pk,
-        quality_rating
-    FROM hospital_quality
-    ORDER BY hospital_pk, date_updated DESC
-)
 SELECT
     l.state,
     AVG(
@@ -142,40 +158,37 @@ SELECT
     COUNT(*) AS total_hospitals
 FROM hospital h
 JOIN locations l ON l.zipcode = h.zipcode
-JOIN latest_quality lq ON lq.hospital_pk = h.hospital_pk
+JOIN hospital_quality_as_of('infinity') lq
+    ON lq.hospital_pk = h.hospital_pk
 GROUP BY l.state
 ORDER BY avg_quality_rating DESC NULLS LAST
 """
 
-# 6. Covid time series by ownership
+# 6. Covid time series by ownership. Archived weeks count each hospital under
+# the ownership type it had when the week was archived.
 covid_by_ownership = """
-WITH latest_quality AS (
-    SELECT DISTINCT ON (hospital_pk)
-        hospital_pk,
-        type_of_ownership
-    FROM hospital_quality
-    ORDER BY hospital_pk, date_updated DESC
-)
 SELECT
     wl.collection_week,
     lq.type_of_ownership,
     SUM(wl.confirmed_covid_hospitalized_avg) AS covid_cases
 FROM weekly_logs wl
-JOIN latest_quality lq ON wl.hospital_pk = lq.hospital_pk
-WHERE wl.collection_week <= %s
+JOIN hospital_quality_as_of('infinity') lq
+    ON wl.hospital_pk = lq.hospital_pk
+WHERE wl.collection_week <= %(week)s
 GROUP BY wl.collection_week, lq.type_of_ownership
-ORDER BY wl.collection_week, lq.type_of_ownership
+UNION ALL
+SELECT
+    collection_week,
+    type_of_ownership,
+    SUM(confirmed_covid_hospitalized_avg)
+FROM weekly_logs_archive_ownership
+WHERE collection_week <= %(week)s
+GROUP BY collection_week, type_of_ownership
+ORDER BY collection_week, type_of_ownership
 """
 
 # 7. Beds in used by emergency services
 beds_by_emergency_services = """
-WITH latest_quality AS (
-    SELECT DISTINCT ON (hospital_pk)
-        hospital_pk,
-        emergency_services
-    FROM hospital_quality
-    ORDER BY hospital_pk, date_updated DESC
-)
 SELECT
     l.state,
     lq.emergency_services,
@@ -184,10 +197,268 @@ SELECT
     SUM(wl.icu_beds_occupied_avg) AS icu_beds_in_use,
     SUM(wl.confirmed_covid_hospitalized_avg) As covid_beds_in_use
 FROM weekly_logs wl
-JOIN latest_quality lq ON wl.hospital_pk = lq.hospital_pk
+JOIN hospital_quality_as_of('infinity') lq
+    ON wl.hospital_pk = lq.hospital_pk
 JOIN hospital h ON wl.hospital_pk = h.hospital_pk
 JOIN locations l ON h.zipcode = l.zipcode
 WHERE wl.collection_week = %s
 GROUP BY l.state, lq.emergency_services
 ORDER BY l.state, lq.emergency_services DESC;
 """
+
+# 8. Hospital locations for nearest-hospital lookups
+hospital_locations = """
+SELECT
+    h.hospital_pk,
+    h.hospital_name,
+    l.city,
+    l.state,
+    h.latitude,
+    h.longitude
+FROM hospital h
+JOIN locations l ON h.zipcode = l.zipcode
+WHERE h.latitude IS NOT NULL AND h.longitude IS NOT NULL
+"""
+
+icu_capacity_by_hospital = """
+SELECT
+    hospital_pk,
+    icu_beds_available_avg,
+    icu_beds_occupied_avg
+FROM weekly_logs
+WHERE collection_week = %(week)s
+"""
+
+get_ownership_types = """
+SELECT DISTINCT type_of_ownership
+FROM hospital_quality
+WHERE type_of_ownership IS NOT NULL
+ORDER BY type_of_ownership;
+"""
+
+# 9. Hospital drill-down, one page at a time, in one of two orders.
+# Rows are ordered by sort_key, hospital_pk and collection_week, and a page
+# starts after the last row of the previous page (keyset pagination). The
+# cursor and the order are on the columns of a weekly_logs index (the primary
+# key when ordering by hospital, weekly_logs_occupancy_idx when ordering by
+# occupancy), so the index is read from the cursor and the joins and filters
+# run only on the rows read until the page is full. sort_key is 0 when
+# ordering by hospital and the negated occupancy fraction (1 when unknown)
+# when ordering by occupancy.
+hospital_page_by_hospital = """
+SELECT
+    wl.hospital_pk,
+    wl.collection_week,
+    h.hospital_name,
+    l.city,
+    l.state,
+    lq.type_of_ownership,
+    lq.quality_rating,
+    wl.adult_beds_occupied_avg,
+    wl.adult_beds_available_avg,
+    wl.pediatric_beds_occupied_avg,
+    wl.pediatric_beds_available_avg,
+    wl.icu_beds_occupied_avg,
+    wl.icu_beds_available_avg,
+    wl.confirmed_covid_hospitalized_avg,
+    wl.fraction_used,
+    0 AS sort_key
+FROM weekly_logs wl
+JOIN hospital h ON wl.hospital_pk = h.hospital_pk
+JOIN locations l ON h.zipcode = l.zipcode
+LEFT JOIN hospital_quality_as_of('infinity') lq
+    ON lq.hospital_pk = wl.hospital_pk
+WHERE (wl.hospital_pk, wl.collection_week) > (%(after_pk)s, %(after_week)s)
+    AND wl.collection_week BETWEEN %(week_from)s AND %(week_to)s
+    AND (%(state)s::text IS NULL OR l.state = %(state)s)
+    AND (%(ownership)s::text IS NULL OR lq.type_of_ownership = %(ownership)s)
+    AND (%(quality)s::text IS NULL OR lq.quality_rating::text = %(quality)s)
+ORDER BY wl.hospital_pk, wl.collection_week
+LIMIT %(limit)s
+"""
+
+hospital_page_by_occupancy = """
+SELECT
+    wl.hospital_pk,
+    wl.collection_week,
+    h.hospital_name,
+    l.city,
+    l.state,
+    lq.type_of_ownership,
+    lq.quality_rating,
+    wl.adult_beds_occupied_avg,
+    wl.adult_beds_available_avg,
+    wl.pediatric_beds_occupied_avg,
+    wl.pediatric_beds_available_avg,
+    wl.icu_beds_occupied_avg,
+    wl.icu_beds_available_avg,
+    wl.confirmed_covid_hospitalized_avg,
+    wl.fraction_used,
+    -COALESCE(wl.fraction_used, -1) AS sort_key
+FROM weekly_logs wl
+JOIN hospital h ON wl.hospital_pk = h.hospital_pk
+JOIN locations l ON h.zipcode = l.zipcode
+LEFT JOIN hospital_quality_as_of('infinity') lq
+    ON lq.hospital_pk = wl.hospital_pk
+WHERE (-COALESCE(wl.fraction_used, -1), wl.hospital_pk, wl.collection_week)
+    > (%(after_key)s, %(after_pk)s, %(after_week)s)
+    AND wl.collection_week BETWEEN %(week_from)s AND %(week_to)s
+    AND (%(state)s::text IS NULL OR l.state = %(state)s)
+    AND (%(ownership)s::text IS NULL OR lq.type_of_ownership = %(ownership)s)
+    AND (%(quality)s::text IS NULL OR lq.quality_rating::text = %(quality)s)
+ORDER BY -COALESCE(wl.fraction_used, -1), wl.hospital_pk, wl.collection_week
+LIMIT %(limit)s
+"""
+
+# 10. Long-format weekly logs for the report cube, for the given weeks
+weekly_logs_for_weeks = """
+SELECT
+    wl.hospital_pk,
+    l.state,
+    wl.collection_week,
+    wl.adult_beds_available_avg,
+    wl.adult_beds_occupied_avg,
+    wl.pediatric_beds_available_avg,
+    wl.pediatric_beds_occupied_avg,
+    wl.icu_beds_available_avg,
+    wl.icu_beds_occupied_avg,
+    wl.confirmed_covid_hospitalized_avg,
+    wl.confirmed_covid_icu_avg
+FROM weekly_logs wl
+JOIN hospital h ON wl.hospital_pk = h.hospital_pk
+JOIN locations l ON h.zipcode = l.zipcode
+WHERE wl.collection_week = ANY(%(weeks)s)
+"""
+
+# Hospital attributes for the report cube, with each hospital's current
+# quality rating (NULL columns if it has never been rated)
+hospital_attributes = """
+SELECT
+    h.hospital_pk,
+    l.state,
+    lq.hospital_pk IS NOT NULL AS has_quality,
+    lq.quality_rating::text AS quality_rating,
+    lq.type_of_ownership,
+    lq.emergency_services
+FROM hospital h
+JOIN locations l ON h.zipcode = l.zipcode
+LEFT JOIN hospital_quality_as_of('infinity') lq
+    ON lq.hospital_pk = h.hospital_pk
+"""
+
+# Version counters bumped by the loaders, one row per data source
+get_data_version = """
+SELECT source, version
+FROM data_version
+ORDER BY source
+"""
+
+# 11. Approximate mode: history totals estimated from the stratified sample
+# of hospitals in hospital_sample (see sampling.py), with standard errors.
+# A stratum of N hospitals with n sampled adds N / n times its sample total
+# to an estimate, and N^2 (1 - n / N) s^2 / n to its variance, where s^2 is
+# the sample variance of the per-hospital values; sampled hospitals without
+# a value count as zero. The weeks of each sampled hospital are looked up in
+# weekly_logs_hospital_idx, which covers the summed columns, so only the
+# sampled rows are read, with an index-only scan. Archived weeks are added
+# from their exact totals, with a standard error of zero.
+sample_beds_used_over_time = """
+WITH sums AS (
+    SELECT
+        wl.collection_week,
+        s.stratum,
+        CAST(MIN(s.stratum_size) AS FLOAT8) AS big_n,
+        CAST(MIN(s.sample_size) AS FLOAT8) AS n,
+        COALESCE(SUM(wl.beds_used), 0) AS all_sum,
+        COALESCE(SUM(wl.beds_used ^ 2), 0) AS all_sq,
+        COALESCE(SUM(wl.confirmed_covid_hospitalized_avg), 0) AS covid_sum,
+        COALESCE(SUM(wl.confirmed_covid_hospitalized_avg ^ 2), 0) AS covid_sq
+    FROM hospital_sample s
+    CROSS JOIN LATERAL (
+        SELECT collection_week, beds_used, confirmed_covid_hospitalized_avg
+        FROM weekly_logs
+        WHERE hospital_pk = s.hospital_pk
+            AND collection_week <= %(week)s
+    ) wl
+    GROUP BY wl.collection_week, s.stratum
+)
+SELECT
+    collection_week,
+    SUM(big_n / n * all_sum) AS all,
+    SUM(big_n / n * covid_sum) AS covid,
+    SQRT(SUM(CASE WHEN n > 1 THEN
+        big_n ^ 2 * (1 - n / big_n) / n
+        * GREATEST(all_sq - all_sum ^ 2 / n, 0) / (n - 1)
+        ELSE 0 END)) AS all_se,
+    SQRT(SUM(CASE WHEN n > 1 THEN
+        big_n ^ 2 * (1 - n / big_n) / n
+        * GREATEST(covid_sq - covid_sum ^ 2 / n, 0) / (n - 1)
+        ELSE 0 END)) AS covid_se
+FROM sums
+GROUP BY collection_week
+UNION ALL
+SELECT
+    collection_week,
+    SUM(beds_used),
+    SUM(confirmed_covid_hospitalized_avg),
+    0,
+    0
+FROM weekly_logs_archive
+WHERE collection_week <= %(week)s
+GROUP BY collection_week
+ORDER BY collection_week
+"""
+
+sample_covid_by_ownership = """
+WITH sums AS (
+    SELECT
+        wl.collection_week,
+        lq.type_of_ownership,
+        s.stratum,
+        CAST(MIN(s.stratum_size) AS FLOAT8) AS big_n,
+        CAST(MIN(s.sample_size) AS FLOAT8) AS n,
+        COALESCE(SUM(wl.confirmed_covid_hospitalized_avg), 0) AS covid_sum,
+        COALESCE(SUM(wl.confirmed_covid_hospitalized_avg ^ 2), 0) AS covid_sq
+    FROM hospital_sample s
+    JOIN hospital_quality_as_of('infinity') lq
+        ON lq.hospital_pk = s.hospital_pk
+    CROSS JOIN LATERAL (
+        SELECT collection_week, confirmed_covid_hospitalized_avg
+        FROM weekly_logs
+        WHERE hospital_pk = s.hospital_pk
+            AND collection_week <= %(week)s
+    ) wl
+    GROUP BY wl.collection_week, lq.type_of_ownership, s.stratum
+)
+SELECT
+    collection_week,
+    type_of_ownership,
+    SUM(big_n / n * covid_sum) AS covid_cases,
+    SQRT(SUM(CASE WHEN n > 1 THEN
+        big_n ^ 2 * (1 - n / big_n) / n
+        * GREATEST(covid_sq - covid_sum ^ 2 / n, 0) / (n - 1)
+        ELSE 0 END)) AS covid_cases_se
+FROM sums
+GROUP BY collection_week, type_of_ownership
+UNION ALL
+SELECT
+    collection_week,
+    type_of_ownership,
+    SUM(confirmed_covid_hospitalized_avg),
+    0
+FROM weekly_logs_archive_ownership
+WHERE collection_week <= %(week)s
+GROUP BY collection_week, type_of_ownership
+ORDER BY collection_week, type_of_ownership
+"""
+
+# Size of the hospital sample
+sample_summary = """
+SELECT
+    COUNT(*) AS sampled,
+    COUNT(DISTINCT stratum) AS strata,
+    (SELECT COALESCE(SUM(stratum_size), 0) FROM (
+        SELECT DISTINCT stratum, stratum_size FROM hospital_sample
+    ) s) AS hospitals
+FROM hospital_sample
+"""
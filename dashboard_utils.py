@@ -1,14 +1,17 @@
+from datetime import date
 import pandas as pd
-import psycopg
-import credentials
+import dashboard_queries as queries
+import schema
+from utils import get_connection
 
+# Keyset cursor that sorts before every row of the hospital drill-down
+FIRST_PAGE = (float('-inf'), '', date.min)
 
-def get_connection():
-    return psycopg.connect(
-        host="debprodserver.postgres.database.azure.com",
-        dbname=credentials.DB_USER,
-        user=credentials.DB_USER,
-        password=credentials.DB_PASSWORD)
+# Drill-down query of each sort order
+HOSPITAL_PAGE_QUERIES = {
+    "hospital": queries.hospital_page_by_hospital,
+    "occupancy": queries.hospital_page_by_occupancy,
+}
 
 
 def run_query(sql, params):
@@ -16,6 +19,53 @@ def run_query(sql, params):
     try:
         df = pd.read_sql(sql, con=conn, params=params)
     finally:
-        # conn.close()
-        pass
-    return df
+        conn.close()
+    # repeated text as categoricals and measures as float32
+    return schema.compact_frame(df)
+
+
+def fetch_hospital_page(filters, after=FIRST_PAGE, page_size=25):
+    """Fetch one page of the hospital drill-down
+
+    Parameters
+    ----------
+    filters : dict
+        Query parameters `week_from`, `week_to`, `state`, `ownership`,
+        `quality` (None for no filter) and `order_by` ('hospital' or
+        'occupancy')
+    after : tuple, optional
+        Keyset cursor (sort_key, hospital_pk, collection_week) of the last
+        row of the previous page
+    page_size : int, optional
+        Number of rows per page
+
+    Returns
+    -------
+    tuple of (DataFrame, tuple or None)
+        The rows of the page, and the cursor of the next page or None if this
+        is the last page
+    """
+    after_key, after_pk, after_week = after
+    params = dict(filters, after_key=after_key, after_pk=after_pk,
+                  after_week=after_week, limit=page_size + 1)
+    df = run_query(HOSPITAL_PAGE_QUERIES[filters['order_by']], params)
+
+    next_cursor = None
+    if len(df) > page_size:
+        df = df.iloc[:page_size]
+        last = df.iloc[-1]
+        next_cursor = (float(last['sort_key']), last['hospital_pk'],
+                       last['collection_week'])
+    return df.drop(columns=['sort_key']), next_cursor
+
+
+def get_data_version():
+    """Return the current data version counters bumped by the loaders
+
+    Returns
+    -------
+    tuple
+        (source, version) pairs, one per data source
+    """
+    df = run_query(queries.get_data_version, ())
+    return tuple(zip(df['source'], df['version']))
@@ -0,0 +1,139 @@
+# A python module reducing long time series to a target number of points
+import numpy as np
+import pandas as pd
+
+# Points kept per series by default, about one per pixel of a report chart
+DEFAULT_POINTS = 500
+
+
+def _numeric(values):
+    """Chart x values (numbers, dates or datetimes) as float64"""
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float64)
+    return pd.to_datetime(values).to_numpy(dtype='datetime64[ns]').astype(
+        np.int64).astype(np.float64)
+
+
+def lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets downsampling
+
+    Keeps the first and last point, splits the rest into `n_out - 2` buckets
+    and keeps the point of each bucket forming the largest triangle with the
+    point kept before it and the average of the next bucket, which preserves
+    the peaks and troughs a reader would see in the full series
+
+    Parameters
+    ----------
+    x : array-like
+        Increasing x values
+    y : array-like
+        y values without NaN
+    n_out : int
+        Number of points to keep
+
+    Returns
+    -------
+    ndarray
+        Positions of the kept points, in increasing order
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def minmax(y, n_out):
+    """Min/max bucketing
+
+    Splits the series into `n_out // 2` equal buckets and keeps the lowest
+    and highest point of each, plus the first and last point
+
+    Parameters
+    ----------
+    y : array-like
+        y values without NaN
+    n_out : int
+        Approximate number of points to keep
+
+    Returns
+    -------
+    ndarray
+        Positions of the kept points, in increasing order
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    n_buckets = max(n_out // 2, 1)
+    bucket = np.arange(n) * n_buckets // n
+    order = np.lexsort((y, bucket))
+    first = np.r_[0, np.flatnonzero(np.diff(bucket)) + 1]
+    last = np.r_[first[1:] - 1, n - 1]
+    return np.unique(np.r_[order[first], order[last], 0, n - 1])
+
+
+METHODS = {'lttb': lttb, 'minmax': minmax}
+
+
+def downsample_frame(df, x, y, by=None, max_points=DEFAULT_POINTS,
+                     method='lttb'):
+    """Downsample each series of a long-format DataFrame
+
+    Parameters
+    ----------
+    df : DataFrame
+        A Pandas DataFrame with one row per point
+    x : str
+        Name of the x column (numbers, dates or datetimes)
+    y : str
+        Name of the y column. Rows with a missing y are dropped, as they are
+        not drawn by a line chart
+    by : str, optional
+        Name of the column identifying each series
+    max_points : int, optional
+        Points to keep per series; None keeps every point
+    method : str, optional
+        'lttb' or 'minmax'
+
+    Returns
+    -------
+    DataFrame
+        The kept rows, in the order of df
+    """
+    if max_points is None:
+        return df
+    df = df[df[y].notna()].reset_index(drop=True)
+    groups = [df] if by is None else [
+        group for _, group in df.groupby(by, sort=False, dropna=False)
+    ]
+    kept = []
+    for group in groups:
+        if len(group) <= max_points:
+            kept.append(group.index.to_numpy())
+            continue
+        group = group.iloc[np.argsort(_numeric(group[x]), kind='stable')]
+        if method == 'lttb':
+            positions = lttb(_numeric(group[x]), group[y], max_points)
+        else:
+            positions = METHODS[method](group[y], max_points)
+        kept.append(group.index.to_numpy()[positions])
+    if not kept:
+        return df
+    return df.loc[df.index.isin(np.concatenate(kept))]
@@ -0,0 +1,157 @@
+# A python module for spatial lookups over hospital locations
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vectors(latitude, longitude):
+    """Convert latitudes and longitudes to points on the unit sphere
+
+    Parameters
+    ----------
+    latitude : array-like
+        Latitudes in degrees
+    longitude : array-like
+        Longitudes in degrees
+
+    Returns
+    -------
+    ndarray
+        An (n, 3) array of x, y, z coordinates
+    """
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    lon = np.radians(np.asarray(longitude, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack(
+        (cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat))
+    )
+
+
+class HospitalIndex:
+    """A spatial index over hospital locations
+
+    Hospitals are stored as unit vectors, so the great-circle distance to a
+    query point follows from a single dot product. A lookup scans all
+    hospitals with one vectorized matrix-vector product, which takes well
+    under a millisecond for the ~5k hospitals in the database.
+
+    Parameters
+    ----------
+    hospitals : DataFrame
+        A Pandas DataFrame with at least `hospital_pk`, `latitude` and
+        `longitude` columns. Rows without coordinates are dropped
+    """
+
+    def __init__(self, hospitals):
+        hospitals = hospitals.dropna(subset=['latitude', 'longitude'])
+        self.hospitals = hospitals.reset_index(drop=True)
+        self.points = to_unit_vectors(self.hospitals['latitude'],
+                                      self.hospitals['longitude'])
+        self.positions = pd.Series(
+            np.arange(len(self.hospitals)),
+            index=self.hospitals['hospital_pk']
+        )
+
+    def __len__(self):
+        return len(self.hospitals)
+
+    def _distances(self, latitude, longitude):
+        query = to_unit_vectors([latitude], [longitude])[0]
+        cos_angle = np.clip(self.points @ query, -1.0, 1.0)
+        return EARTH_RADIUS_KM * np.arccos(cos_angle)
+
+    def _result(self, positions, distances):
+        result = self.hospitals.iloc[positions].copy()
+        result['distance_km'] = distances[positions]
+        return result.reset_index(drop=True)
+
+    def within(self, latitude, longitude, radius_km):
+        """Find all hospitals within a distance of a point
+
+        Parameters
+        ----------
+        latitude : float
+            Latitude of the query point in degrees
+        longitude : float
+            Longitude of the query point in degrees
+        radius_km : float
+            Search radius in kilometers
+
+        Returns
+        -------
+        DataFrame
+            The matching hospitals with a `distance_km` column, nearest first
+        """
+        distances = self._distances(latitude, longitude)
+        positions = np.flatnonzero(distances <= radius_km)
+        positions = positions[np.argsort(distances[positions], kind='stable')]
+        return self._result(positions, distances)
+
+    def nearest(self, latitude, longitude, k=10, hospital_pks=None):
+        """Find the k hospitals nearest to a point
+
+        Parameters
+        ----------
+        latitude : float
+            Latitude of the query point in degrees
+        longitude : float
+            Longitude of the query point in degrees
+        k : int, optional
+            Number of hospitals to return
+        hospital_pks : array-like, optional
+            Restrict the search to these hospitals
+
+        Returns
+        -------
+        DataFrame
+            Up to k hospitals with a `distance_km` column, nearest first
+        """
+        distances = self._distances(latitude, longitude)
+        if hospital_pks is None:
+            candidates = np.arange(len(distances))
+        else:
+            candidates = self.positions.reindex(hospital_pks).dropna()
+            candidates = candidates.to_numpy(dtype=int)
+        k = min(k, len(candidates))
+        if k == 0:
+            return self._result(candidates, distances)
+        subset = distances[candidates]
+        top = np.argpartition(subset, k - 1)[:k]
+        top = top[np.argsort(subset[top], kind='stable')]
+        return self._result(candidates[top], distances)
+
+
+def nearest_with_icu_capacity(index, icu, latitude, longitude, k=10):
+    """Find the k nearest hospitals with free ICU beds in a given week
+
+    Parameters
+    ----------
+    index : HospitalIndex
+        A spatial index over hospital locations
+    icu : DataFrame
+        A Pandas DataFrame with `hospital_pk`, `icu_beds_available_avg` and
+        `icu_beds_occupied_avg` columns for one week
+    latitude : float
+        Latitude of the query point in degrees
+    longitude : float
+        Longitude of the query point in degrees
+    k : int, optional
+        Number of hospitals to return
+
+    Returns
+    -------
+    DataFrame
+        Up to k hospitals with `distance_km` and `icu_beds_free` columns,
+        nearest first
+    """
+    icu = icu.assign(
+        icu_beds_free=icu['icu_beds_available_avg']
+        - icu['icu_beds_occupied_avg']
+    )
+    icu = icu[icu['icu_beds_free'] > 0]
+    result = index.nearest(latitude, longitude, k,
+                           hospital_pks=icu['hospital_pk'])
+    return result.merge(
+        icu[['hospital_pk', 'icu_beds_free']], on='hospital_pk', how='left'
+    )
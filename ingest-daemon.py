@@ -0,0 +1,61 @@
+# Python script running the watch-folder ingest service
+import argparse
+import threading
+from ingest import IngestService, status_server
+
+parser = argparse.ArgumentParser(
+    description="Load HHS and quality data files as they are dropped into a "
+    "directory")
+parser.add_argument("drop_dir", help="directory to watch for "
+                    "*-hhs-data.csv and Hospital_General_Information-*.csv "
+                    "files")
+parser.add_argument("--poll-interval", type=float, default=1.0,
+                    help="seconds between scans of the drop directory")
+parser.add_argument("--status-port", type=int, default=8765,
+                    help="port of the local status endpoint")
+parser.add_argument("--max-rejects", type=int, default=None,
+                    help="maximum number of skipped rows to write to each "
+                    "error log")
+parser.add_argument("--sample-rejects", type=int, default=1,
+                    help="only write every n-th skipped row of each reason "
+                    "to the error log")
+parser.add_argument("--server-validate", action="store_true",
+                    help="validate weekly_logs rows in the database and "
+                    "record rejects in weekly_logs_rejects")
+parser.add_argument("--skip-report", action="store_true",
+                    help="do not re-render the weekly report snapshots "
+                    "after each load")
+args = parser.parse_args()
+
+
+def main():
+    service = IngestService(args.drop_dir,
+                            server_validate=args.server_validate,
+                            render_report=not args.skip_report,
+                            max_rejects=args.max_rejects,
+                            sample_rejects=args.sample_rejects)
+    server = status_server(service, port=args.status_port)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=service.work, args=(stop,), daemon=True),
+        threading.Thread(target=server.serve_forever, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    print(f"Watching {args.drop_dir}; status at "
+          f"http://127.0.0.1:{args.status_port}/status")
+
+    try:
+        service.watch(stop, args.poll_interval)
+    except KeyboardInterrupt:
+        print("Stopping after the current file.")
+    finally:
+        stop.set()
+        server.shutdown()
+        threads[0].join()
+        if service.conn is not None:
+            service.conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+# A python module holding the watch-folder ingest service
+import fnmatch
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cube
+import loaders
+import snapshots
+from compression import split_compression
+from updateTables import DimensionCache
+from utils import createErrorLog, get_connection
+
+# File name patterns picked up from the drop directory, and their data source
+FILE_PATTERNS = {
+    '*-hhs-data.csv': 'hhs',
+    'Hospital_General_Information-*.csv': 'quality',
+}
+
+
+def file_source(filename):
+    """Return 'hhs' or 'quality' for a data file name, or None
+
+    Compressed files (.gz, .zip, .zst) are matched on their name without the
+    compression suffix, taking `name.zip` as `name.csv`
+    """
+    filename, compression = split_compression(filename)
+    if compression == 'zip' and not filename.lower().endswith('.csv'):
+        filename += '.csv'
+    for pattern, source in FILE_PATTERNS.items():
+        if fnmatch.fnmatch(filename, pattern):
+            return source
+    return None
+
+
+class IngestService:
+    """Load data files dropped into a directory as soon as they arrive
+
+    The service polls the drop directory, queues each new data file once its
+    size stops changing, and loads the queue one file at a time over a
+    persistent database connection. ZIP codes and hospitals are kept in a
+    `DimensionCache` between files, and a warm `cube.ReportCube` re-renders
+    the report snapshots a load made out of date (see
+    `snapshots.render_snapshots`). Loaded files are moved to `processed/`
+    and files that failed to load to `failed/` inside the drop directory.
+
+    Parameters
+    ----------
+    drop_dir : str
+        The directory to watch
+    server_validate : bool, optional
+        Validate weekly_logs rows in the database (see `loaders.load_hhs`)
+    render_report : bool, optional
+        Re-render the report snapshots after each load
+    max_rejects : int, optional
+        Maximum number of skipped rows written to each error log
+    sample_rejects : int, optional
+        Only write every n-th skipped row of each reason to the error log
+    """
+
+    def __init__(self, drop_dir, server_validate=False, render_report=True,
+                 max_rejects=None, sample_rejects=1):
+        self.drop_dir = drop_dir
+        self.server_validate = server_validate
+        self.render_report = render_report
+        self.max_rejects = max_rejects
+        self.sample_rejects = sample_rejects
+
+        self.queue = queue.Queue()
+        self.cache = DimensionCache()
+        self.report = cube.ReportCube() if render_report else None
+        self.conn = None
+        self._sizes = {}
+        self._queued = set()
+
+        self.lock = threading.Lock()
+        self.started_at = datetime.now()
+        self.current = None
+        self.last = None
+        self.loaded_files = 0
+        self.failed_files = 0
+
+    # ---- watching ----
+
+    def scan(self):
+        """Queue the data files in the drop directory whose size is stable
+
+        Returns
+        -------
+        int
+            The number of files queued
+        """
+        sizes = {}
+        with os.scandir(self.drop_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and file_source(entry.name):
+                    sizes[entry.path] = entry.stat().st_size
+        queued = 0
+        for path, size in sorted(sizes.items()):
+            # a file still being copied changes size between two scans
+            if path in self._queued or self._sizes.get(path) != size:
+                continue
+            self._queued.add(path)
+            self.queue.put(path)
+            queued += 1
+        self._sizes = sizes
+        return queued
+
+    def watch(self, stop, poll_interval=1.0):
+        """Scan the drop directory every `poll_interval` seconds until stop"""
+        while not stop.is_set():
+            try:
+                self.scan()
+            except OSError as e:
+                print("Error scanning drop directory:", e)
+            stop.wait(poll_interval)
+
+    # ---- loading ----
+
+    def connection(self):
+        """The persistent database connection, reopened if it was lost"""
+        if self.conn is None or self.conn.closed:
+            self.conn = get_connection()
+            self.cache.clear()
+        return self.conn
+
+    def load_file(self, path):
+        """Load one data file
+
+        Returns
+        -------
+        dict
+            The summary returned by `loaders.load_hhs` or
+            `loaders.load_quality`, with the read statistics of the file
+            under `read`
+        """
+        source = file_source(os.path.basename(path))
+        rejects = createErrorLog(source, max_records=self.max_rejects,
+                                 sample_every=self.sample_rejects)
+        try:
+            if source == 'hhs':
+                data, read_stats = loaders.read_hhs(path)
+                summary = loaders.load_hhs(
+                    self.connection(), data, rejects,
+                    server_validate=self.server_validate, cache=self.cache
+                )
+            else:
+                data, read_stats = loaders.read_quality(path)
+                date_updated = data['date_updated'].iloc[0].date()
+                summary = loaders.load_quality(self.connection(), data,
+                                               date_updated, rejects,
+                                               cache=self.cache)
+        finally:
+            rejects.close()
+        summary["read"] = read_stats
+        return summary
+
+    def refresh_report(self):
+        """Re-render the report snapshots that the load made out of date"""
+        return snapshots.render_snapshots(self.report.refresh())
+
+    def _move(self, path, subdirectory):
+        """Move a file into a subdirectory of the drop directory
+
+        Returns
+        -------
+        str or None
+            The error if the file could not be moved, None otherwise
+        """
+        target = os.path.join(self.drop_dir, subdirectory)
+        try:
+            os.makedirs(target, exist_ok=True)
+            shutil.move(path, os.path.join(target, os.path.basename(path)))
+        except OSError as e:
+            return f"{type(e).__name__}: {e}"
+        return None
+
+    def process(self, path):
+        """Load a queued file, move it aside and record the outcome
+
+        The load is committed or rolled back before the file is moved, so a
+        file that cannot be moved does not change the outcome of its load.
+        It is kept out of the queue instead, so that it is not loaded again.
+        """
+        started = time.perf_counter()
+        with self.lock:
+            self.current = os.path.basename(path)
+        summary, error, move_error = None, None, None
+        try:
+            try:
+                summary = self.load_file(path)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if self.conn is not None and self.conn.broken:
+                    self.conn = None
+            load_seconds = time.perf_counter() - started
+            move_error = self._move(
+                path, 'processed' if error is None else 'failed'
+            )
+
+            render_seconds = None
+            if summary is not None and self.render_report:
+                try:
+                    self.refresh_report()
+                    render_seconds = (time.perf_counter() - started
+                                      - load_seconds)
+                except Exception as e:
+                    print("Error rendering report snapshots:", e)
+
+            with self.lock:
+                if error is None:
+                    self.loaded_files += 1
+                else:
+                    self.failed_files += 1
+                self.last = {
+                    "file": os.path.basename(path),
+                    "finished_at": datetime.now().isoformat(
+                        timespec='seconds'),
+                    "load_seconds": round(load_seconds, 3),
+                    "render_seconds": (None if render_seconds is None
+                                       else round(render_seconds, 3)),
+                    "error": error,
+                    "move_error": move_error,
+                    "summary": summary,
+                }
+        finally:
+            with self.lock:
+                self.current = None
+                if move_error is None:
+                    self._queued.discard(path)
+        outcome = "loaded" if error is None else f"failed ({error})"
+        print(f"{os.path.basename(path)} {outcome} in {load_seconds:.2f}s")
+        if move_error is not None:
+            print(f"Error moving {os.path.basename(path)}:", move_error)
+
+    def work(self, stop):
+        """Load queued files one at a time until stop"""
+        while not stop.is_set():
+            try:
+                path = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.process(path)
+
+    # ---- status ----
+
+    def status(self):
+        """The service status served by the status endpoint"""
+        with self.lock:
+            return {
+                "drop_dir": os.path.abspath(self.drop_dir),
+                "started_at": self.started_at.isoformat(timespec='seconds'),
+                "queue_depth": self.queue.qsize(),
+                "loading": self.current,
+                "loaded_files": self.loaded_files,
+                "failed_files": self.failed_files,
+                "last_load": self.last,
+            }
+
+
+def status_server(service, host='127.0.0.1', port=8765):
+    """Create an HTTP server answering GET /status with the service status
+
+    Parameters
+    ----------
+    service : IngestService
+        The service to report on
+    host : str, optional
+        Address to listen on; local only by default
+    port : int, optional
+        Port to listen on
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The server; call `serve_forever` to start it
+    """
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/status'):
+                self.send_error(404)
+                return
+            body = json.dumps(service.status(), default=str).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), StatusHandler)
@@ -1,44 +1,37 @@
 # Python script to load the hospital quality data set
-import sys
-from utils import (
-    load_data,
-    preprocess_quality,
-    get_connection,
-    parse_emergency,
-    createErrorLog)
-from updateTables import update_hospitals_table, update_locations_table
+import argparse
+from utils import get_connection, createErrorLog
+from loaders import read_quality, load_quality, describe_read
+from snapshots import refresh_snapshots
 from datetime import datetime
 
 # Driver code to load data
 
-cols = [
-    "Facility ID",
-    "Facility Name",
-    "Address",
-    "City",
-    "State",
-    "ZIP Code",
-    "County Name",
-    "Hospital Type",
-    "Hospital Ownership",
-    "Emergency Services",
-    "Hospital overall rating"
-]
-
-date_str = sys.argv[1]
-csv_file = sys.argv[2]
+parser = argparse.ArgumentParser(description="Load a hospital quality file")
+parser.add_argument("date_str", help="date the ratings were updated, "
+                    "YYYY-MM-DD")
+parser.add_argument("filepath", help="path to a "
+                    "Hospital_General_Information-YYYY-MM.csv file, "
+                    "optionally compressed (.gz, .zip or .zst)")
+parser.add_argument("--max-rejects", type=int, default=None,
+                    help="maximum number of skipped rows to write to the "
+                    "error log")
+parser.add_argument("--sample-rejects", type=int, default=1,
+                    help="only write every n-th skipped row of each reason "
+                    "to the error log")
+parser.add_argument("--skip-report", action="store_true",
+                    help="do not re-render the weekly report snapshots "
+                    "after loading")
+args = parser.parse_args()
+
+date_str = args.date_str
+csv_file = args.filepath
 
 try:
-    data = load_data(csv_file, cols)
-    loaded = len(data)
+    data, read_stats = read_quality(csv_file)
 except Exception as e:
     print("Error loading quality data:", e)
 
-try:
-    data = preprocess_quality(data, csv_file)
-except Exception as e:
-    print("Error preprocessing quality data:", e)
-
 try:
     date_updated = datetime.strptime(date_str, "%Y-%m-%d").date()
 except ValueError:
@@ -50,77 +43,50 @@ except ValueError:
 # Driver code to update hospital table if necessary
 
 
+def render_report():
+    """Re-render the report snapshots; the load is already committed"""
+    try:
+        rendered = refresh_snapshots()
+        print(f"Rendered {rendered} weekly report snapshots.")
+    except Exception as e:
+        print("Error rendering report snapshots:", e)
+
+
 def main():
     conn = get_connection()
-    cursor = conn.cursor()
+    rejects = createErrorLog("quality", max_records=args.max_rejects,
+                             sample_every=args.sample_rejects)
 
     try:
-        with conn.transaction():
-            # 1. ---Insert and update locations table---
-            loc_rows, skipped = update_locations_table(cursor, data)
-
-            # 2. ---Insert and update hospital tables---
-            hosp_insert, hosp_update = update_hospitals_table(
-                cursor, data, is_quality_data=True
-            )
-
-            # 3. ---Insert into hospital_quality---
-            quality_rows = []
-            skipped_missing_hospital = 0
-            for _, r in data.iterrows():
-                # Normalize quality rating to ENUM
-                raw_q = str(r['Hospital overall rating']).strip()
-                valid_ratings = {'1', '2', '3', '4', '5'}
-                quality_rating = (
-                    raw_q if raw_q in valid_ratings else "Not Available"
-                )
-
-                hosp_type = r['Hospital Type']
-                ownership = r['Hospital Ownership']
-                emergency = parse_emergency(r["Emergency Services"])
-                hospital_pk = r['hospital_pk']
-
-                quality_rows.append((quality_rating, date_updated, hosp_type,
-                                     ownership, emergency, hospital_pk))
-
-            cursor.executemany(
-                """
-                INSERT INTO hospital_quality (
-                    quality_rating,
-                    date_updated,
-                    type_of_hospital,
-                    type_of_ownership,
-                    emergency_services,
-                    hospital_pk
-                )
-                VALUES (%s, %s, %s, %s, %s, %s);
-                """, quality_rows,
-            )
-
-            createErrorLog(skipped, "quality")
-
-            print("\nSummary:")
-            print(f"Loaded {loaded} rows from the provided .CSV file.")
-            print(f"Inserted {loc_rows} new rows into locations.")
-            print(
-                f"Skipped {len(skipped)} rows due to null city/state/zipcode."
-            )
-            print(f"Inserted {hosp_insert} rows into hospital.")
-            print(f"Updated {hosp_update} rows in hospital.")
-            print(f"Inserted {len(quality_rows)} rows into hospital_quality.\n"
-                  )
-            print(
-                f"Skipped {skipped_missing_hospital} "
-                "rows due to missing hospitals."
-            )
+        summary = load_quality(conn, data, date_updated, rejects)
+
+        print("\nSummary:")
+        print(f"Loaded {summary['loaded']} rows from the provided .CSV file.")
+        print(describe_read(read_stats))
+        print(f"Inserted {summary['locations_inserted']} new rows into "
+              "locations.")
+        print(
+            f"Skipped {summary['locations_skipped']} rows due to null "
+            "city/state/zipcode."
+        )
+        print(f"Inserted {summary['hospitals_inserted']} rows into hospital.")
+        print(f"Updated {summary['hospitals_updated']} rows in hospital.")
+        print(f"Wrote {summary['quality_written']} changed rows to "
+              "hospital_quality.")
+        print(f"Skipped {summary['quality_unchanged']} hospitals with "
+              "unchanged quality attributes.\n")
+
+        # 4. ---Re-render the weekly report snapshots---
+        if not args.skip_report:
+            render_report()
 
     except Exception as e:
         print("Error inserting data", e)
         raise
 
     finally:
+        rejects.close()
         conn.close()
-        cursor.close()
 
 
 if __name__ == "__main__":
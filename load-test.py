@@ -0,0 +1,318 @@
+# Python script load-testing the dashboard queries with concurrent sessions
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+import cube
+import dashboard_queries as queries
+import synthetic
+from dashboard_utils import (FIRST_PAGE, HOSPITAL_PAGE_QUERIES,
+                             fetch_hospital_page, run_query)
+from utils import DSN_VARIABLE, bump_data_version, get_connection
+
+parser = argparse.ArgumentParser(
+    description="Replay the weekly report's database access with concurrent "
+    f"sessions against the database in ${DSN_VARIABLE}")
+parser.add_argument("--sessions", type=int, default=10,
+                    help="number of concurrent simulated sessions")
+parser.add_argument("--duration", type=float, default=30.0,
+                    help="seconds to run the sessions for")
+parser.add_argument("--think-time", type=float, default=0.0,
+                    help="mean seconds a session waits between page views")
+parser.add_argument("--approximate", type=float, default=0.0,
+                    help="fraction of page views in approximate mode")
+parser.add_argument("--pages", type=int, default=3,
+                    help="most drill-down pages a page view pages through")
+parser.add_argument("--load-every", type=float, default=None,
+                    help="bump the hhs data version every number of seconds, "
+                    "as a load does, so the cube and caches are refreshed")
+parser.add_argument("--seed", action="store_true",
+                    help="drop every table and seed the database with "
+                    "synthetic data first")
+parser.add_argument("--hospitals", type=int, default=5000,
+                    help="number of synthetic hospitals to seed")
+parser.add_argument("--weeks", type=int, default=52,
+                    help="number of synthetic collection weeks to seed")
+parser.add_argument("--random-state", type=int, default=0,
+                    help="seed of the synthetic data and session choices")
+parser.add_argument("--json", default=None,
+                    help="also write the results to this JSON file")
+args = parser.parse_args()
+
+# The timed steps of a page view: the queries the report runs, and the cube
+# refresh that answers sections 1-8 from memory (a check of the data version
+# unless a load bumped it, when it re-reads the changed weeks)
+STEPS = [
+    "get_data_version",
+    "cube_refresh",
+    "hospital_locations",
+    "hospital_page_by_hospital",
+    "hospital_page_by_occupancy",
+    "get_weeks",
+    "sample_covid_by_ownership",
+    "sample_beds_used_over_time",
+    "sample_summary",
+]
+
+# Quality ratings offered by the drill-down filter
+QUALITY_RATINGS = ["1", "2", "3", "4", "5", "Not Available"]
+
+# Drill-down page sizes offered by the report
+PAGE_SIZES = [25, 50, 100]
+
+
+class Results:
+    """Latencies and errors recorded by the sessions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.page_views = 0
+
+    def record(self, name, seconds=None):
+        with self.lock:
+            if seconds is None:
+                self.errors[name] += 1
+            else:
+                self.latencies[name].append(seconds)
+
+
+class Server:
+    """State the Streamlit server shares between sessions
+
+    As in weekly-report.py, one data cube answers the report sections, the
+    hospital locations are read once per data version and the sample
+    estimates once per week and data version.
+    """
+
+    def __init__(self):
+        self.report = cube.ReportCube()
+        self.lock = threading.Lock()
+        self.cached = set()
+
+    def first(self, key):
+        """Whether a cache entry is missing, marking it present"""
+        with self.lock:
+            if key in self.cached:
+                return False
+            self.cached.add(key)
+            return True
+
+
+def timed(results, name, function, *params):
+    """Run and time one step of a page view; None if it failed"""
+    start = time.perf_counter()
+    try:
+        value = function(*params)
+    except Exception as e:
+        print(f"{name} failed: {type(e).__name__}: {e}")
+        results.record(name)
+        return None
+    results.record(name, time.perf_counter() - start)
+    return value
+
+
+def drilldown(data, weeks, week, rng, results):
+    """Page through the hospital drill-down with random filters"""
+    order_by = rng.choice(list(HOSPITAL_PAGE_QUERIES))
+    week_from = week
+    if rng.random() < 0.5:
+        # "Include previous 4 weeks"
+        week_from = weeks[min(weeks.index(week) + 4, len(weeks) - 1)]
+    filters = {
+        "week_from": week_from,
+        "week_to": week,
+        "state": rng.choice([None] + data.states()),
+        "ownership": rng.choice([None] + data.ownership_types()),
+        "quality": rng.choice([None] + QUALITY_RATINGS),
+        "order_by": order_by,
+    }
+    page_size = rng.choice(PAGE_SIZES)
+    cursor = FIRST_PAGE
+    for _ in range(rng.randint(1, args.pages)):
+        page = timed(results, f"hospital_page_by_{order_by}",
+                     fetch_hospital_page, filters, cursor, page_size)
+        if page is None or page[1] is None:
+            break
+        cursor = page[1]
+
+
+def page_view(server, weeks, rng, results):
+    """The database access of one view of the report for a random week"""
+    week = rng.choice(weeks)
+    version = timed(results, "get_data_version", run_query,
+                    queries.get_data_version, ())
+    if version is None:
+        return
+    version = tuple(zip(version['source'], version['version']))
+    approximate = rng.random() < args.approximate
+    if approximate and not server.report.refresh_in_background():
+        # drawn from the hospital sample while the cube is refreshed
+        timed(results, "get_weeks", run_query, queries.get_weeks, {})
+        if server.first(("history_estimates", week, version)):
+            for name in ("sample_covid_by_ownership",
+                         "sample_beds_used_over_time"):
+                timed(results, name, run_query, getattr(queries, name),
+                      {"week": week})
+            timed(results, "sample_summary", run_query,
+                  queries.sample_summary, {})
+        return
+    data = timed(results, "cube_refresh", server.report.refresh)
+    if data is None:
+        return
+    if server.first(("hospital_locations", version)):
+        timed(results, "hospital_locations", run_query,
+              queries.hospital_locations, {})
+    drilldown(data, weeks, week, rng, results)
+
+
+def session(server, weeks, deadline, rng, results):
+    """Run page views until the deadline"""
+    while time.perf_counter() < deadline:
+        page_view(server, weeks, rng, results)
+        with results.lock:
+            results.page_views += 1
+        if args.think_time > 0:
+            time.sleep(rng.expovariate(1 / args.think_time))
+
+
+def bump_versions(stop, interval):
+    """Bump the hhs data version every interval, as a load does"""
+    while not stop.wait(interval):
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                bump_data_version(cursor, 'hhs')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def monitor_connections(stop, samples, interval=0.5):
+    """Sample the number of open and active connections to the database"""
+    conn = get_connection()
+    conn.autocommit = True
+    try:
+        while not stop.is_set():
+            row = conn.execute(
+                """
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE state = 'active')
+                FROM pg_stat_activity
+                WHERE datname = current_database()
+                """
+            ).fetchone()
+            # the monitor's own connection is not part of the load
+            samples.append((row[0] - 1, row[1] - 1))
+            stop.wait(interval)
+    finally:
+        conn.close()
+
+
+def summarize(results, samples, elapsed):
+    """Latency percentiles per query, throughput and connection counts"""
+    per_query = {}
+    for name in STEPS:
+        ms = np.array(results.latencies[name]) * 1000
+        per_query[name] = {
+            "count": len(ms),
+            "errors": results.errors[name],
+            "p50_ms": float(np.percentile(ms, 50)) if len(ms) else None,
+            "p95_ms": float(np.percentile(ms, 95)) if len(ms) else None,
+            "p99_ms": float(np.percentile(ms, 99)) if len(ms) else None,
+        }
+    total = sum(q["count"] for q in per_query.values())
+    open_conns = [s[0] for s in samples] or [0]
+    active_conns = [s[1] for s in samples] or [0]
+    return {
+        "sessions": args.sessions,
+        "seconds": elapsed,
+        "page_views": results.page_views,
+        "page_views_per_s": results.page_views / elapsed,
+        "queries_per_s": total / elapsed,
+        "connections_peak": max(open_conns),
+        "connections_mean": float(np.mean(open_conns)),
+        "active_connections_peak": max(active_conns),
+        "queries": per_query,
+    }
+
+
+def print_summary(summary):
+    print(f"{summary['sessions']} sessions for {summary['seconds']:.1f}s: "
+          f"{summary['page_views']} page views "
+          f"({summary['page_views_per_s']:.2f}/s), "
+          f"{summary['queries_per_s']:.1f} queries/s")
+    print(f"Connections: peak {summary['connections_peak']} open "
+          f"({summary['active_connections_peak']} active), "
+          f"mean {summary['connections_mean']:.1f} open")
+    print(f"{'query':<28}{'count':>7}{'errors':>7}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, q in summary["queries"].items():
+        if q["count"]:
+            times = f"{q['p50_ms']:9.1f}{q['p95_ms']:9.1f}{q['p99_ms']:9.1f}"
+        else:
+            times = f"{'-':>9}" * 3
+        print(f"{name:<28}{q['count']:>7}{q['errors']:>7}{times}")
+
+
+def main():
+    if not os.environ.get(DSN_VARIABLE):
+        parser.error(f"set {DSN_VARIABLE} to the connection string of a "
+                     "local test database")
+
+    if args.seed:
+        conn = get_connection()
+        try:
+            synthetic.create_schema(conn)
+            counts = synthetic.seed(conn, args.hospitals, args.weeks,
+                                    args.random_state)
+        finally:
+            conn.close()
+        print("Seeded " + ", ".join(f"{n} {table} rows"
+                                    for table, n in counts.items()))
+
+    weeks = list(run_query(queries.get_weeks, {})['week'])
+    if not weeks:
+        parser.error("the database has no weekly_logs; use --seed")
+
+    results = Results()
+    server = Server()
+    samples = []
+    stop = threading.Event()
+    monitor = threading.Thread(target=monitor_connections,
+                               args=(stop, samples), daemon=True)
+    monitor.start()
+    if args.load_every:
+        threading.Thread(target=bump_versions, args=(stop, args.load_every),
+                         daemon=True).start()
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    sessions = [
+        threading.Thread(target=session, args=(
+            server, weeks, deadline, random.Random(args.random_state + i),
+            results
+        ))
+        for i in range(args.sessions)
+    ]
+    for thread in sessions:
+        thread.start()
+    for thread in sessions:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    monitor.join()
+
+    summary = summarize(results, samples, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+# A python module loading HHS and quality data files into the database,
+# shared by the loading scripts and the ingest service
+from archive import ARCHIVE_DIR, archived_among, restore_week
+from compression import DataSource
+from sampling import refresh_sample
+from schema import HHS_DTYPES, QUALITY_DTYPES
+from utils import (
+    load_data,
+    preprocess_hhs,
+    preprocess_quality,
+    advisory_lock,
+    bump_data_version)
+from updateTables import (
+    update_hospitals_table,
+    update_locations_table,
+    insert_weekly_logs,
+    insert_weekly_logs_validated,
+    insert_hospital_quality)
+
+# Columns of interest in the HHS data
+HHS_COLUMNS = [
+    'hospital_pk', 'state', 'hospital_name', 'address', 'city', 'zip',
+    'fips_code', 'geocoded_hospital_address', 'collection_week',
+    'all_adult_hospital_beds_7_day_avg',
+    'all_pediatric_inpatient_beds_7_day_avg',
+    'all_adult_hospital_inpatient_bed_occupied_7_day_avg',
+    'all_pediatric_inpatient_bed_occupied_7_day_avg',
+    'total_icu_beds_7_day_avg', 'icu_beds_used_7_day_avg',
+    'inpatient_beds_used_covid_7_day_avg',
+    'staffed_icu_adult_patients_confirmed_covid_7_day_avg'
+]
+
+# Columns of interest in the quality data
+QUALITY_COLUMNS = [
+    "Facility ID",
+    "Facility Name",
+    "Address",
+    "City",
+    "State",
+    "ZIP Code",
+    "County Name",
+    "Hospital Type",
+    "Hospital Ownership",
+    "Emergency Services",
+    "Hospital overall rating"
+]
+
+
+def read_hhs(filepath):
+    """Load and pre-process an HHS data file, possibly compressed
+
+    Returns
+    -------
+    tuple of (DataFrame, dict)
+        The pre-processed data, and the read statistics of the file (see
+        `compression.DataSource.stats`)
+    """
+    with DataSource(filepath) as source:
+        data = load_data(source.stream, HHS_COLUMNS, HHS_DTYPES)
+    return preprocess_hhs(data), source.stats()
+
+
+def read_quality(filepath):
+    """Load and pre-process a quality data file, possibly compressed
+
+    The rating date is parsed from the name of the CSV file, which for a
+    .zip file is the name of the file inside it
+
+    Returns
+    -------
+    tuple of (DataFrame, dict)
+        The pre-processed data, and the read statistics of the file (see
+        `compression.DataSource.stats`)
+    """
+    with DataSource(filepath) as source:
+        data = load_data(source.stream, QUALITY_COLUMNS, QUALITY_DTYPES)
+    return preprocess_quality(data, source.name), source.stats()
+
+
+def describe_read(stats):
+    """One-line summary of the read statistics returned by `read_hhs`"""
+    size = stats['bytes'] / 1e6
+    rate = stats['mb_per_s'] or 0
+    total = f"end-to-end read {stats['seconds']:.1f}s with parsing"
+    if stats['compression'] is None:
+        return (f"Read {size:.1f} MB in {stats['wait_seconds']:.1f}s "
+                f"({rate:.0f} MB/s; {total}).")
+    done = (f"Decompressed {stats['compressed_bytes'] / 1e6:.1f} MB of "
+            f"{stats['compression']} to {size:.1f} MB with "
+            f"{stats['decompressor']}")
+    if stats['external']:
+        return (f"{done} alongside the parser, which waited "
+                f"{stats['wait_seconds']:.1f}s for data ({total}).")
+    return (f"{done} in {stats['wait_seconds']:.1f}s ({rate:.0f} MB/s; "
+            f"{total}).")
+
+
+def update_dimensions(conn, data, rejects, is_quality_data, cache=None):
+    """Insert and update the locations and hospitals of a data file
+
+    Each table is updated in its own short transaction holding the table's
+    advisory lock, so concurrent loaders queue for a table only while it is
+    being written, and never hold one table while waiting for the other.
+    Rows are written in key order. A table that changed gets its
+    data_version counter bumped, which tells other loaders' caches to
+    re-read it.
+
+    Parameters
+    ----------
+    conn : psycopg.Connection
+        An open database connection, not inside a transaction
+    data : DataFrame
+        A Pandas DataFrame as returned by `read_hhs` or `read_quality`
+    rejects : utils.RejectLog
+        The reject log of the load
+    is_quality_data : bool
+        Whether `data` is quality data, which has no coordinates or FIPS
+        codes
+    cache : updateTables.DimensionCache, optional
+        ZIP codes and hospitals kept between loads
+
+    Returns
+    -------
+    tuple of int
+        Locations inserted and skipped, hospitals inserted and updated
+    """
+    # 1. ---Insert and update locations table---
+    with conn.transaction(), conn.cursor() as cursor:
+        advisory_lock(cursor, 'locations')
+        if cache is not None:
+            cache.validate(cursor, 'locations')
+        loc_rows, skipped = update_locations_table(cursor, data, rejects,
+                                                   cache)
+        if loc_rows:
+            bump_data_version(cursor, 'locations')
+        if cache is not None:
+            cache.remember_version(cursor, 'locations')
+
+    # 2. ---Insert and update hospital tables---
+    with conn.transaction(), conn.cursor() as cursor:
+        advisory_lock(cursor, 'hospital')
+        if cache is not None:
+            cache.validate(cursor, 'hospital')
+        hosp_insert, hosp_update = update_hospitals_table(
+            cursor, data, is_quality_data=is_quality_data, cache=cache
+        )
+        if hosp_insert or hosp_update:
+            bump_data_version(cursor, 'hospital')
+        if cache is not None:
+            cache.remember_version(cursor, 'hospital')
+
+    return loc_rows, skipped, hosp_insert, hosp_update
+
+
+def load_hhs(conn, data, rejects, server_validate=False, cache=None,
+             archive_dir=ARCHIVE_DIR):
+    """Load pre-processed HHS data into the database
+
+    The locations and hospitals are updated first (see
+    `update_dimensions`). The weekly_logs rows are then inserted in a
+    single transaction holding the advisory lock of each collection week in
+    the file, so the file's rows become visible at once, loads of different
+    weeks run in parallel and loads of the same week queue. Archived weeks
+    of the file are first restored to weekly_logs in the same transaction
+    (see `archive.restore_week`), so their rows are not counted twice. If a
+    load fails after the dimension updates, the locations and hospitals it
+    added stay; loading the file again adds the weekly_logs rows. When
+    hospitals changed, the hospital sample of the approximate report is
+    redrawn last (see `sampling.refresh_sample`).
+
+    Parameters
+    ----------
+    conn : psycopg.Connection
+        An open database connection
+    data : DataFrame
+        A Pandas DataFrame as returned by `read_hhs`
+    rejects : utils.RejectLog
+        The reject log of the load; it is closed before the commit
+    server_validate : bool, optional
+        Validate weekly_logs rows in the database and record rejects in
+        weekly_logs_rejects
+    cache : updateTables.DimensionCache, optional
+        ZIP codes and hospitals kept between loads
+    archive_dir : str, optional
+        The archive directory of archived weeks to restore
+
+    Returns
+    -------
+    dict
+        Row counts of the load: `loaded`, `locations_inserted`,
+        `locations_skipped`, `hospitals_inserted`, `hospitals_updated`,
+        `weekly_logs_inserted`, `weekly_logs_restored` and `rejected`
+        (reason code to count), the collection `weeks` in the data and the
+        `restored_weeks` among them
+    """
+    weeks = sorted(
+        week.date() for week in data['collection_week'].dropna().unique()
+    )
+    try:
+        loc_rows, skipped, hosp_insert, hosp_update = update_dimensions(
+            conn, data, rejects, is_quality_data=False, cache=cache
+        )
+
+        # 3. ---Insert into weekly_logs---
+        with conn.transaction(), conn.cursor() as cursor:
+            for week in weeks:
+                advisory_lock(cursor, f"weekly_logs:{week}")
+            restored_weeks = archived_among(cursor, weeks)
+            restored = sum(restore_week(cursor, week, archive_dir)
+                           for week in restored_weeks)
+            if restored_weeks:
+                bump_data_version(cursor, "archive")
+            if server_validate:
+                inserted, bad_rows = insert_weekly_logs_validated(
+                    cursor, data
+                )
+            else:
+                inserted = insert_weekly_logs(cursor, data, rejects)
+                bad_rows = {
+                    reason: count
+                    for reason, count in rejects.counts.items()
+                    if reason != 'missing_location'
+                }
+
+            bump_data_version(cursor, "hhs")
+            rejects.close()
+
+        # 4. ---Redraw the hospital sample of the approximate report---
+        if hosp_insert or hosp_update:
+            with conn.transaction(), conn.cursor() as cursor:
+                refresh_sample(cursor)
+    except Exception:
+        if cache is not None:
+            cache.clear()
+        raise
+
+    return {
+        "loaded": len(data),
+        "locations_inserted": loc_rows,
+        "locations_skipped": skipped,
+        "hospitals_inserted": hosp_insert,
+        "hospitals_updated": hosp_update,
+        "weekly_logs_inserted": inserted,
+        "weekly_logs_restored": restored,
+        "rejected": bad_rows,
+        "weeks": weeks,
+        "restored_weeks": restored_weeks,
+    }
+
+
+def load_quality(conn, data, date_updated, rejects, cache=None):
+    """Load pre-processed quality data into the database
+
+    The locations and hospitals are updated first (see
+    `update_dimensions`). The hospital_quality versions are then written in
+    a single transaction holding the hospital_quality advisory lock, since
+    each quality file may close versions written by another. HHS loads do
+    not wait for it. When hospitals or ratings changed, the hospital sample
+    of the approximate report is redrawn last (see
+    `sampling.refresh_sample`).
+
+    Parameters
+    ----------
+    conn : psycopg.Connection
+        An open database connection
+    data : DataFrame
+        A Pandas DataFrame as returned by `read_quality`
+    date_updated : date
+        The date the ratings were updated
+    rejects : utils.RejectLog
+        The reject log of the load; it is closed before the commit
+    cache : updateTables.DimensionCache, optional
+        ZIP codes and hospitals kept between loads
+
+    Returns
+    -------
+    dict
+        Row counts of the load: `loaded`, `locations_inserted`,
+        `locations_skipped`, `hospitals_inserted`, `hospitals_updated`,
+        `quality_written` (new or corrected hospital_quality versions) and
+        `quality_unchanged` (hospitals whose attributes did not change)
+    """
+    try:
+        loc_rows, skipped, hosp_insert, hosp_update = update_dimensions(
+            conn, data, rejects, is_quality_data=True, cache=cache
+        )
+
+        # 3. ---Insert into hospital_quality---
+        with conn.transaction(), conn.cursor() as cursor:
+            advisory_lock(cursor, 'hospital_quality')
+            quality_written, quality_unchanged = insert_hospital_quality(
+                cursor, data, date_updated
+            )
+
+            bump_data_version(cursor, "quality")
+            rejects.close()
+
+        # 4. ---Redraw the hospital sample of the approximate report---
+        if hosp_insert or hosp_update or quality_written:
+            with conn.transaction(), conn.cursor() as cursor:
+                refresh_sample(cursor)
+    except Exception:
+        if cache is not None:
+            cache.clear()
+        raise
+
+    return {
+        "loaded": len(data),
+        "locations_inserted": loc_rows,
+        "locations_skipped": skipped,
+        "hospitals_inserted": hosp_insert,
+        "hospitals_updated": hosp_update,
+        "quality_written": quality_written,
+        "quality_unchanged": quality_unchanged,
+    }
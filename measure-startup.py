@@ -0,0 +1,98 @@
+# Python script measuring the cold start of the weekly report
+import argparse
+import subprocess
+import sys
+import time
+
+# Modules imported by weekly-report.py before the first section is drawn
+REPORT_MODULES = ["dashboard_queries", "dashboard_utils", "analytics",
+                  "archive", "cube", "geo", "report_sections", "sampling",
+                  "snapshots"]
+
+# Charting libraries that must only be imported when their section renders
+LAZY_MODULES = ["altair", "plotly"]
+
+parser = argparse.ArgumentParser(
+    description="Measure import time and first paint of the weekly report")
+parser.add_argument("--import-budget-ms", type=float, default=1500,
+                    help="fail if importing the report modules takes longer")
+parser.add_argument("--app", action="store_true",
+                    help="also time a full run of weekly-report.py "
+                         "(needs a database)")
+parser.add_argument("--app-budget-ms", type=float, default=10000,
+                    help="fail if a full run of the report takes longer")
+args = parser.parse_args()
+
+
+def import_times(modules):
+    """Import modules in a fresh interpreter and read back -X importtime
+
+    Parameters
+    ----------
+    modules : list
+        Names of the modules to import
+
+    Returns
+    -------
+    dict
+        Maps each imported module (including indirect imports) to its
+        cumulative import time in milliseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import " + ", ".join(modules)],
+        capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def time_app():
+    """Run weekly-report.py once headless and return the elapsed ms"""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file("weekly-report.py", default_timeout=60)
+    start = time.perf_counter()
+    app.run()
+    elapsed = (time.perf_counter() - start) * 1000
+    if app.exception:
+        raise RuntimeError(f"weekly-report.py failed: {app.exception[0]}")
+    return elapsed
+
+
+def main():
+    failures = []
+
+    times = import_times(REPORT_MODULES)
+    total = sum(times[m] for m in REPORT_MODULES if m in times)
+    print(f"Report modules imported in {total:.0f} ms "
+          f"(budget {args.import_budget_ms:.0f} ms)")
+    for name in sorted(REPORT_MODULES, key=lambda m: -times.get(m, 0)):
+        print(f"  {name:<20} {times.get(name, 0):8.1f} ms")
+    if total > args.import_budget_ms:
+        failures.append("import time over budget")
+    eager = [m for m in LAZY_MODULES if m in times]
+    if eager:
+        failures.append(f"imported at startup: {', '.join(eager)}")
+
+    if args.app:
+        elapsed = time_app()
+        print(f"Full report run in {elapsed:.0f} ms "
+              f"(budget {args.app_budget_ms:.0f} ms)")
+        if elapsed > args.app_budget_ms:
+            failures.append("report run over budget")
+
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+-- Add the data_version counters (see create_database.sql) to an existing
+-- database. The counters start empty; the first load of each source adds
+-- its counter, and the dashboard and API refresh from the current data.
+
+CREATE TABLE data_version (
+    source TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,54 @@
+-- Convert an existing hospital_quality table, holding one row per hospital
+-- per quality file, to change-only versions with valid_to ranges (see
+-- create_database.sql). Run once, inside a transaction.
+
+ALTER TABLE hospital_quality
+    ADD COLUMN valid_to DATE CHECK (valid_to > date_updated);
+
+-- Drop rows whose attributes equal the hospital's previous row
+DELETE FROM hospital_quality hq
+USING (
+    SELECT
+        hospital_pk,
+        date_updated,
+        (quality_rating, type_of_hospital, type_of_ownership,
+         emergency_services)
+        IS NOT DISTINCT FROM
+        LAG((quality_rating, type_of_hospital, type_of_ownership,
+             emergency_services))
+            OVER (PARTITION BY hospital_pk ORDER BY date_updated)
+        AS unchanged
+    FROM hospital_quality
+) prev
+WHERE hq.hospital_pk = prev.hospital_pk
+    AND hq.date_updated = prev.date_updated
+    AND prev.unchanged;
+
+-- Each remaining row is valid until the hospital's next row
+UPDATE hospital_quality hq
+SET valid_to = next.valid_to
+FROM (
+    SELECT
+        hospital_pk,
+        date_updated,
+        LEAD(date_updated)
+            OVER (PARTITION BY hospital_pk ORDER BY date_updated)
+        AS valid_to
+    FROM hospital_quality
+) next
+WHERE hq.hospital_pk = next.hospital_pk
+    AND hq.date_updated = next.date_updated
+    AND next.valid_to IS NOT NULL;
+
+CREATE UNIQUE INDEX hospital_quality_current_idx
+    ON hospital_quality (hospital_pk) WHERE valid_to IS NULL;
+
+CREATE FUNCTION hospital_quality_as_of(as_of DATE)
+RETURNS SETOF hospital_quality
+LANGUAGE sql STABLE
+AS $$
+    SELECT *
+    FROM hospital_quality
+    WHERE date_updated <= as_of
+        AND (valid_to IS NULL OR valid_to > as_of)
+$$;
@@ -0,0 +1,15 @@
+-- Add the hospital sample of the approximate report mode (see
+-- create_database.sql) to an existing database. Draw the sample afterwards
+-- with `python refresh-sample.py`; the loaders redraw it from then on.
+
+CREATE INDEX weekly_logs_hospital_idx
+    ON weekly_logs (hospital_pk, collection_week)
+    INCLUDE (beds_used, confirmed_covid_hospitalized_avg);
+
+CREATE TABLE hospital_sample (
+    hospital_pk TEXT PRIMARY KEY REFERENCES hospital(hospital_pk),
+    stratum TEXT NOT NULL,
+    stratum_size INTEGER NOT NULL CHECK (stratum_size > 0),
+    sample_size INTEGER NOT NULL
+        CHECK (sample_size > 0 AND sample_size <= stratum_size)
+);
@@ -0,0 +1,21 @@
+-- Add the per-state totals of archived weeks (see create_database.sql) to an
+-- existing database. The history queries of the report read this table, so
+-- it is needed even before the first run of archive-weeks.py; run
+-- migrate_weekly_logs_archive_ownership.sql as well.
+
+CREATE TABLE weekly_logs_archive (
+    collection_week DATE NOT NULL,
+    state TEXT NOT NULL,
+    records INTEGER NOT NULL,
+    adult_beds_available_avg FLOAT8,
+    adult_beds_occupied_avg FLOAT8,
+    pediatric_beds_available_avg FLOAT8,
+    pediatric_beds_occupied_avg FLOAT8,
+    icu_beds_available_avg FLOAT8,
+    icu_beds_occupied_avg FLOAT8,
+    confirmed_covid_hospitalized_avg FLOAT8,
+    confirmed_covid_icu_avg FLOAT8,
+    beds_used FLOAT8,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (collection_week, state)
+);
@@ -0,0 +1,14 @@
+-- Add the per-ownership totals of archived weeks (see create_database.sql)
+-- to an existing database. Fill them in for the weeks already archived with
+-- one run of `python archive-weeks.py`, which adds the missing totals from
+-- the archive files before archiving anything.
+
+CREATE TABLE weekly_logs_archive_ownership (
+    collection_week DATE NOT NULL,
+    type_of_ownership TEXT,
+    records INTEGER NOT NULL,
+    confirmed_covid_hospitalized_avg FLOAT8
+);
+
+CREATE INDEX weekly_logs_archive_ownership_week_idx
+    ON weekly_logs_archive_ownership (collection_week);
@@ -0,0 +1,6 @@
+-- Add the index ordering the hospital drill-down by occupancy (see
+-- create_database.sql) to an existing database. CONCURRENTLY keeps loads
+-- running while it is built, so run this outside of a transaction block.
+
+CREATE INDEX CONCURRENTLY weekly_logs_occupancy_idx ON weekly_logs (
+    (-COALESCE(fraction_used, -1)), hospital_pk, collection_week);
@@ -0,0 +1,30 @@
+-- Add the generated occupancy columns of weekly_logs (see
+-- create_database.sql) to an existing database. Adding stored generated
+-- columns rewrites the table, so run this outside of loading hours, and not
+-- inside a transaction block (VACUUM cannot run in one).
+
+ALTER TABLE weekly_logs
+    ADD COLUMN beds_used FLOAT8 GENERATED ALWAYS AS (
+        adult_beds_occupied_avg + pediatric_beds_occupied_avg
+        + icu_beds_occupied_avg) STORED,
+    ADD COLUMN beds_available FLOAT8 GENERATED ALWAYS AS (
+        adult_beds_available_avg + pediatric_beds_available_avg
+        + icu_beds_available_avg) STORED,
+    ADD COLUMN adult_fraction_used FLOAT8 GENERATED ALWAYS AS (
+        adult_beds_occupied_avg
+        / NULLIF(adult_beds_available_avg, 0)) STORED,
+    ADD COLUMN pediatric_fraction_used FLOAT8 GENERATED ALWAYS AS (
+        pediatric_beds_occupied_avg
+        / NULLIF(pediatric_beds_available_avg, 0)) STORED,
+    ADD COLUMN icu_fraction_used FLOAT8 GENERATED ALWAYS AS (
+        icu_beds_occupied_avg / NULLIF(icu_beds_available_avg, 0)) STORED,
+    ADD COLUMN fraction_used FLOAT8 GENERATED ALWAYS AS (
+        (adult_beds_occupied_avg + pediatric_beds_occupied_avg
+         + icu_beds_occupied_avg)
+        / NULLIF(adult_beds_available_avg + pediatric_beds_available_avg
+                 + icu_beds_available_avg, 0)) STORED;
+
+CREATE INDEX weekly_logs_beds_used_idx ON weekly_logs (collection_week)
+    INCLUDE (beds_used, confirmed_covid_hospitalized_avg);
+
+VACUUM ANALYZE weekly_logs;
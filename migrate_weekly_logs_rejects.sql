@@ -0,0 +1,19 @@
+-- Add the table of rows rejected by the server-side validation mode of
+-- load-hhs.py (see create_database.sql) to an existing database.
+
+CREATE TABLE weekly_logs_rejects (
+    reject_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    rejected_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    source_row INTEGER,
+    reason TEXT NOT NULL,
+    collection_week DATE,
+    adult_beds_available_avg FLOAT8,
+    pediatric_beds_available_avg FLOAT8,
+    adult_beds_occupied_avg FLOAT8,
+    pediatric_beds_occupied_avg FLOAT8,
+    icu_beds_available_avg FLOAT8,
+    icu_beds_occupied_avg FLOAT8,
+    confirmed_covid_hospitalized_avg FLOAT8,
+    confirmed_covid_icu_avg FLOAT8,
+    hospital_pk TEXT
+);
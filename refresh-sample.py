@@ -0,0 +1,23 @@
+# Python script redrawing the hospital sample of the approximate report mode
+import argparse
+from sampling import refresh_sample
+from utils import get_connection
+
+parser = argparse.ArgumentParser(
+    description="Redraw the stratified sample of hospitals used by the "
+    "approximate mode of the weekly report")
+args = parser.parse_args()
+
+
+def main():
+    conn = get_connection()
+    try:
+        with conn.transaction(), conn.cursor() as cursor:
+            sampled = refresh_sample(cursor)
+    finally:
+        conn.close()
+    print(f"Sampled {sampled} hospitals.")
+
+
+if __name__ == "__main__":
+    main()
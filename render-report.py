@@ -0,0 +1,24 @@
+# Python script to pre-render snapshots of the weekly report
+import argparse
+import time
+from snapshots import refresh_snapshots, SNAPSHOT_DIR
+
+parser = argparse.ArgumentParser(
+    description="Render JSON and HTML snapshots of the weekly report")
+parser.add_argument("--weeks", type=int, default=None,
+                    help="only render the latest number of weeks")
+parser.add_argument("--output-dir", default=SNAPSHOT_DIR,
+                    help="directory the snapshots are written to")
+args = parser.parse_args()
+
+
+def main():
+    start = time.perf_counter()
+    rendered = refresh_snapshots(args.weeks, args.output_dir)
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {rendered} weekly report snapshots to {args.output_dir} "
+          f"in {elapsed:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+# A python module building the tables and charts of the weekly report.
+# altair and plotly are imported by the sections that draw with them, so
+# importing this module (and starting the report) does not pay for them.
+import hashlib
+import json
+import pandas as pd
+import analytics
+import downsample
+
+# Report sections in page order, with their titles
+SECTIONS = {
+    'weekly_counts': "Number of Weekly Logs from Each Week",
+    'beds_summary':
+        "Adult & Pediatric & COVID Beds: Current vs Previous 4 Weeks",
+    'covid_by_ownership':
+        "COVID Cases by Type of Hospital Ownership Per Week Over Time",
+    'beds_by_quality': "Proportion of Beds in Use by Hospital Quality",
+    'beds_over_time': "Total Hospital Beds Used Per Week Over Time",
+    'quality_map': "Hospital Quality Ratings Across the US",
+    'beds_by_emergency': "Beds in Use by Emergency Services (Selected Week)",
+}
+
+# Sections whose line charts are downsampled before serialization
+TIME_SERIES = ('covid_by_ownership', 'beds_over_time')
+
+# Sections drawn from sample estimates in the approximate mode, until the
+# exact results are ready (see sampling.py)
+APPROXIMATE = ('covid_by_ownership', 'beds_over_time')
+
+# Sections that show the same content whatever week is selected
+WEEK_INDEPENDENT = ('weekly_counts', 'quality_map')
+
+# Weekly logs each section reads: 'all' weeks, the weeks 'up_to' the
+# selected one, or only the selected 'week'. The quality map reads none.
+SECTION_WEEKS = {
+    'weekly_counts': 'all',
+    'beds_summary': 'up_to',
+    'covid_by_ownership': 'up_to',
+    'beds_by_quality': 'week',
+    'beds_over_time': 'up_to',
+    'beds_by_emergency': 'week',
+}
+
+# data_version sources of the hospital attributes (state, ownership,
+# emergency services and quality rating) each section reads; the other
+# sections read only the weekly logs
+ATTRIBUTE_SOURCES = ('quality', 'hospital', 'locations')
+SECTION_SOURCES = {
+    'beds_summary': ('hospital', 'locations'),
+    'covid_by_ownership': ATTRIBUTE_SOURCES,
+    'beds_by_quality': ATTRIBUTE_SOURCES,
+    'quality_map': ATTRIBUTE_SOURCES,
+    'beds_by_emergency': ATTRIBUTE_SOURCES,
+}
+
+
+def _weeks_to_datetime(df, column):
+    """Copy of df with a week column as datetimes, for temporal chart axes"""
+    df = df.copy()
+    df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def weekly_counts(data, week):
+    """Section #1: records loaded per week"""
+    return {"table": data.weekly_records_summary()}
+
+
+def beds_summary(data, week, trends=None):
+    """Section #2: state bed totals with week-over-week trend columns"""
+    if trends is None:
+        trends = analytics.state_metrics(data.matrix)
+    beds_df = data.bed_summary_5_weeks(week).merge(
+        trends[["state", "week", "beds_used_wow", "beds_used_4wk_avg",
+                "fraction_used_z"]],
+        on=["state", "week"],
+        how="left",
+    )
+    return {"table": beds_df}
+
+
+def covid_by_ownership(data, week, max_points=downsample.DEFAULT_POINTS):
+    """Section #3: COVID patients per week by ownership type"""
+    import altair as alt
+
+    covid_over_time = data.covid_by_ownership(week)
+    plot_df = downsample.downsample_frame(
+        covid_over_time, "collection_week", "covid_cases",
+        by="type_of_ownership", max_points=max_points
+    )
+    chart = alt.Chart(
+        _weeks_to_datetime(plot_df, "collection_week")
+    ).mark_line().encode(
+        x=alt.X("collection_week:T", title="Week"),
+        y=alt.Y("covid_cases:Q",
+                title="Number of hospitalized patients with confirmed COVID"),
+        color=alt.Color("type_of_ownership:N"),
+    ).interactive(bind_y=False)
+    return {"table": covid_over_time, "vega": chart.to_dict()}
+
+
+def beds_by_quality(data, week):
+    """Section #4: fraction of beds used by quality rating and bed type"""
+    import altair as alt
+
+    beds_by_quality = data.beds_fraction_by_quality(week)
+
+    plot3_df = beds_by_quality.melt(
+        id_vars="quality_rating",
+        value_vars=["adult",
+                    "pediatric",
+                    "icu",
+                    "total"],
+        var_name="bed_type",
+        value_name="avg_fraction_used",
+    )
+
+    chart3 = alt.Chart(plot3_df).mark_bar().encode(
+        x=alt.X('quality_rating', title="Hospital Quality Rating"),
+        xOffset="bed_type",  # ensures bars appear side by side
+        y=alt.Y('avg_fraction_used', title="Fraction of Beds Used"),
+        color=alt.Color('bed_type', title="Bed Type")
+    )
+    return {"vega": chart3.to_dict()}
+
+
+def beds_over_time(data, week, max_points=downsample.DEFAULT_POINTS):
+    """Section #5: total and COVID beds used per week"""
+    import altair as alt
+
+    beds_over_time = data.beds_used_over_time(week)
+
+    plot4_df = beds_over_time.melt(
+        id_vars="collection_week",
+        value_vars=["all",
+                    "covid"],
+        var_name="Bed Type",
+        value_name="beds_used",
+    )
+    plot4_df = downsample.downsample_frame(
+        plot4_df, "collection_week", "beds_used", by="Bed Type",
+        max_points=max_points
+    )
+
+    chart = alt.Chart(
+        _weeks_to_datetime(plot4_df, "collection_week")
+    ).mark_line().encode(
+        x=alt.X("collection_week:T", title="Week"),
+        y=alt.Y("beds_used:Q", title="Number of Beds Used"),
+        color=alt.Color("Bed Type:N"),
+    ).interactive(bind_y=False)
+    return {"vega": chart.to_dict()}
+
+
+def quality_map(data, week):
+    """Section #6: map of average quality rating by state"""
+    import plotly.express as px
+
+    state_quality = data.avg_quality_by_state()
+
+    plot5 = px.choropleth(
+        state_quality,
+        locations='state',
+        locationmode="USA-states",
+        color='avg_quality_rating',
+        scope="usa",
+        color_continuous_scale="Viridis"
+    )
+
+    plot5.update_layout(coloraxis_colorbar=dict(
+        title="Average Quality Rating"
+    ))
+    return {"plotly": json.loads(plot5.to_json())}
+
+
+def beds_by_emergency(data, week):
+    """Section #7: beds in use by state and emergency services"""
+    import altair as alt
+
+    beds_es_df = data.beds_by_emergency_services(week)
+    beds_es_df["emergency_group"] = beds_es_df["emergency_services"].replace({
+        True: "Yes",
+        False: "No"
+    })
+    beds_es_df = beds_es_df.drop(columns=["emergency_services"])
+
+    agg = (beds_es_df.groupby("emergency_group", as_index=False)[[
+        "adult_beds_in_use", "pediatric_beds_in_use", "icu_beds_in_use",
+    ]].sum())
+
+    # Long format for Altair
+    plot_df = agg.melt(
+        id_vars="emergency_group",
+        value_vars=["adult_beds_in_use",
+                    "pediatric_beds_in_use",
+                    "icu_beds_in_use",],
+        var_name="bed_type",
+        value_name="beds_in_use",
+    )
+    plot_df["bed_type"] = plot_df["bed_type"].map({
+        "adult_beds_in_use": "Adult",
+        "pediatric_beds_in_use": "Pediatric",
+        "icu_beds_in_use": "ICU",
+    })
+
+    # Grouped bar chart
+    chart = (
+        alt.Chart(plot_df)
+        .mark_bar()
+        .encode(
+            x=alt.X("emergency_group:N", title="Emergency Services"),
+            xOffset="bed_type:N",  # ensures bars appear side by side
+            y=alt.Y("beds_in_use:Q", title="Beds in Use"),
+            color=alt.Color("bed_type:N", title="Bed Type"),
+            tooltip=[
+                "emergency_group:N",
+                "bed_type:N",
+                alt.Tooltip("beds_in_use:Q", title="Beds in Use", format=","),
+            ],
+        )
+        .properties(height=350)
+    )
+    return {"table": beds_es_df, "vega": chart.to_dict()}
+
+
+def section_key(name, week, data):
+    """The inputs a built section depends on, as cache and snapshot keys
+
+    Loads only add rows to a week, so the weekly logs a section reads are
+    keyed by the record counts of the weeks in `SECTION_WEEKS`, as the cube
+    does when it refreshes, rather than by the hhs counter. A load then
+    changes the key of the sections reading the weeks it loaded, and of the
+    records-per-week table.
+
+    Parameters
+    ----------
+    name : str
+        A key of `SECTIONS`
+    week : date
+        The selected collection week
+    data : cube.CubeSnapshot
+        The data cube snapshot the section is built from
+
+    Returns
+    -------
+    tuple of (date or None, tuple, str or None)
+        The week, or None for `WEEK_INDEPENDENT` sections; the counters of
+        the `SECTION_SOURCES` the section reads; and a digest of the record
+        counts of the weeks it reads, or None if it reads none
+    """
+    sources = SECTION_SOURCES.get(name, ())
+    version = tuple(
+        (source, v) for source, v in data.version if source in sources
+    )
+    read = SECTION_WEEKS.get(name)
+    counts = None
+    if read is not None:
+        counts = [
+            (str(w), n) for w, n in data.record_counts()
+            if read == 'all' or w == week or (read == 'up_to' and w < week)
+        ]
+        counts = hashlib.sha1(json.dumps(counts).encode()).hexdigest()
+    if name in WEEK_INDEPENDENT:
+        week = None
+    return week, version, counts
+
+
+def _estimate_chart(df, by, y_title):
+    """Line chart of weekly estimates with bands of their intervals
+
+    `df` has `collection_week`, the `by` series, the `estimate` and its
+    `low` and `high` confidence bounds
+    """
+    import altair as alt
+
+    base = alt.Chart(
+        _weeks_to_datetime(df, "collection_week")
+    ).encode(
+        x=alt.X("collection_week:T", title="Week"),
+        color=alt.Color(f"{by}:N"),
+    )
+    band = base.mark_area(opacity=0.2).encode(
+        y=alt.Y("low:Q", title=y_title), y2="high:Q"
+    )
+    line = base.mark_line().encode(y="estimate:Q")
+    return (band + line).interactive(bind_y=False)
+
+
+def covid_by_ownership_estimate(estimates,
+                                max_points=downsample.DEFAULT_POINTS):
+    """Section #3 from sample estimates, with 95% confidence bands"""
+    table = estimates[["collection_week", "type_of_ownership", "covid_cases",
+                       "covid_cases_low", "covid_cases_high"]]
+    plot_df = downsample.downsample_frame(
+        table, "collection_week", "covid_cases", by="type_of_ownership",
+        max_points=max_points
+    ).rename(columns={"covid_cases": "estimate", "covid_cases_low": "low",
+                      "covid_cases_high": "high"})
+    chart = _estimate_chart(
+        plot_df, "type_of_ownership",
+        "Estimated number of hospitalized patients with confirmed COVID"
+    )
+    return {"table": table, "vega": chart.to_dict()}
+
+
+def beds_over_time_estimate(estimates, max_points=downsample.DEFAULT_POINTS):
+    """Section #5 from sample estimates, with 95% confidence bands"""
+    plot_df = pd.concat([
+        pd.DataFrame({
+            "collection_week": estimates["collection_week"],
+            "Bed Type": bed_type,
+            "estimate": estimates[bed_type],
+            "low": estimates[bed_type + "_low"],
+            "high": estimates[bed_type + "_high"],
+        })
+        for bed_type in ["all", "covid"]
+    ], ignore_index=True)
+    plot_df = downsample.downsample_frame(
+        plot_df, "collection_week", "estimate", by="Bed Type",
+        max_points=max_points
+    )
+    chart = _estimate_chart(plot_df, "Bed Type",
+                            "Estimated number of beds used")
+    return {"vega": chart.to_dict()}
+
+
+def build_estimate(name, estimates, max_points=downsample.DEFAULT_POINTS):
+    """Build an `APPROXIMATE` section from `sampling.history_estimates`
+
+    Parameters
+    ----------
+    name : str
+        A name in `APPROXIMATE`
+    estimates : dict
+        The output of `sampling.history_estimates`
+    max_points : int, optional
+        Points kept per series; None draws every point
+
+    Returns
+    -------
+    dict
+        A dictionary with an optional "table" DataFrame and "vega" spec
+    """
+    builders = {
+        'covid_by_ownership': covid_by_ownership_estimate,
+        'beds_over_time': beds_over_time_estimate,
+    }
+    return builders[name](estimates[name], max_points)
+
+
+def build_section(name, data, week, trends=None,
+                  max_points=downsample.DEFAULT_POINTS):
+    """Build one section of the weekly report
+
+    Parameters
+    ----------
+    name : str
+        A key of `SECTIONS`
+    data : cube.CubeSnapshot
+        The data cube snapshot answering the report queries
+    week : date
+        The selected collection week
+    trends : DataFrame, optional
+        Precomputed `analytics.state_metrics` output
+    max_points : int, optional
+        Points kept per series of the `TIME_SERIES` line charts; None draws
+        every point
+
+    Returns
+    -------
+    dict
+        A dictionary with an optional "table" DataFrame, "vega" Vega-Lite
+        spec and "plotly" figure dict
+    """
+    if name == 'beds_summary':
+        return beds_summary(data, week, trends)
+    if name in TIME_SERIES:
+        return BUILDERS[name](data, week, max_points)
+    return BUILDERS[name](data, week)
+
+
+def build_sections(data, week, trends=None):
+    """Build every section of the weekly report for one week
+
+    Parameters
+    ----------
+    data : cube.CubeSnapshot
+        The data cube snapshot answering the report queries
+    week : date
+        The selected collection week
+    trends : DataFrame, optional
+        Precomputed `analytics.state_metrics` output
+
+    Returns
+    -------
+    dict
+        Maps each name in `SECTIONS` to the output of `build_section`
+    """
+    return {name: build_section(name, data, week, trends)
+            for name in SECTIONS}
+
+
+BUILDERS = {
+    'weekly_counts': weekly_counts,
+    'beds_summary': beds_summary,
+    'covid_by_ownership': covid_by_ownership,
+    'beds_by_quality': beds_by_quality,
+    'beds_over_time': beds_over_time,
+    'quality_map': quality_map,
+    'beds_by_emergency': beds_by_emergency,
+}
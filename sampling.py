@@ -0,0 +1,141 @@
+# A python module maintaining a stratified sample of hospitals, from which
+# the approximate mode of the weekly report estimates the history charts with
+# confidence intervals while the exact results are computed
+import dashboard_queries as queries
+import dashboard_utils as utils
+from utils import advisory_lock
+
+# Fraction of the hospitals of each stratum kept in the sample
+SAMPLE_FRACTION = 0.1
+
+# Hospitals kept in a stratum of at least this size, so that each stratum
+# has a sample variance
+MIN_PER_STRATUM = 2
+
+# Normal quantile of a two-sided 95% confidence interval
+Z_95 = 1.959964
+
+# Sample draw: strata are states crossed with current quality ratings, and
+# each stratum keeps the hospitals whose hashed hospital_pk ranks first, so a
+# hospital stays sampled as long as its stratum does not change
+REFRESH_SAMPLE = """
+INSERT INTO hospital_sample (hospital_pk, stratum, stratum_size, sample_size)
+WITH strata AS (
+    SELECT
+        h.hospital_pk,
+        l.state || ':' || COALESCE(CAST(q.quality_rating AS TEXT), 'unrated')
+            AS stratum
+    FROM hospital h
+    JOIN locations l ON l.zipcode = h.zipcode
+    LEFT JOIN hospital_quality_as_of('infinity') q
+        ON q.hospital_pk = h.hospital_pk
+),
+ranked AS (
+    SELECT
+        hospital_pk,
+        stratum,
+        COUNT(*) OVER (PARTITION BY stratum) AS stratum_size,
+        ROW_NUMBER() OVER (
+            PARTITION BY stratum ORDER BY md5(hospital_pk || %(seed)s)
+        ) AS draw_rank
+    FROM strata
+),
+sized AS (
+    SELECT
+        *,
+        LEAST(stratum_size, GREATEST(%(min_per_stratum)s,
+                                     CEIL(stratum_size * %(fraction)s)))
+            AS sample_size
+    FROM ranked
+)
+SELECT hospital_pk, stratum, stratum_size, sample_size
+FROM sized
+WHERE draw_rank <= sample_size
+"""
+
+
+def refresh_sample(cursor, fraction=SAMPLE_FRACTION, seed='prancer'):
+    """Redraw the hospital sample from the current hospitals and ratings
+
+    The loaders call this after adding hospitals or quality versions, so
+    that the strata sizes match the hospital table
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor, inside a transaction
+    fraction : float, optional
+        Fraction of the hospitals of each stratum to sample
+    seed : str, optional
+        Salt of the hash that orders the hospitals of a stratum
+
+    Returns
+    -------
+    int
+        The number of sampled hospitals
+    """
+    advisory_lock(cursor, 'hospital_sample')
+    cursor.execute("DELETE FROM hospital_sample")
+    cursor.execute(REFRESH_SAMPLE, {
+        "seed": seed, "fraction": fraction,
+        "min_per_stratum": MIN_PER_STRATUM,
+    })
+    return cursor.rowcount
+
+
+def add_intervals(df, columns, z=Z_95):
+    """Add confidence bounds to estimates with standard errors
+
+    Parameters
+    ----------
+    df : DataFrame
+        Estimates with a `<column>_se` standard error per estimated column
+    columns : list of str
+        The estimated columns
+    z : float, optional
+        Normal quantile of the interval; 95% by default
+
+    Returns
+    -------
+    DataFrame
+        The same frame with `<column>_low` and `<column>_high` columns; the
+        lower bound of a total is never below zero
+    """
+    df = df.copy()
+    for column in columns:
+        estimate = df[column].astype('float64')
+        half_width = z * df[column + '_se'].astype('float64')
+        df[column + '_low'] = (estimate - half_width).clip(lower=0)
+        df[column + '_high'] = estimate + half_width
+    return df
+
+
+def history_estimates(week):
+    """Estimate the history charts of the report from the hospital sample
+
+    Parameters
+    ----------
+    week : date
+        The selected collection week
+
+    Returns
+    -------
+    dict
+        'covid_by_ownership' and 'beds_over_time': the columns of the exact
+        queries, with `_se`, `_low` and `_high` columns per estimate;
+        'sample': the numbers of `sampled` hospitals, `hospitals` and
+        `strata`
+    """
+    covid = utils.run_query(queries.sample_covid_by_ownership,
+                            {"week": week})
+    beds = utils.run_query(queries.sample_beds_used_over_time,
+                           {"week": week})
+    sample = utils.run_query(queries.sample_summary, {})
+    return {
+        "covid_by_ownership": add_intervals(covid, ["covid_cases"]),
+        "beds_over_time": add_intervals(beds, ["all", "covid"]),
+        "sample": {
+            name: int(sample[name].iloc[0])
+            for name in ("sampled", "hospitals", "strata")
+        },
+    }
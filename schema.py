@@ -0,0 +1,152 @@
+# A python module defining compact column types for loaded and queried data.
+# Repeated text is stored as categoricals, other text as Arrow strings and
+# numbers as nullable or float32 arrays, instead of Python objects per cell.
+import numpy as np
+import pandas as pd
+import analytics
+
+# Value the HHS data uses for suppressed or missing numbers
+HHS_MISSING = -999999
+
+# HHS bed averages. The loaders keep them as nullable float64 so values reach
+# the database exactly as published; the dashboard holds them as float32.
+HHS_FLOAT_COLUMNS = [
+    'all_adult_hospital_beds_7_day_avg',
+    'all_pediatric_inpatient_beds_7_day_avg',
+    'all_adult_hospital_inpatient_bed_occupied_7_day_avg',
+    'all_pediatric_inpatient_bed_occupied_7_day_avg',
+    'total_icu_beds_7_day_avg',
+    'icu_beds_used_7_day_avg',
+    'inpatient_beds_used_covid_7_day_avg',
+    'staffed_icu_adult_patients_confirmed_covid_7_day_avg'
+]
+
+# Column types of the raw HHS data, passed to `pd.read_csv`
+HHS_DTYPES = {
+    'hospital_pk': 'string[pyarrow]',
+    'state': 'category',
+    'hospital_name': 'string[pyarrow]',
+    'address': 'string[pyarrow]',
+    'city': 'category',
+    'zip': 'string[pyarrow]',
+    'fips_code': 'string[pyarrow]',
+    'geocoded_hospital_address': 'string[pyarrow]',
+    **{column: 'Float64' for column in HHS_FLOAT_COLUMNS},
+}
+
+# Column types of the raw quality data, passed to `pd.read_csv`
+QUALITY_DTYPES = {
+    'Facility ID': 'string[pyarrow]',
+    'Facility Name': 'string[pyarrow]',
+    'Address': 'string[pyarrow]',
+    'City': 'category',
+    'State': 'category',
+    'ZIP Code': 'string[pyarrow]',
+    'County Name': 'category',
+    'Hospital Type': 'category',
+    'Hospital Ownership': 'category',
+    'Emergency Services': 'category',
+    'Hospital overall rating': 'category',
+}
+
+# Column types of dashboard query results, applied by `compact_frame`
+DASHBOARD_DTYPES = {
+    'state': 'category',
+    'city': 'category',
+    'type_of_ownership': 'category',
+    'type_of_hospital': 'category',
+    'quality_rating': 'category',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    **{column: 'float32' for column in analytics.MEASURES},
+}
+
+
+def zero_padded_codes(values, width=5):
+    """Convert ZIP or FIPS codes to fixed-width categorical codes
+
+    Codes read as numbers lose their leading zeros and may carry a trailing
+    ".0"; both are restored here
+
+    Parameters
+    ----------
+    values : Series
+        The codes, as strings or numbers
+    width : int, optional
+        Number of characters of each code
+
+    Returns
+    -------
+    Series
+        A categorical Series of `width`-character codes, missing values
+        kept as NaN
+    """
+    codes = values.astype('string[pyarrow]').str.strip()
+    codes = codes.str.replace(r'\.0$', '', regex=True).str.zfill(width)
+    return codes.astype('category')
+
+
+def compact_frame(df):
+    """Convert the columns of a query result to `DASHBOARD_DTYPES`
+
+    Parameters
+    ----------
+    df : DataFrame
+        A Pandas DataFrame as returned by `pd.read_sql`
+
+    Returns
+    -------
+    DataFrame
+        The same frame with the listed columns converted; other columns are
+        left as they are
+    """
+    dtypes = {c: t for c, t in DASHBOARD_DTYPES.items() if c in df.columns}
+    return df.astype(dtypes)
+
+
+def to_db(value):
+    """Convert a DataFrame cell to a value the database driver accepts
+
+    Parameters
+    ----------
+    value : Any
+        A cell value, possibly a NumPy scalar, NaN or `pd.NA`
+
+    Returns
+    -------
+    Any
+        None for missing values, the Python equivalent of NumPy scalars, and
+        any other value unchanged
+    """
+    if pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def rows_differ(left, right):
+    """Find the rows of two aligned DataFrames that differ
+
+    Missing values compare equal to each other, whatever their type (None,
+    NaN or `pd.NA`), so unchanged rows are never reported as changed
+
+    Parameters
+    ----------
+    left : DataFrame
+        A Pandas DataFrame
+    right : DataFrame
+        A Pandas DataFrame with the same columns and row order as left
+
+    Returns
+    -------
+    ndarray
+        A boolean array, True for each row with at least one differing value
+    """
+    differ = np.zeros(len(left), dtype=bool)
+    for column in left.columns:
+        differ |= np.array([
+            to_db(a) != to_db(b)
+            for a, b in zip(left[column], right[column])
+        ], dtype=bool)
+    return differ
@@ -0,0 +1,28 @@
+# Python script to print the human-readable lines of a reject log
+import argparse
+from utils import render_error_log, get_connection, get_hospital_info
+
+parser = argparse.ArgumentParser(
+    description="Render an errorLogs/*.jsonl.gz file as readable lines")
+parser.add_argument("filepath", help="path to a reject log file")
+parser.add_argument("--db", action="store_true",
+                    help="look up hospital names and addresses in the "
+                    "database")
+args = parser.parse_args()
+
+
+def main():
+    hospital_info = None
+    if args.db:
+        conn = get_connection()
+        try:
+            hospital_info = get_hospital_info(conn.cursor())
+        finally:
+            conn.close()
+
+    for line in render_error_log(args.filepath, hospital_info):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# A python module writing and reading pre-rendered weekly report snapshots
+import html
+import json
+import os
+from datetime import date
+from io import StringIO
+import pandas as pd
+import analytics
+import cube
+import report_sections
+
+SNAPSHOT_DIR = 'reports'
+
+# Snapshot of the sections that show the same content for every week
+SHARED = 'all-weeks'
+
+# File listing the data version, the weeks and the sections of every
+# snapshot that were up to date when the snapshots were last rendered
+INDEX = 'index'
+
+# The data cube of the last render, so the next one reads only new weeks
+CUBE_STATE = 'cube.pickle'
+
+# Sections stored in the snapshot of each week
+WEEK_SECTIONS = [name for name in report_sections.SECTIONS
+                 if name not in report_sections.WEEK_INDEPENDENT]
+
+
+def snapshot_path(week, directory=SNAPSHOT_DIR, extension='json'):
+    """Path of the snapshot file for a collection week, `SHARED` or `INDEX`"""
+    return os.path.join(directory, f"{week}.{extension}")
+
+
+def _version_key(data_version):
+    """Data version as a JSON-comparable list of [source, version] pairs"""
+    return [[str(source), int(version)] for source, version in data_version]
+
+
+def _json_key(key):
+    """A section key of `report_sections.section_key` as stored in a file"""
+    week, version, counts = key
+    return [None if week is None else str(week), _version_key(version),
+            counts]
+
+
+def section_keys(week, data):
+    """The stored key of each section of a week's snapshot, or of `SHARED`"""
+    if week == SHARED:
+        names, week = report_sections.WEEK_INDEPENDENT, None
+    else:
+        names = WEEK_SECTIONS
+    return {
+        name: _json_key(report_sections.section_key(name, week, data))
+        for name in names
+    }
+
+
+def _write_atomic(path, text):
+    """Write a file so readers never see a partially written snapshot"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def dates_to_str(df):
+    """Copy of df with date columns as YYYY-MM-DD strings"""
+    df = df.copy()
+    for column in df.columns:
+        values = df[column].dropna()
+        if len(values) and isinstance(values.iloc[0], date):
+            df[column] = df[column].map(
+                lambda x: x if pd.isna(x) else x.isoformat()[:10]
+            )
+    return df
+
+
+def serialize_sections(sections):
+    """Convert report sections to a JSON-serializable dictionary"""
+    out = {}
+    for name, section in sections.items():
+        entry = dict(section)
+        if section.get("table") is not None:
+            table = dates_to_str(section["table"])
+            entry["table"] = json.loads(
+                table.to_json(orient='split', index=False)
+            )
+        out[name] = entry
+    return out
+
+
+def deserialize_sections(payload):
+    """Convert serialized report sections back to DataFrames and specs"""
+    sections = {}
+    for name, entry in payload.items():
+        section = dict(entry)
+        if entry.get("table") is not None:
+            section["table"] = pd.read_json(
+                StringIO(json.dumps(entry["table"])), orient='split',
+                convert_dates=False
+            )
+        sections[name] = section
+    return sections
+
+
+def _script_json(value):
+    """JSON for embedding inside a <script> tag"""
+    return json.dumps(value).replace("</", "<\\/")
+
+
+def render_html(sections, week):
+    """Render report sections as an HTML page
+
+    Tables are inlined as HTML; Vega-Lite and Plotly charts are embedded as
+    JSON specs drawn by the vega-embed and plotly.js scripts, which the page
+    loads from their CDNs
+
+    Parameters
+    ----------
+    sections : dict
+        Report sections as returned by `report_sections.build_sections`;
+        the page shows those it is given, in report order
+    week : date or str
+        The collection week of the report, or `SHARED` for the page of the
+        sections shown for every week
+
+    Returns
+    -------
+    str
+        The HTML page
+    """
+    body = []
+    for i, (name, title) in enumerate(report_sections.SECTIONS.items()):
+        if name not in sections:
+            continue
+        section = sections[name]
+        body.append(f"<h2>{html.escape(title)}</h2>")
+        if section.get("table") is not None:
+            body.append(section["table"].to_html(index=False, na_rep=""))
+        if section.get("vega") is not None:
+            body.append(
+                f'<div id="chart{i}"></div><script>vegaEmbed("#chart{i}", '
+                f'{_script_json(section["vega"])});</script>'
+            )
+        if section.get("plotly") is not None:
+            fig = section["plotly"]
+            body.append(
+                f'<div id="chart{i}"></div><script>Plotly.newPlot("chart{i}",'
+                f' {_script_json(fig.get("data", []))}, '
+                f'{_script_json(fig.get("layout", {}))});</script>'
+            )
+    if week == SHARED:
+        title = "All Weeks"
+        intro = "<p>Sections shown for every report week</p>"
+    else:
+        title = str(week)
+        intro = (f"<p>Report week: {week}. The sections shown for every "
+                 f'week are on <a href="{SHARED}.html">their own page</a>.'
+                 "</p>")
+    return (
+        "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+        f"<title>HHS Hospital Capacity Weekly Report - {title}</title>"
+        '<script src="https://cdn.jsdelivr.net/npm/vega@5"></script>'
+        '<script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>'
+        '<script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>'
+        '<script src="https://cdn.plot.ly/plotly-2.35.2.min.js"></script>'
+        "</head><body>"
+        "<h1>HHS Hospital Capacity Weekly Report</h1>"
+        + intro
+        + "\n".join(body)
+        + "</body></html>\n"
+    )
+
+
+def write_snapshot(entries, keys, week, directory=SNAPSHOT_DIR):
+    """Write the JSON and HTML snapshot of one week's report, or `SHARED`
+
+    Parameters
+    ----------
+    entries : dict
+        Report sections serialized by `serialize_sections`
+    keys : dict
+        The stored key of each section, as returned by `section_keys`
+    week : date or str
+        The collection week of the report, or `SHARED`
+    directory : str, optional
+        Directory the snapshot files are written to
+    """
+    os.makedirs(directory, exist_ok=True)
+    payload = {"week": str(week), "keys": keys, "sections": entries}
+    _write_atomic(snapshot_path(week, directory), json.dumps(payload))
+    _write_atomic(snapshot_path(week, directory, 'html'),
+                  render_html(deserialize_sections(entries), week))
+
+
+def _read_snapshot(week, directory):
+    """A stored snapshot or the index, or None if there is none"""
+    try:
+        with open(snapshot_path(week, directory)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def index_stamp(directory=SNAPSHOT_DIR):
+    """Modification time of the snapshot index, None if there is none
+
+    Readers caching `load_index` include it in their key, so an index
+    written after they first read it is read again.
+    """
+    try:
+        return os.stat(snapshot_path(INDEX, directory)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_index(data_version, directory=SNAPSHOT_DIR):
+    """Load the snapshot index if it was written for a data version
+
+    Parameters
+    ----------
+    data_version : tuple
+        The current data version, as returned by
+        `dashboard_utils.get_data_version`
+    directory : str, optional
+        Directory the snapshot files are read from
+
+    Returns
+    -------
+    dict or None
+        The index: `weeks` (every collection week, newest first) and the
+        `snapshots`, with the `keys` of the sections stored in each file and
+        the names of those that are `fresh`; None if the snapshots were
+        rendered from other data
+    """
+    index = _read_snapshot(INDEX, directory)
+    if index is None or index.get("data_version") != _version_key(
+            data_version):
+        return None
+    return index
+
+
+def load_snapshot(week, index, directory=SNAPSHOT_DIR):
+    """Load the up-to-date sections of a week's report
+
+    No data cube is needed: the index, written for the current data version
+    (see `load_index`), lists the sections of the week's snapshot and of
+    the `SHARED` snapshot that are up to date.
+
+    Parameters
+    ----------
+    week : date
+        The selected collection week
+    index : dict or None
+        The snapshot index returned by `load_index`
+    directory : str, optional
+        Directory the snapshot files are read from
+
+    Returns
+    -------
+    dict
+        The up-to-date sections, as returned by
+        `report_sections.build_sections`; empty without an index
+    """
+    if index is None:
+        return {}
+    entries = {}
+    for name in (SHARED, str(week)):
+        listed = index["snapshots"].get(name, {})
+        if not listed.get("fresh"):
+            continue
+        payload = _read_snapshot(name, directory)
+        if payload is None:
+            continue
+        # a file rewritten by another render since the index was written
+        # only serves the sections it still holds under the listed keys
+        stored = payload.get("keys", {})
+        for section in listed["fresh"]:
+            if (section in payload.get("sections", {})
+                    and stored.get(section) == listed["keys"][section]):
+                entries[section] = payload["sections"][section]
+    return deserialize_sections(entries)
+
+
+def render_snapshots(data, weeks=None, directory=SNAPSHOT_DIR):
+    """Render the out-of-date snapshots of the weekly report
+
+    Each week's snapshot holds the sections that depend on the week, and
+    the `SHARED` snapshot the others. Only the sections whose key (see
+    `report_sections.section_key`) changed since they were written are
+    built again, and only the files holding them are rewritten, so a load
+    rewrites the snapshots of the weeks it loaded, of the later weeks whose
+    history charts include them, and the shared snapshot. The index is
+    written last, for the data version of `data`.
+
+    Parameters
+    ----------
+    data : cube.CubeSnapshot
+        A snapshot of a refreshed data cube
+    weeks : list, optional
+        Collection weeks to render; defaults to every week
+    directory : str, optional
+        Directory the snapshot files are written to
+
+    Returns
+    -------
+    int
+        The number of weeks written
+    """
+    if weeks is None:
+        weeks = data.weeks()
+    index = _read_snapshot(INDEX, directory) or {}
+    stored = {name: listed["keys"]
+              for name, listed in index.get("snapshots", {}).items()}
+    rendered = [SHARED] + [str(week) for week in weeks]
+    trends = None
+    written = 0
+    snapshots = {}
+    for week in [SHARED] + data.weeks():
+        name = str(week)
+        keys = section_keys(week, data)
+        old = stored.get(name, {})
+        stale = [section for section in keys
+                 if old.get(section) != keys[section]]
+        if name not in rendered or not stale:
+            snapshots[name] = {
+                "keys": old,
+                "fresh": [section for section in keys if section not in stale]
+            }
+            continue
+        payload = _read_snapshot(name, directory) or {}
+        entries = {}
+        for section in keys:
+            if (payload.get("keys", {}).get(section) == keys[section]
+                    and section in payload.get("sections", {})):
+                entries[section] = payload["sections"][section]
+                continue
+            if section == 'beds_summary' and trends is None:
+                trends = analytics.state_metrics(data.matrix)
+            built = report_sections.build_section(
+                section, data, None if week == SHARED else week, trends
+            )
+            entries[section] = serialize_sections({section: built})[section]
+        write_snapshot(entries, keys, week, directory)
+        snapshots[name] = {"keys": keys, "fresh": list(keys)}
+        written += week != SHARED
+    os.makedirs(directory, exist_ok=True)
+    _write_atomic(snapshot_path(INDEX, directory), json.dumps({
+        "data_version": _version_key(data.version),
+        "weeks": [str(week) for week in data.weeks()],
+        "snapshots": snapshots,
+    }))
+    return written
+
+
+def refresh_snapshots(weeks=None, directory=SNAPSHOT_DIR):
+    """Bring the data cube up to date and render report snapshots
+
+    The cube starts from the one saved by the previous render in
+    `directory`, so only the weeks loaded since are read from the database,
+    and is saved again for the next render.
+
+    Parameters
+    ----------
+    weeks : int, optional
+        Only render the latest number of weeks; defaults to every week
+    directory : str, optional
+        Directory the snapshot files are written to
+
+    Returns
+    -------
+    int
+        The number of weeks written, out of date before
+    """
+    report = cube.ReportCube()
+    state = os.path.join(directory, CUBE_STATE)
+    report.load(state)
+    data = report.refresh()
+    selected = data.weeks()
+    if weeks is not None:
+        selected = selected[:weeks]
+    written = render_snapshots(data, selected, directory)
+    report.save(state)
+    return written
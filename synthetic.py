@@ -0,0 +1,180 @@
+# A python module seeding a database with synthetic hospital data, for load
+# tests and query plan tests against a local Postgres
+import os
+from datetime import date, timedelta
+import numpy as np
+from sampling import refresh_sample
+
+STATES = [
+    'AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI',
+    'IA', 'ID', 'IL', 'IN', 'KS', 'KY', 'LA', 'MA', 'MD', 'ME', 'MI', 'MN',
+    'MO', 'MS', 'MT', 'NC', 'ND', 'NE', 'NH', 'NJ', 'NM', 'NV', 'NY', 'OH',
+    'OK', 'OR', 'PA', 'PR', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VA', 'VT',
+    'WA', 'WI', 'WV', 'WY',
+]
+
+OWNERSHIP_TYPES = [
+    'Government - Federal', 'Government - Local', 'Physician',
+    'Proprietary', 'Voluntary non-profit - Church',
+    'Voluntary non-profit - Private', 'Voluntary non-profit - Other',
+]
+
+HOSPITAL_TYPES = [
+    'Acute Care Hospitals', 'Critical Access Hospitals',
+    'Childrens', 'Psychiatric',
+]
+
+QUALITY_RATINGS = ['1', '2', '3', '4', '5', 'Not Available']
+
+# First collection week of the synthetic data (a Friday, like the HHS data)
+FIRST_WEEK = date(2020, 7, 31)
+
+
+def create_schema(conn):
+    """Drop and re-create every table from create_database.sql"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'create_database.sql')
+    with open(path) as f:
+        sql = f.read()
+    with conn.transaction(), conn.cursor() as cursor:
+        cursor.execute(sql)
+
+
+def _maybe_missing(rng, values, rate):
+    """Values as Python floats, with `rate` of them replaced by None"""
+    missing = rng.random(len(values)) < rate
+    return [None if m else float(v) for v, m in zip(values, missing)]
+
+
+def seed(conn, hospitals=5000, weeks=52, random_state=0):
+    """Fill an empty database with synthetic hospitals and weekly logs
+
+    About 97% of the hospitals report each week, 1% of the measures are
+    missing, 90% of the hospitals have a quality rating and a third of those
+    have an older version as well. All values satisfy the table constraints.
+
+    Parameters
+    ----------
+    conn : psycopg.Connection
+        An open connection to a database created with `create_schema`
+    hospitals : int, optional
+        Number of hospitals
+    weeks : int, optional
+        Number of collection weeks, starting at `FIRST_WEEK`
+    random_state : int, optional
+        Seed of the random generator; the same seed gives the same data
+
+    Returns
+    -------
+    dict
+        Number of rows written to each table
+    """
+    rng = np.random.default_rng(random_state)
+    n_zip = max(hospitals // 3, 1)
+    zipcodes = [f"{i:05d}" for i in rng.choice(100000, n_zip, replace=False)]
+    hospital_pks = [f"{i:06d}" for i in range(hospitals)]
+    hospital_zip = rng.integers(0, n_zip, hospitals)
+    week_dates = [FIRST_WEEK + timedelta(weeks=i) for i in range(weeks)]
+    counts = {}
+
+    with conn.transaction(), conn.cursor() as cursor:
+        with cursor.copy(
+            "COPY locations (zipcode, state, city) FROM STDIN"
+        ) as copy:
+            for i, zipcode in enumerate(zipcodes):
+                copy.write_row((zipcode, STATES[i % len(STATES)],
+                                f"City {i // len(STATES)}"))
+        counts['locations'] = n_zip
+
+        with cursor.copy(
+            """
+            COPY hospital (hospital_pk, hospital_name, address, longitude,
+            latitude, fips_code, zipcode) FROM STDIN
+            """
+        ) as copy:
+            lon = rng.uniform(-124.0, -67.0, hospitals)
+            lat = rng.uniform(25.0, 49.0, hospitals)
+            for i, pk in enumerate(hospital_pks):
+                copy.write_row((pk, f"Hospital {pk}", f"{i} Main Street",
+                                float(lon[i]), float(lat[i]),
+                                f"{rng.integers(1000, 57000):05d}",
+                                zipcodes[hospital_zip[i]]))
+        counts['hospital'] = hospitals
+
+        # beds available per hospital, with weekly occupancy around 70%
+        adult = rng.uniform(10, 600, hospitals).round()
+        pediatric = rng.uniform(0, 60, hospitals).round()
+        icu = rng.uniform(0, 80, hospitals).round()
+        written = 0
+        with cursor.copy(
+            """
+            COPY weekly_logs (collection_week, hospital_pk,
+            adult_beds_available_avg, adult_beds_occupied_avg,
+            pediatric_beds_available_avg, pediatric_beds_occupied_avg,
+            icu_beds_available_avg, icu_beds_occupied_avg,
+            confirmed_covid_hospitalized_avg, confirmed_covid_icu_avg)
+            FROM STDIN
+            """
+        ) as copy:
+            for week in week_dates:
+                reporting = np.flatnonzero(rng.random(hospitals) < 0.97)
+                n = len(reporting)
+                used = rng.uniform(0.4, 1.0, (3, n))
+                adult_used = (adult[reporting] * used[0]).round(1)
+                pediatric_used = (pediatric[reporting] * used[1]).round(1)
+                icu_used = (icu[reporting] * used[2]).round(1)
+                covid = (adult_used * rng.uniform(0, 0.3, n)).round(1)
+                covid_icu = np.minimum(covid, icu_used).round(1)
+                columns = [
+                    _maybe_missing(rng, values, 0.01) for values in (
+                        adult[reporting], adult_used,
+                        pediatric[reporting], pediatric_used,
+                        icu[reporting], icu_used, covid, covid_icu)
+                ]
+                for j, i in enumerate(reporting):
+                    copy.write_row((week, hospital_pks[i])
+                                   + tuple(c[j] for c in columns))
+                written += n
+        counts['weekly_logs'] = written
+
+        written = 0
+        with cursor.copy(
+            """
+            COPY hospital_quality (hospital_pk, quality_rating, date_updated,
+            valid_to, type_of_hospital, type_of_ownership,
+            emergency_services) FROM STDIN
+            """
+        ) as copy:
+            updates = sorted({week_dates[0], week_dates[len(week_dates) // 2]})
+            for pk in hospital_pks:
+                if rng.random() >= 0.9:
+                    continue
+                versions = updates if rng.random() < 1 / 3 else updates[:1]
+                hospital_type = HOSPITAL_TYPES[rng.integers(4)]
+                ownership = OWNERSHIP_TYPES[rng.integers(7)]
+                emergency = bool(rng.random() < 0.8)
+                for k, updated in enumerate(versions):
+                    valid_to = (versions[k + 1] if k + 1 < len(versions)
+                                else None)
+                    copy.write_row((pk, QUALITY_RATINGS[rng.integers(6)],
+                                    updated, valid_to, hospital_type,
+                                    ownership, emergency))
+                    written += 1
+        counts['hospital_quality'] = written
+
+        cursor.execute(
+            "INSERT INTO data_version (source, version) "
+            "VALUES ('hhs', 1), ('quality', 1)"
+        )
+        counts['hospital_sample'] = refresh_sample(cursor)
+
+    # VACUUM runs outside a transaction. Like autovacuum after a load, it
+    # marks the pages all-visible, so index-only scans are planned as they
+    # would be on a loaded database.
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        conn.execute("VACUUM ANALYZE")
+    finally:
+        conn.autocommit = autocommit
+    return counts
@@ -0,0 +1,262 @@
+# Query plan regression tests for dashboard_queries.py
+#
+# The tests seed the database in PRANCER_TEST_DSN with synthetic data at
+# production scale (see synthetic.py; every table is dropped first), run
+# EXPLAIN (FORMAT JSON) for each dashboard query and check properties of the
+# plans. Estimated costs are compared with query_plan_baseline.json, recorded
+# from the seeded database with the default size; a query without a baseline
+# fails. After an intended plan change, or after adding a query, record a new
+# baseline with
+#
+#     PRANCER_UPDATE_PLAN_BASELINE=1 python -m pytest tests/test_query_plans.py
+import difflib
+import json
+import os
+from datetime import timedelta
+import pytest
+
+DSN = os.environ.get('PRANCER_TEST_DSN')
+pytestmark = pytest.mark.skipif(
+    not DSN, reason="set PRANCER_TEST_DSN to a disposable test database"
+)
+psycopg = pytest.importorskip("psycopg")
+
+import dashboard_queries as queries  # noqa: E402
+import synthetic  # noqa: E402
+from dashboard_utils import FIRST_PAGE  # noqa: E402
+
+HOSPITALS = int(os.environ.get('PRANCER_TEST_HOSPITALS', 5000))
+WEEKS = int(os.environ.get('PRANCER_TEST_WEEKS', 104))
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__),
+                             'query_plan_baseline.json')
+UPDATE_BASELINE = os.environ.get('PRANCER_UPDATE_PLAN_BASELINE') == '1'
+
+# A plan may cost this much more than its baseline before the test fails
+COST_TOLERANCE = 1.5
+
+WEEK = synthetic.FIRST_WEEK + timedelta(weeks=WEEKS // 2)
+DRILLDOWN = {
+    "week_from": WEEK, "week_to": WEEK, "state": None, "ownership": None,
+    "quality": None, "order_by": 'occupancy', "after_key": FIRST_PAGE[0],
+    "after_pk": FIRST_PAGE[1], "after_week": FIRST_PAGE[2], "limit": 26,
+}
+
+# Every dashboard query with representative parameters
+QUERIES = {
+    "get_weeks": (queries.get_weeks, {}),
+    "get_states": (queries.get_states, {}),
+    "weekly_records_summary": (queries.weekly_records_summary, {}),
+    "bed_summary_5_weeks": (queries.bed_summary_5_weeks, {"week": WEEK}),
+    "beds_fraction_by_quality": (queries.beds_fraction_by_quality,
+                                 {"week": WEEK}),
+    "beds_used_over_time": (queries.beds_used_over_time, {"week": WEEK}),
+    "avg_quality_by_state": (queries.avg_quality_by_state, {}),
+    "covid_by_ownership": (queries.covid_by_ownership, {"week": WEEK}),
+    "beds_by_emergency_services": (queries.beds_by_emergency_services,
+                                   (WEEK,)),
+    "hospital_locations": (queries.hospital_locations, {}),
+    "icu_capacity_by_hospital": (queries.icu_capacity_by_hospital,
+                                 {"week": WEEK}),
+    "get_ownership_types": (queries.get_ownership_types, {}),
+    "hospital_page_by_hospital": (queries.hospital_page_by_hospital,
+                                  dict(DRILLDOWN, order_by='hospital')),
+    "hospital_page_by_occupancy": (queries.hospital_page_by_occupancy,
+                                   DRILLDOWN),
+    "weekly_logs_for_weeks": (queries.weekly_logs_for_weeks,
+                              {"weeks": [WEEK]}),
+    "hospital_attributes": (queries.hospital_attributes, {}),
+    "get_data_version": (queries.get_data_version, {}),
+    "sample_beds_used_over_time": (queries.sample_beds_used_over_time,
+                                   {"week": WEEK}),
+    "sample_covid_by_ownership": (queries.sample_covid_by_ownership,
+                                  {"week": WEEK}),
+    "sample_summary": (queries.sample_summary, {}),
+}
+
+# Queries reading a single week of weekly_logs, which must use its index
+SINGLE_WEEK = [
+    "beds_fraction_by_quality",
+    "beds_by_emergency_services",
+    "icu_capacity_by_hospital",
+    "hospital_page_by_hospital",
+    "hospital_page_by_occupancy",
+    "weekly_logs_for_weeks",
+]
+
+# Queries reading the weekly_logs rows of the sampled hospitals only, which
+# must look them up per hospital with an index-only scan of
+# weekly_logs_hospital_idx
+SAMPLED = [
+    "sample_beds_used_over_time",
+    "sample_covid_by_ownership",
+]
+
+# Queries reading hospital_quality through hospital_quality_as_of, which must
+# be inlined rather than run as a function scan
+QUALITY_AS_OF = [
+    name for name, (sql, _) in QUERIES.items()
+    if 'hospital_quality_as_of' in sql
+]
+
+# Queries looking up the quality of a page of hospitals, which must read
+# hospital_quality through an index rather than scan it
+QUALITY_LOOKUPS = [
+    "hospital_page_by_hospital",
+    "hospital_page_by_occupancy",
+]
+
+
+@pytest.fixture(scope='module')
+def conn():
+    # client-side binding puts the parameter values into the EXPLAIN text
+    conn = psycopg.connect(DSN, cursor_factory=psycopg.ClientCursor)
+    synthetic.create_schema(conn)
+    synthetic.seed(conn, HOSPITALS, WEEKS)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    try:
+        with open(BASELINE_PATH) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        if not UPDATE_BASELINE:
+            pytest.fail(f"{BASELINE_PATH} is missing; record it with "
+                        "PRANCER_UPDATE_PLAN_BASELINE=1")
+        stored = {}
+    yield stored
+    if UPDATE_BASELINE:
+        # queries that no longer exist are dropped from the baseline
+        current = {name: stored[name] for name in QUERIES if name in stored}
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def explain(conn, name):
+    """The JSON plan of a dashboard query"""
+    sql, params = QUERIES[name]
+    with conn.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        return cursor.fetchone()[0][0]['Plan']
+
+
+def plan_nodes(plan):
+    """Every node of a plan, depth first"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def plan_lines(plan, depth=0):
+    """A plan as indented lines of node type, relation and index, for diffs
+
+    Costs and row estimates are left out so that only structural changes
+    show up in a diff
+    """
+    line = plan['Node Type']
+    if 'Relation Name' in plan:
+        line += f" on {plan['Relation Name']}"
+    if 'Index Name' in plan:
+        line += f" using {plan['Index Name']}"
+    if 'Function Name' in plan:
+        line += f" of {plan['Function Name']}"
+    lines = ['  ' * depth + line]
+    for child in plan.get('Plans', []):
+        lines += plan_lines(child, depth + 1)
+    return lines
+
+
+def show(plan):
+    return '\n'.join(plan_lines(plan))
+
+
+@pytest.mark.parametrize('name', SINGLE_WEEK)
+def test_single_week_queries_use_weekly_logs_index(conn, name):
+    plan = explain(conn, name)
+    seq_scans = [
+        node for node in plan_nodes(plan)
+        if node['Node Type'] == 'Seq Scan'
+        and node.get('Relation Name') == 'weekly_logs'
+    ]
+    assert not seq_scans, (
+        f"{name} scans all of weekly_logs:\n{show(plan)}"
+    )
+
+
+@pytest.mark.parametrize('name', SAMPLED)
+def test_sampled_queries_read_only_sampled_rows(conn, name):
+    plan = explain(conn, name)
+    scans = [
+        node for node in plan_nodes(plan)
+        if node.get('Relation Name') == 'weekly_logs'
+    ]
+    assert scans, show(plan)
+    assert all(
+        node['Node Type'] == 'Index Only Scan'
+        and node.get('Index Name') == 'weekly_logs_hospital_idx'
+        for node in scans
+    ), (
+        f"{name} does not look up the sampled hospitals in "
+        f"weekly_logs_hospital_idx:\n{show(plan)}"
+    )
+
+
+@pytest.mark.parametrize('name', QUALITY_AS_OF)
+def test_hospital_quality_as_of_is_inlined(conn, name):
+    plan = explain(conn, name)
+    function_scans = [
+        node for node in plan_nodes(plan)
+        if node['Node Type'] == 'Function Scan'
+    ]
+    assert not function_scans, (
+        f"{name} runs hospital_quality_as_of as a function scan instead of "
+        f"reading hospital_quality:\n{show(plan)}"
+    )
+    relations = {node.get('Relation Name') for node in plan_nodes(plan)}
+    assert 'hospital_quality' in relations, show(plan)
+
+
+@pytest.mark.parametrize('name', QUALITY_LOOKUPS)
+def test_quality_lookups_use_hospital_quality_index(conn, name):
+    plan = explain(conn, name)
+    scans = [
+        node for node in plan_nodes(plan)
+        if node.get('Relation Name') == 'hospital_quality'
+    ]
+    assert scans, show(plan)
+    assert all(
+        node['Node Type'] in ('Index Scan', 'Index Only Scan')
+        for node in scans
+    ), (
+        f"{name} does not read hospital_quality through an index:\n"
+        f"{show(plan)}"
+    )
+
+
+@pytest.mark.parametrize('name', list(QUERIES))
+def test_cost_within_baseline(conn, baseline, name):
+    plan = explain(conn, name)
+    cost = plan['Total Cost']
+    if UPDATE_BASELINE:
+        baseline[name] = {"total_cost": cost, "plan": plan_lines(plan)}
+        return
+    assert name in baseline, (
+        f"no baseline for {name}; record one with "
+        "PRANCER_UPDATE_PLAN_BASELINE=1"
+    )
+
+    expected = baseline[name]
+    limit = expected["total_cost"] * COST_TOLERANCE
+    diff = '\n'.join(difflib.unified_diff(
+        expected["plan"], plan_lines(plan),
+        fromfile='baseline', tofile='current', lineterm=''
+    ))
+    assert cost <= limit, (
+        f"{name} estimated cost {cost:.0f} is over {limit:.0f} "
+        f"({COST_TOLERANCE}x the baseline of {expected['total_cost']:.0f})\n"
+        + (diff or "plan shape unchanged:\n" + show(plan))
+    )
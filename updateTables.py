@@ -1,32 +1,118 @@
 import pandas as pd
+import schema
+from utils import parse_emergency
 
+# Columns of the hospital table, named as in the loaded data
+HOSPITAL_COLUMNS = ['hospital_pk', 'hospital_name', 'address', 'longitude',
+                    'latitude', 'fips_code', 'zip']
 
-def update_locations_table(cursor, data):
-    # get all zipcodes
+
+class DimensionCache:
+    """ZIP codes and hospital rows known to be in the database
+
+    A long-running loader keeps one cache between files, so a load does not
+    re-read the locations and hospital tables. Each table is cached with the
+    data_version counter it matches, and dropped when another loader changed
+    the table, or when a load is rolled back.
+    """
+
+    # Cache attribute holding the rows of each table
+    TABLES = {'locations': 'zipcodes', 'hospital': 'hospitals'}
+
+    def __init__(self):
+        self.zipcodes = None
+        self.hospitals = None
+        self.versions = {}
+
+    def clear(self):
+        self.zipcodes = None
+        self.hospitals = None
+        self.versions = {}
+
+    def _read_version(self, cursor, table):
+        cursor.execute("SELECT version FROM data_version WHERE source = %s",
+                       (table,))
+        row = cursor.fetchone()
+        return row[0] if row is not None else 0
+
+    def validate(self, cursor, table):
+        """Drop the cached rows of a table if another loader changed it
+
+        Run while holding the table's advisory lock, so that the table does
+        not change again before the transaction ends
+        """
+        if self._read_version(cursor, table) != self.versions.get(table):
+            setattr(self, self.TABLES[table], None)
+            self.versions.pop(table, None)
+
+    def remember_version(self, cursor, table):
+        """Record the data_version counter of a table after updating it"""
+        self.versions[table] = self._read_version(cursor, table)
+
+    def remember_hospitals(self, rows):
+        """Insert or overwrite cached hospital rows
+
+        Parameters
+        ----------
+        rows : DataFrame
+            Rows written to the hospital table, with `hospital_pk` and any
+            subset of `HOSPITAL_COLUMNS`
+        """
+        rows = rows.astype(object).map(schema.to_db).set_index('hospital_pk')
+        current = self.hospitals.set_index('hospital_pk')
+        new = rows.index.difference(current.index)
+        current = pd.concat(
+            [current, pd.DataFrame(None, index=new, columns=current.columns)]
+        )
+        current.loc[rows.index, rows.columns] = rows.to_numpy()
+        self.hospitals = current.rename_axis('hospital_pk').reset_index()
+
+
+def read_hospitals(cursor):
+    """Read the hospital table, with columns named as in `HOSPITAL_COLUMNS`"""
     cursor.execute(
-        "SELECT zipcode FROM locations",
+        """
+        SELECT hospital_pk, hospital_name, address, longitude, latitude,
+        fips_code, zipcode FROM hospital
+        """
     )
-    db_zipcodes = [row[0] for row in cursor.fetchall()]
+    return pd.DataFrame(cursor.fetchall(), columns=HOSPITAL_COLUMNS,
+                        dtype=object)
+
 
+def update_locations_table(cursor, data, rejects=None, cache=None):
+    # get all zipcodes
+    if cache is not None and cache.zipcodes is not None:
+        db_zipcodes = cache.zipcodes
+    else:
+        cursor.execute(
+            "SELECT zipcode FROM locations",
+        )
+        db_zipcodes = {row[0] for row in cursor.fetchall()}
+        if cache is not None:
+            cache.zipcodes = db_zipcodes
     # drop duplicate (zip,state,city) combos to avoid redundant inserts
     loc_df = data[['zip', 'state', 'city']].drop_duplicates()
     # remove zipcodes already in database
     loc_df = loc_df[~loc_df['zip'].isin(db_zipcodes)]
     loc_rows = []
-    skipped_rows = []
+    skipped_rows = 0
     for i, r in loc_df.iterrows():
         zipcode = r['zip']
         state = r['state']
         city = r['city']
 
         if pd.isna(zipcode) or pd.isna(state) or pd.isna(city):
-            skipped_rows.append(
-                (f"Skipped row {i+1}: zipcode={zipcode}, state={state}, "
-                 f"city={city} (missing value)")
-            )
+            skipped_rows += 1
+            if rejects is not None:
+                rejects.add('missing_location', i + 1, zipcode=zipcode,
+                            state=state, city=city)
             continue
 
-        loc_rows.append((zipcode, state, city))
+        loc_rows.append((str(zipcode), str(state), str(city)))
+    # rows are written in key order, so concurrent loads lock them in the
+    # same order
+    loc_rows.sort()
     cursor.executemany(
         """
         INSERT INTO locations (zipcode, state, city)
@@ -34,15 +120,20 @@ def update_locations_table(cursor, data):
         ON CONFLICT (zipcode) DO NOTHING
         """, loc_rows
     )
+    if cache is not None:
+        cache.zipcodes.update(row[0] for row in loc_rows)
     return len(loc_rows), skipped_rows
 
 
-def update_hospitals_table(cursor, data, is_quality_data):
+def update_hospitals_table(cursor, data, is_quality_data, cache=None):
     # get all hospitals in database
-    cursor.execute(
-        "SELECT hospital_pk FROM hospital",
-    )
-    db_hospital_pks = [row[0] for row in cursor.fetchall()]
+    if cache is not None and cache.hospitals is not None:
+        db_hospital = cache.hospitals
+    else:
+        db_hospital = read_hospitals(cursor)
+        if cache is not None:
+            cache.hospitals = db_hospital
+    db_hospital_pks = db_hospital['hospital_pk']
     # each hospital_pk should appear once
     if (is_quality_data):
         hosp_df = data[
@@ -54,7 +145,10 @@ def update_hospitals_table(cursor, data, is_quality_data):
              'longitude', 'latitude', 'fips_code', 'zip']
         ].drop_duplicates(subset=['hospital_pk'])
     # INSERT new hospitals
+    # rows are written in key order, so concurrent loads lock them in the
+    # same order
     insert_hosp_df = hosp_df[~hosp_df['hospital_pk'].isin(db_hospital_pks)]
+    insert_hosp_df = insert_hosp_df.sort_values('hospital_pk')
     hosp_rows = []
     for _, r in insert_hosp_df.iterrows():
         hospital_pk = r['hospital_pk']
@@ -63,13 +157,14 @@ def update_hospitals_table(cursor, data, is_quality_data):
         zipcode = r['zip']
 
         if (is_quality_data):
-            hosp_rows.append((hospital_pk, hospital_name, address, zipcode))
+            row = (hospital_pk, hospital_name, address, zipcode)
         else:
             longitude = r['longitude']
             latitude = r['latitude']
             fips_code = r['fips_code']
-            hosp_rows.append((hospital_pk, hospital_name, address,
-                              longitude, latitude, fips_code, zipcode))
+            row = (hospital_pk, hospital_name, address,
+                   longitude, latitude, fips_code, zipcode)
+        hosp_rows.append(tuple(schema.to_db(v) for v in row))
 
     if (is_quality_data):
         cursor.executemany(
@@ -92,33 +187,6 @@ def update_hospitals_table(cursor, data, is_quality_data):
 
     rows_inserted = len(hosp_rows)
     # existing hospitals to update
-    if (is_quality_data):
-        cursor.execute(
-            "SELECT hospital_pk, hospital_name, address, zipcode FROM hospital"
-        )
-        db_hospital = pd.DataFrame(
-            cursor.fetchall(),
-            columns=('hospital_pk', 'hospital_name', 'address', 'zip')
-        )
-    else:
-        cursor.execute(
-            """
-            SELECT hospital_pk, hospital_name, address, longitude, latitude,
-            fips_code, zipcode FROM hospital
-            """
-        )
-        db_hospital = pd.DataFrame(
-            cursor.fetchall(),
-            columns=(
-                'hospital_pk',
-                'hospital_name',
-                'address',
-                'longitude',
-                'latitude',
-                'fips_code',
-                'zip'
-            )
-        )
     update_hosp_df = hosp_df[hosp_df['hospital_pk'].isin(db_hospital_pks)]
     db_hospital = db_hospital[
         db_hospital['hospital_pk'].isin(update_hosp_df['hospital_pk'])
@@ -127,7 +195,8 @@ def update_hospitals_table(cursor, data, is_quality_data):
     update_hosp_df = update_hosp_df.sort_values('hospital_pk')
     update_hosp_df = update_hosp_df.reset_index(drop=True)
     db_hospital = db_hospital[update_hosp_df.columns]
-    rows_different = (update_hosp_df != db_hospital).any(axis=1)
+    # missing values compare equal, so unchanged rows are not rewritten
+    rows_different = schema.rows_differ(update_hosp_df, db_hospital)
     update_hosp_df = update_hosp_df[rows_different]
     hosp_rows = []
     for _, r in update_hosp_df.iterrows():
@@ -136,14 +205,14 @@ def update_hospitals_table(cursor, data, is_quality_data):
         address = r['address']
         zipcode = r['zip']
         if (is_quality_data):
-            hosp_rows.append((hospital_name, address, zipcode, hospital_pk))
+            row = (hospital_name, address, zipcode, hospital_pk)
         else:
             longitude = r['longitude']
             latitude = r['latitude']
             fips_code = r['fips_code']
-            hosp_rows.append((hospital_name, address,
-                              longitude, latitude, fips_code,
-                              zipcode, hospital_pk))
+            row = (hospital_name, address, longitude, latitude, fips_code,
+                   zipcode, hospital_pk)
+        hosp_rows.append(tuple(schema.to_db(v) for v in row))
     if (is_quality_data):
         cursor.executemany(
             """
@@ -162,4 +231,430 @@ def update_hospitals_table(cursor, data, is_quality_data):
             """, hosp_rows
         )
 
+    if cache is not None:
+        cache.remember_hospitals(insert_hosp_df)
+        cache.remember_hospitals(update_hosp_df)
     return rows_inserted, len(hosp_rows)
+
+
+def insert_weekly_logs(cursor, data, rejects):
+    """Check HHS rows against the weekly_logs constraints and insert them
+
+    Rows violating a constraint are recorded in the reject log and skipped
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor, inside a transaction
+    data : DataFrame
+        A Pandas DataFrame of pre-processed HHS data
+    rejects : utils.RejectLog
+        The reject log of the load
+
+    Returns
+    -------
+    int
+        The number of rows inserted into weekly_logs
+    """
+    weekly_rows = []
+    for i, r in data.iterrows():
+        # missing values become None, as the checks below expect
+        r = {name: schema.to_db(value) for name, value in r.items()}
+        collection_week = r['collection_week']
+        adult_beds_available_avg = r[
+            'all_adult_hospital_beds_7_day_avg'
+        ]
+        pediatric_beds_available_avg = r[
+            'all_pediatric_inpatient_beds_7_day_avg'
+        ]
+        adult_beds_occupied_avg = r[
+            'all_adult_hospital_inpatient_bed_occupied_7_day_avg'
+        ]
+        pediatric_beds_occupied_avg = r[
+            'all_pediatric_inpatient_bed_occupied_7_day_avg'
+        ]
+        icu_beds_available_avg = r['total_icu_beds_7_day_avg']
+        icu_beds_occupied_avg = r['icu_beds_used_7_day_avg']
+        confirmed_covid_hospitalized_avg = r[
+            'inpatient_beds_used_covid_7_day_avg'
+        ]
+        confirmed_covid_icu_avg = r[
+            'staffed_icu_adult_patients_confirmed_covid_7_day_avg'
+        ]
+        hospital_pk = r['hospital_pk']
+
+        # ICU
+        if (
+            icu_beds_available_avg is not None
+            and icu_beds_occupied_avg is not None
+            and icu_beds_occupied_avg > icu_beds_available_avg
+        ):
+            rejects.add('icu_over_capacity', i + 1, hospital_pk,
+                        occupied=icu_beds_occupied_avg,
+                        available=icu_beds_available_avg)
+            continue
+
+        # Adult
+        if (
+            adult_beds_available_avg is not None
+            and adult_beds_occupied_avg is not None
+            and adult_beds_occupied_avg > adult_beds_available_avg
+        ):
+            rejects.add('adult_over_capacity', i + 1, hospital_pk,
+                        occupied=adult_beds_occupied_avg,
+                        available=adult_beds_available_avg)
+            continue
+
+        # Pediatric
+        if (
+            pediatric_beds_available_avg is not None
+            and pediatric_beds_occupied_avg is not None
+            and pediatric_beds_occupied_avg
+                > pediatric_beds_available_avg
+        ):
+            rejects.add('pediatric_over_capacity', i + 1, hospital_pk,
+                        occupied=pediatric_beds_occupied_avg,
+                        available=pediatric_beds_available_avg)
+            continue
+
+        # COVID ICU > COVID hospitalized
+        if (
+            confirmed_covid_hospitalized_avg is not None
+            and confirmed_covid_icu_avg is not None
+            and confirmed_covid_icu_avg
+                > confirmed_covid_hospitalized_avg
+        ):
+            rejects.add('covid_icu_over_hospitalized', i + 1,
+                        hospital_pk,
+                        covid_icu=confirmed_covid_icu_avg,
+                        covid_hospitalized=(
+                            confirmed_covid_hospitalized_avg))
+            continue
+
+        weekly_rows.append((
+            collection_week,
+            adult_beds_available_avg,
+            pediatric_beds_available_avg,
+            adult_beds_occupied_avg,
+            pediatric_beds_occupied_avg,
+            icu_beds_available_avg,
+            icu_beds_occupied_avg,
+            confirmed_covid_hospitalized_avg,
+            confirmed_covid_icu_avg,
+            hospital_pk
+        ))
+    cursor.executemany(
+        """
+        INSERT INTO weekly_logs (
+            collection_week,
+            adult_beds_available_avg,
+            pediatric_beds_available_avg,
+            adult_beds_occupied_avg,
+            pediatric_beds_occupied_avg,
+            icu_beds_available_avg,
+            icu_beds_occupied_avg,
+            confirmed_covid_hospitalized_avg,
+            confirmed_covid_icu_avg,
+            hospital_pk
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+        """, weekly_rows
+    )
+    return len(weekly_rows)
+
+
+# weekly_logs columns and the HHS data columns they are loaded from
+WEEKLY_LOG_COLUMNS = {
+    'collection_week': 'collection_week',
+    'adult_beds_available_avg': 'all_adult_hospital_beds_7_day_avg',
+    'pediatric_beds_available_avg': 'all_pediatric_inpatient_beds_7_day_avg',
+    'adult_beds_occupied_avg':
+        'all_adult_hospital_inpatient_bed_occupied_7_day_avg',
+    'pediatric_beds_occupied_avg':
+        'all_pediatric_inpatient_bed_occupied_7_day_avg',
+    'icu_beds_available_avg': 'total_icu_beds_7_day_avg',
+    'icu_beds_occupied_avg': 'icu_beds_used_7_day_avg',
+    'confirmed_covid_hospitalized_avg': 'inpatient_beds_used_covid_7_day_avg',
+    'confirmed_covid_icu_avg':
+        'staffed_icu_adult_patients_confirmed_covid_7_day_avg',
+    'hospital_pk': 'hospital_pk',
+}
+
+
+def insert_weekly_logs_validated(cursor, data):
+    """Insert HHS rows into weekly_logs, validating them in the database
+
+    Raw rows are copied into an unconstrained temporary staging table. A
+    single statement then classifies every staged row against the
+    weekly_logs constraints, inserts the valid rows into weekly_logs and the
+    rest into weekly_logs_rejects with a reason code, so one bad row cannot
+    abort the load.
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor, inside a transaction
+    data : DataFrame
+        A Pandas DataFrame of pre-processed HHS data
+
+    Returns
+    -------
+    tuple of (int, dict)
+        The number of rows inserted into weekly_logs, and a dictionary
+        mapping reason codes to the number of rows rejected for that reason
+    """
+    cols = list(WEEKLY_LOG_COLUMNS)
+    col_list = ", ".join(cols)
+    cursor.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS weekly_logs_staging (
+            source_row INTEGER,
+            collection_week DATE,
+            adult_beds_available_avg FLOAT8,
+            pediatric_beds_available_avg FLOAT8,
+            adult_beds_occupied_avg FLOAT8,
+            pediatric_beds_occupied_avg FLOAT8,
+            icu_beds_available_avg FLOAT8,
+            icu_beds_occupied_avg FLOAT8,
+            confirmed_covid_hospitalized_avg FLOAT8,
+            confirmed_covid_icu_avg FLOAT8,
+            hospital_pk TEXT
+        ) ON COMMIT DROP
+        """
+    )
+    cursor.execute("TRUNCATE weekly_logs_staging")
+
+    staged = data[list(WEEKLY_LOG_COLUMNS.values())]
+    with cursor.copy(
+        f"COPY weekly_logs_staging (source_row, {col_list}) FROM STDIN"
+    ) as copy:
+        for i, row in enumerate(staged.itertuples(index=False, name=None)):
+            week = row[0]
+            week = None if pd.isna(week) else pd.Timestamp(week).date()
+            copy.write_row((i + 1, week) + tuple(
+                schema.to_db(v) for v in row[1:]
+            ))
+
+    cursor.execute(
+        f"""
+        WITH checked AS (
+            SELECT
+                s.*,
+                CASE
+                    WHEN s.hospital_pk IS NULL OR s.collection_week IS NULL
+                        THEN 'missing_key'
+                    WHEN LEAST(
+                        s.adult_beds_available_avg,
+                        s.pediatric_beds_available_avg,
+                        s.adult_beds_occupied_avg,
+                        s.pediatric_beds_occupied_avg,
+                        s.icu_beds_available_avg,
+                        s.icu_beds_occupied_avg,
+                        s.confirmed_covid_hospitalized_avg,
+                        s.confirmed_covid_icu_avg) < 0
+                        THEN 'negative_value'
+                    WHEN s.icu_beds_occupied_avg > s.icu_beds_available_avg
+                        THEN 'icu_over_capacity'
+                    WHEN s.adult_beds_occupied_avg
+                        > s.adult_beds_available_avg
+                        THEN 'adult_over_capacity'
+                    WHEN s.pediatric_beds_occupied_avg
+                        > s.pediatric_beds_available_avg
+                        THEN 'pediatric_over_capacity'
+                    WHEN s.confirmed_covid_icu_avg
+                        > s.confirmed_covid_hospitalized_avg
+                        THEN 'covid_icu_over_hospitalized'
+                    WHEN h.hospital_pk IS NULL
+                        THEN 'unknown_hospital'
+                    WHEN wl.hospital_pk IS NOT NULL
+                        THEN 'already_loaded'
+                END AS check_reason
+            FROM weekly_logs_staging s
+            LEFT JOIN hospital h ON h.hospital_pk = s.hospital_pk
+            LEFT JOIN weekly_logs wl
+                ON wl.hospital_pk = s.hospital_pk
+                AND wl.collection_week = s.collection_week
+        ),
+        classified AS (
+            SELECT
+                c.*,
+                COALESCE(
+                    c.check_reason,
+                    CASE
+                        WHEN ROW_NUMBER() OVER (
+                            PARTITION BY c.hospital_pk, c.collection_week,
+                                c.check_reason
+                            ORDER BY c.source_row) > 1
+                        THEN 'duplicate_row'
+                    END
+                ) AS reason
+            FROM checked c
+        ),
+        inserted AS (
+            INSERT INTO weekly_logs ({col_list})
+            SELECT {col_list}
+            FROM classified
+            WHERE reason IS NULL
+            RETURNING 1
+        ),
+        rejected AS (
+            INSERT INTO weekly_logs_rejects (source_row, reason, {col_list})
+            SELECT source_row, reason, {col_list}
+            FROM classified
+            WHERE reason IS NOT NULL
+            RETURNING reason
+        )
+        SELECT NULL AS reason, COUNT(*) FROM inserted
+        UNION ALL
+        SELECT reason, COUNT(*) FROM rejected GROUP BY reason
+        """
+    )
+    inserted = 0
+    rejected = {}
+    for reason, count in cursor.fetchall():
+        if reason is None:
+            inserted = count
+        else:
+            rejected[reason] = count
+    return inserted, rejected
+
+
+def insert_hospital_quality(cursor, data, date_updated):
+    """Write the changed hospital_quality versions of the quality data
+
+    hospital_quality keeps one version per change of a hospital's rating,
+    hospital type, ownership or emergency services (slowly changing
+    dimension, type 2). A hospital whose attributes equal the version valid
+    on `date_updated` gets no new row. Otherwise the valid version is closed
+    on `date_updated` and a new version is inserted, valid until the next
+    later version if the file is older than the latest one. Reloading a
+    file corrects the versions of that date in place.
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor, inside a transaction
+    data : DataFrame
+        A Pandas DataFrame of pre-processed quality data
+    date_updated : date
+        The date the ratings were updated
+
+    Returns
+    -------
+    tuple of (int, int)
+        The number of hospital_quality versions written, and the number of
+        hospitals whose attributes were unchanged
+    """
+    quality_rows = {}
+    for _, r in data.iterrows():
+        # Normalize quality rating to ENUM
+        raw_q = str(r['Hospital overall rating']).strip()
+        valid_ratings = {'1', '2', '3', '4', '5'}
+        quality_rating = (
+            raw_q if raw_q in valid_ratings else "Not Available"
+        )
+
+        hosp_type = schema.to_db(r['Hospital Type'])
+        ownership = schema.to_db(r['Hospital Ownership'])
+        emergency = parse_emergency(schema.to_db(r["Emergency Services"]))
+        hospital_pk = r['hospital_pk']
+
+        # one version per hospital and date; the last row of a hospital wins
+        quality_rows[hospital_pk] = (quality_rating, hosp_type, ownership,
+                                     emergency, hospital_pk)
+
+    cursor.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS hospital_quality_staging (
+            quality_rating quality,
+            type_of_hospital TEXT,
+            type_of_ownership TEXT,
+            emergency_services BOOLEAN,
+            hospital_pk TEXT
+        ) ON COMMIT DROP
+        """
+    )
+    cursor.execute("TRUNCATE hospital_quality_staging")
+    with cursor.copy(
+        """
+        COPY hospital_quality_staging (quality_rating, type_of_hospital,
+        type_of_ownership, emergency_services, hospital_pk) FROM STDIN
+        """
+    ) as copy:
+        for row in quality_rows.values():
+            copy.write_row(row)
+
+    params = {"date": date_updated}
+    # Staged hospitals whose attributes differ from the version valid on the
+    # date, with the start date of that version (NULL if there is none)
+    cursor.execute(
+        """
+        CREATE TEMP TABLE hospital_quality_changes ON COMMIT DROP AS
+        SELECT s.*, cur.date_updated AS current_from
+        FROM hospital_quality_staging s
+        LEFT JOIN hospital_quality_as_of(%(date)s) cur
+            ON cur.hospital_pk = s.hospital_pk
+        WHERE cur.hospital_pk IS NULL
+            OR (cur.quality_rating, cur.type_of_hospital,
+                cur.type_of_ownership, cur.emergency_services)
+            IS DISTINCT FROM
+               (s.quality_rating, s.type_of_hospital,
+                s.type_of_ownership, s.emergency_services)
+        """, params
+    )
+    # Correct versions of the same date in place
+    cursor.execute(
+        """
+        UPDATE hospital_quality hq
+        SET quality_rating = c.quality_rating,
+            type_of_hospital = c.type_of_hospital,
+            type_of_ownership = c.type_of_ownership,
+            emergency_services = c.emergency_services
+        FROM hospital_quality_changes c
+        WHERE hq.hospital_pk = c.hospital_pk
+            AND hq.date_updated = %(date)s
+        """, params
+    )
+    corrected = cursor.rowcount
+    # Close the versions valid on the date, then insert the new versions
+    cursor.execute(
+        """
+        UPDATE hospital_quality hq
+        SET valid_to = %(date)s
+        FROM hospital_quality_changes c
+        WHERE hq.hospital_pk = c.hospital_pk
+            AND hq.date_updated = c.current_from
+            AND c.current_from < %(date)s
+        """, params
+    )
+    cursor.execute(
+        """
+        INSERT INTO hospital_quality (
+            quality_rating,
+            date_updated,
+            type_of_hospital,
+            type_of_ownership,
+            emergency_services,
+            hospital_pk,
+            valid_to
+        )
+        SELECT
+            c.quality_rating,
+            %(date)s,
+            c.type_of_hospital,
+            c.type_of_ownership,
+            c.emergency_services,
+            c.hospital_pk,
+            (
+                SELECT MIN(hq.date_updated)
+                FROM hospital_quality hq
+                WHERE hq.hospital_pk = c.hospital_pk
+                    AND hq.date_updated > %(date)s
+            )
+        FROM hospital_quality_changes c
+        WHERE c.current_from IS NULL OR c.current_from < %(date)s
+        """, params
+    )
+    written = corrected + cursor.rowcount
+    cursor.execute("DROP TABLE hospital_quality_changes")
+    return written, len(quality_rows) - written
@@ -1,25 +1,64 @@
 # A python module to hold function definitions to aid in data loading
-import pandas as pd
-import numpy as np
+import gzip
+import json
+import os
+from collections import Counter
 from datetime import datetime
+import pandas as pd
 import psycopg
-import credentials
-
-
-def load_data(filepath, cols):
+import schema
+
+# Environment variable holding a connection string that overrides the
+# credentials module, e.g. "postgresql://localhost/prancer" for a local
+# database seeded with synthetic data
+DSN_VARIABLE = 'PRANCER_DSN'
+
+
+# Human-readable messages for each reject reason code, rendered on demand
+# from the structured reject log
+REJECT_MESSAGES = {
+    'missing_location': (
+        "zipcode={zipcode}, state={state}, city={city} (missing value)"
+    ),
+    'icu_over_capacity': (
+        "ICU occupied > available for {hospital} ({occupied} > {available})"
+    ),
+    'adult_over_capacity': (
+        "Adult beds occupied > available for {hospital} "
+        "({occupied} > {available})"
+    ),
+    'pediatric_over_capacity': (
+        "Pediatric beds occupied > available for {hospital} "
+        "({occupied} > {available})"
+    ),
+    'covid_icu_over_hospitalized': (
+        "COVID ICU > COVID hospitalized for {hospital} "
+        "({covid_icu} > {covid_hospitalized})"
+    ),
+}
+
+
+def load_data(filepath, cols, dtypes=None):
     """A function to load a data file
 
     Parameters
     ----------
-    filepath : str
-        A string containing the file path to the data file to be loaded
+    filepath : str or file-like
+        A string containing the file path to the data file to be loaded, or
+        a binary stream of the CSV data (see `compression.DataSource`)
+    cols : list
+        The columns of interest
+    dtypes : dict, optional
+        Column types to read the columns as, such as `schema.HHS_DTYPES`
 
     Returns
     -------
     Pandas DataFrame
         A data frame containing only the columns of interest from the HHS data
     """
-    df = pd.read_csv(filepath)
+    if dtypes is not None:
+        dtypes = {c: t for c, t in dtypes.items() if c in cols}
+    df = pd.read_csv(filepath, usecols=cols, dtype=dtypes)
 
     return df[cols]
 
@@ -38,48 +77,35 @@ def preprocess_hhs(data):
         A Pandas DataFrame of processed data
     """
 
-    # Convert columns to correct data type
-    str_cols = [
-        'hospital_pk', 'state', 'hospital_name', 'address', 'city', 'zip',
-        'fips_code', 'geocoded_hospital_address',
-    ]
-    float_cols = [
-        'all_adult_hospital_beds_7_day_avg',
-        'all_pediatric_inpatient_beds_7_day_avg',
-        'all_adult_hospital_inpatient_bed_occupied_7_day_avg',
-        'all_pediatric_inpatient_bed_occupied_7_day_avg',
-        'total_icu_beds_7_day_avg',
-        'icu_beds_used_7_day_avg',
-        'inpatient_beds_used_covid_7_day_avg',
-        'staffed_icu_adult_patients_confirmed_covid_7_day_avg'
-    ]
-    data[str_cols] = data[str_cols].astype(str)
-    data[float_cols] = data[float_cols].astype(float)
-
-    # Add the date column
+    # Convert columns to their compact types (see schema.HHS_DTYPES); this is
+    # a no-op when the file was read with them
+    data = data.astype({
+        c: t for c, t in schema.HHS_DTYPES.items() if c in data.columns
+    })
+
+    # Add the date column; a file holds only a few weeks, so it is stored as
+    # a categorical
     data['collection_week'] = pd.to_datetime(data['collection_week'],
                                              format='%Y-%m-%d')
+    data['collection_week'] = data['collection_week'].astype('category')
 
-    # Replace missing values and -999999 with None
-    data = data.replace(['nan', np.nan, -999999], None)
-
-    # FIPS code should be a string of 5 characters, dropping the decimals
-    trimmed = [s[:-2] if s else s for s in data['fips_code']]
-    padded = [s.rjust(5, '0') if s and len(s) < 5 else s for s in trimmed]
-    data['fips_code'] = padded
-
-    # ZIP code also should be a string of 5 characters, adding leading 0's
-    padded = [s.rjust(5, '0') if s and len(s) < 5 else s for s in data['zip']]
-    data['zip'] = padded
+    # Mark -999999 as missing
+    float_cols = schema.HHS_FLOAT_COLUMNS
+    data[float_cols] = data[float_cols].mask(
+        data[float_cols] == schema.HHS_MISSING
+    )
 
-    # Split geocoded address to latitude and longitude
-    geo_loc = data['geocoded_hospital_address'].str.split(' ')
+    # FIPS and ZIP codes should be strings of 5 characters, with leading 0's
+    data['fips_code'] = schema.zero_padded_codes(data['fips_code'])
+    data['zip'] = schema.zero_padded_codes(data['zip'])
 
-    # trim extra parentheses, add to df, and drop geo location column
-    lats = [row[1][1:] if row is not None else None for row in geo_loc]
-    lons = [row[2][:-1] if row is not None else None for row in geo_loc]
-    data['latitude'] = lats
-    data['longitude'] = lons
+    # Split geocoded address to latitude and longitude, and drop the geo
+    # location column. The address is a WKT point, "POINT (longitude latitude)"
+    point = data['geocoded_hospital_address'].str.extract(
+        r'POINT \((\S+) (\S+)\)'
+    )
+    data['latitude'] = pd.to_numeric(point[1]).astype('Float64')
+    data['longitude'] = pd.to_numeric(point[0]).astype('Float64')
     data = data.drop(columns=['geocoded_hospital_address'])
 
     # possible change column names if we want to do that
@@ -112,10 +138,13 @@ def preprocess_quality(data, filepath):
     date_updated = parts[1] + '-' + parts[2][:2] + "-15"
     data['date_updated'] = datetime.strptime(date_updated, '%Y-%m-%d')
 
+    # Convert columns to their compact types (see schema.QUALITY_DTYPES)
+    data = data.astype({
+        c: t for c, t in schema.QUALITY_DTYPES.items() if c in data.columns
+    })
+
     # left pad ZIP code if we are missing leading 0's
-    data['ZIP Code'] = data['ZIP Code'].astype(str)
-    z = [s.rjust(5, '0') if s and len(s) < 5 else s for s in data['ZIP Code']]
-    data['ZIP Code'] = z
+    data['ZIP Code'] = schema.zero_padded_codes(data['ZIP Code'])
 
     # change column names to match HHS data
     data = data.rename(columns={
@@ -133,13 +162,18 @@ def preprocess_quality(data, filepath):
 def get_connection():
     """Create and return a connection to the PostgreSQL database
 
-    This function uses secure credentials stored in the credentials module
+    This function uses secure credentials stored in the credentials module,
+    unless a connection string is set in the PRANCER_DSN environment variable
 
     Returns
     -------
         psycopg.Connextion
             An open database connection object
     """
+    dsn = os.environ.get(DSN_VARIABLE)
+    if dsn:
+        return psycopg.connect(dsn)
+    import credentials
     return psycopg.connect(
         host="debprodserver.postgres.database.azure.com",
         dbname=credentials.DB_USER,
@@ -147,6 +181,83 @@ def get_connection():
         password=credentials.DB_PASSWORD)
 
 
+def get_hospital_info(cursor):
+    """Build a lookup of hospital metadata used to format log messages
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor
+
+    Returns
+    -------
+    dict
+        A dictionary mapping hospital primary keys to metadata entries
+    """
+    cursor.execute(
+        """
+        SELECT h.hospital_pk, h.hospital_name, h.address,
+               l.city, l.state, l.zipcode
+        FROM hospital h
+        JOIN locations l ON h.zipcode = l.zipcode
+        """
+    )
+    hospital_info = {}
+    for row in cursor.fetchall():
+        pk, name, address, city, state, zipcode = row
+        hospital_info[pk] = {
+            "name": name,
+            "address": address,
+            "city": city,
+            "state": state,
+            "zip": zipcode
+        }
+    return hospital_info
+
+
+def bump_data_version(cursor, data_source):
+    """Record that new data was loaded for a data source
+
+    Dashboard caches compare these counters to decide when to refresh, so
+    this should run inside the loading transaction
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor
+    data_source : str
+        'hhs' or 'quality' for new fact rows, 'locations' or 'hospital' for
+        changed dimension rows, or 'archive'
+    """
+    cursor.execute(
+        """
+        INSERT INTO data_version (source, version)
+        VALUES (%s, 1)
+        ON CONFLICT (source) DO UPDATE
+        SET version = data_version.version + 1, updated_at = now()
+        """, (data_source,)
+    )
+
+
+def advisory_lock(cursor, name):
+    """Wait for the transaction-level advisory lock of a name
+
+    Concurrent loaders serialize on these locks instead of on row locks: one
+    per dimension table ('locations', 'hospital'), one for hospital_quality
+    and one per collection week of weekly_logs ('weekly_logs:YYYY-MM-DD').
+    The lock is released when the transaction ends.
+
+    Parameters
+    ----------
+    cursor : psycopg.Cursor
+        An open database cursor, inside a transaction
+    name : str
+        Name of the locked resource
+    """
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtextextended(%s, 0))",
+                   ("prancer:" + name,))
+
+
 def parse_emergency(value):
     """Parse an emergency indicator value into a boolean
 
@@ -206,24 +317,159 @@ def fmt_hospital(hpk, info):
     )
 
 
-def createErrorLog(errors, data_source):
-    """Creates an error log .txt file from loading data
+class RejectLog:
+    """A streaming sink for rows skipped while loading data
+
+    Each rejected row is written immediately as one JSON line to a gzip
+    compressed file in `errorLogs/`, holding the reason code, the 1-based row
+    index, the hospital primary key and the offending values. Only counters
+    are kept in memory. The file is created on the first written record, so
+    a clean load leaves no log behind.
 
     Parameters
     ----------
-    errors : list
-        A list of the error messages to be written
     data_source : str
         Either 'hhs' or 'quality', depending on the source of the data being
         loaded
+    max_records : int, optional
+        Stop writing records after this many have been written. Rejects past
+        the cap are still counted
+    sample_every : int, optional
+        Only write every n-th reject of each reason code. Defaults to 1, which
+        writes every reject
+    directory : str, optional
+        Directory the log file is written to
+    """
+
+    def __init__(self, data_source, max_records=None, sample_every=1,
+                 directory='errorLogs'):
+        self.data_source = data_source
+        self.max_records = max_records
+        self.sample_every = max(1, sample_every)
+        self.directory = directory
+        self.path = None
+        self.counts = Counter()
+        self.written = 0
+        self._file = None
+
+    def add(self, reason, row, hospital_pk=None, **values):
+        """Record one rejected row
+
+        Parameters
+        ----------
+        reason : str
+            A reason code, one of the keys of `REJECT_MESSAGES`
+        row : int
+            The 1-based index of the row in the source data
+        hospital_pk : str, optional
+            Primary key of the affected hospital
+        **values
+            The offending values, used when rendering the message
+        """
+        self.counts[reason] += 1
+        if (self.counts[reason] - 1) % self.sample_every != 0:
+            return
+        if self.max_records is not None and self.written >= self.max_records:
+            return
+
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            time = datetime.now().strftime("%Y-%m-%dT%H%M%S")
+            filename = self.data_source + "ErrorLog_" + time + ".jsonl.gz"
+            self.path = os.path.join(self.directory, filename)
+            self._file = gzip.open(self.path, 'wt')
+
+        record = {
+            "reason": reason,
+            "row": row,
+            "hospital_pk": hospital_pk,
+            "values": values,
+        }
+        self._file.write(json.dumps(record, default=str) + '\n')
+        self.written += 1
+
+    def count(self, *reasons):
+        """Return the number of rejects seen for the given reason codes
+
+        With no reason codes, the total number of rejects is returned
+        """
+        if not reasons:
+            return sum(self.counts.values())
+        return sum(self.counts[reason] for reason in reasons)
+
+    def close(self):
+        """Flush and close the log file, if one was opened"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def createErrorLog(data_source, max_records=None, sample_every=1):
+    """Creates a streaming error log for rows skipped while loading data
+
+    Parameters
+    ----------
+    data_source : str
+        Either 'hhs' or 'quality', depending on the source of the data being
+        loaded
+    max_records : int, optional
+        Maximum number of reject records to write to the log file
+    sample_every : int, optional
+        Only write every n-th reject of each reason code
+
+    Returns
+    -------
+    RejectLog
+        An open reject log; close it (or use it as a context manager) once
+        loading is finished
     """
+    return RejectLog(data_source, max_records=max_records,
+                     sample_every=sample_every)
 
-    if len(errors) == 0:
-        return
 
-    time = datetime.now()
-    filename = data_source + "ErrorLog_" + time.strftime("%Y-%m-%d:%H:%M:%S")
-    with open('errorLogs/' + filename + '.txt', 'w') as f:
-        for line in errors:
-            f.write(line + '\n')
-        f.close()
+def read_error_log(path):
+    """Read the structured records of a reject log file
+
+    Parameters
+    ----------
+    path : str
+        Path to a `.jsonl.gz` file written by `RejectLog`
+
+    Returns
+    -------
+    generator of dict
+        One dictionary per rejected row
+    """
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def render_error_log(path, hospital_info=None):
+    """Render the human-readable lines of a reject log file
+
+    Parameters
+    ----------
+    path : str
+        Path to a `.jsonl.gz` file written by `RejectLog`
+    hospital_info : dict, optional
+        A dictionary mapping hospital primary keys to metadata entries, as
+        used by `fmt_hospital`. Without it hospitals are shown by primary key
+
+    Returns
+    -------
+    generator of str
+        One formatted line per rejected row
+    """
+    info = hospital_info or {}
+    for record in read_error_log(path):
+        values = dict(record['values'])
+        values['hospital'] = fmt_hospital(record['hospital_pk'], info)
+        message = REJECT_MESSAGES.get(record['reason'], record['reason'])
+        yield f"[SKIP ROW {record['row']}] " + message.format(**values)
@@ -1,215 +1,395 @@
+import logging
+import time
+from datetime import date
 import streamlit as st
 import dashboard_queries as queries
 import dashboard_utils as utils
-import altair as alt
-import plotly.express as px
+import analytics
+import cube
+import downsample
+import geo
+import report_sections
+import sampling
+import snapshots
+
+# Maximum number of built report sections kept in memory
+FIGURE_CACHE_ENTRIES = 128
+
+started = time.perf_counter()
+st.title("HHS Hospital Capacity Weekly Report")
 
 
-st.title("HHS Hospital Capacity Weekly Report")
+# Server-wide data cube answering every chart from memory. It is shared by
+# all sessions and refreshed only when a loader bumps the data version.
+@st.cache_resource
+def report_cube():
+    return cube.ReportCube()
+
+
+@st.cache_data
+def state_trends(_matrix, data_version):
+    return analytics.state_metrics(_matrix)
+
+
+@st.cache_data
+def hospital_trends(_matrix, data_version, week):
+    return analytics.hospital_metrics(_matrix, week)
+
+
+# Built sections, shared by all sessions. A section is rebuilt only when the
+# week it shows or the data it reads changed (see
+# report_sections.section_key), so a hit skips the query, the chart
+# construction and the spec serialization; a load only rebuilds the sections
+# reading the weeks it loaded, and the quality map is reused across weeks
+# and HHS loads.
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def cached_section(name, key, max_points, _data, _selected_week):
+    trends = None
+    if name == "beds_summary":
+        trends = state_trends(_data.matrix, _data.version)
+    return report_sections.build_section(
+        name, _data, _selected_week, trends, max_points=max_points
+    )
+
+
+# Pre-rendered snapshot index and sections (see snapshots.py), parsed once
+# per data version and index write rather than on every rerun
+@st.cache_data
+def snapshot_index(data_version, stamp):
+    return snapshots.load_index(data_version)
+
+
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def snapshot_sections(week, data_version, stamp):
+    return snapshots.load_snapshot(week, snapshot_index(data_version, stamp))
+
+
+# Sample estimates of the history charts for the approximate mode
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def history_estimates(week, data_version):
+    return sampling.history_estimates(week)
+
+
+report = report_cube()
+# one snapshot of the cube answers every section of this run, but it is only
+# brought up to date once a section is not served from a snapshot
+data = None
+
+
+def cube_data():
+    """The snapshot of the data cube for this run, refreshed on first use"""
+    global data
+    if data is None:
+        data = report.refresh()
+    return data
+
+
+data_version = utils.get_data_version()
+stamp = snapshots.index_stamp()
+index = snapshot_index(data_version, stamp)
 
 # ---- Sidebar filters ----
 st.sidebar.header("Filters")
-available_weeks = utils.run_query(queries.get_weeks, params=())
-weeks = sorted(available_weeks["week"].tolist(), reverse=True)
+approximate = st.sidebar.toggle(
+    "Approximate mode",
+    help="While the report data is being loaded, draw the history charts "
+         "from a stratified sample of hospitals with 95% confidence "
+         "intervals, and switch to exact results when they are ready",
+)
+# In approximate mode an out-of-date cube is refreshed in the background
+# while the page is drawn from the hospital sample
+exact = not approximate or report.refresh_in_background()
+if index is not None:
+    weeks = [date.fromisoformat(week) for week in index["weeks"]]
+elif exact:
+    weeks = cube_data().weeks()
+else:
+    weeks = list(utils.run_query(queries.get_weeks, {})["week"])
 default_index = 0  # most recent week
 selected_week = st.sidebar.selectbox(
     "Week (collection_week)",
     options=weeks,
     index=default_index,
 )
+full_resolution = st.sidebar.toggle(
+    "Full-resolution time series",
+    help="Draw every weekly point of the line charts instead of a "
+         "downsampled series; useful when zooming into a short period",
+)
 st.caption(f"Report week: {selected_week}")
 
+# Serve the sections of the week's pre-rendered snapshot that are up to date
+# with the data, before the data cube is refreshed. The other sections are
+# built from the cube only when the page reaches them, so the first table
+# paints before any chart library is imported.
+snapshot = snapshot_sections(selected_week, data_version, stamp)
+
+
+def section(name):
+    """The snapshot of a report section, or the section built from the cube"""
+    full = full_resolution and name in report_sections.TIME_SERIES
+    if approximate and name in report_sections.APPROXIMATE:
+        st.caption("Status: exact")
+    if name in snapshot and not full:
+        return snapshot[name]
+    data = cube_data()
+    key = report_sections.section_key(name, selected_week, data)
+    return cached_section(
+        name, key, None if full else downsample.DEFAULT_POINTS, data,
+        selected_week
+    )
+
+
+def show(content):
+    """Draw the table and chart of a report section"""
+    if content.get("table") is not None:
+        st.dataframe(content["table"], use_container_width=True,
+                     hide_index=True)
+    if content.get("vega") is not None:
+        st.vega_lite_chart(content["vega"], use_container_width=True)
+    if content.get("plotly") is not None:
+        st.plotly_chart(content["plotly"])
+
+
+@st.fragment(run_every=2)
+def wait_for_exact():
+    """Rerun the page with exact results once the cube is up to date"""
+    if report.refresh_in_background():
+        st.rerun()
+
+
+def approximate_report():
+    """Draw the report from snapshots and sample estimates during a refresh"""
+    estimates = history_estimates(selected_week, data_version)
+    sample = estimates["sample"]
+    st.warning(
+        "Approximate mode: the exact results are being computed. Charts "
+        f"marked approximate are estimated from {sample['sampled']} of "
+        f"{sample['hospitals']} hospitals, sampled within each state and "
+        "quality rating; the shaded bands are 95% confidence intervals."
+    )
+    max_points = None if full_resolution else downsample.DEFAULT_POINTS
+    for name, title in report_sections.SECTIONS.items():
+        st.subheader(title)
+        if name in snapshot:
+            st.caption("Status: exact")
+            show(snapshot[name])
+        elif name in report_sections.APPROXIMATE:
+            st.caption("Status: approximate")
+            show(report_sections.build_estimate(name, estimates, max_points))
+        else:
+            st.caption("Status: loading exact results")
+    wait_for_exact()
+
+
+if not exact:
+    approximate_report()
+    st.stop()
+
 st.header("QUERY RESULTS")
 # ----------Plot/Table #1: Totals of Weekly Logs----------
-st.subheader("Number of Weekly Logs from Each Week")
+st.subheader(report_sections.SECTIONS["weekly_counts"])
 """
 A table with counts for weekly logs from each week.
 This shows records retrieved for user’s query
 with comparison to previous weeks.
 Note that the rows are listed from latest to earliest.
 """
-
-weekly_counts = utils.run_query(
-    queries.weekly_records_summary,
-    params={"week": selected_week}
-)
-
-st.dataframe(weekly_counts, use_container_width=True, hide_index=True)
+show(section("weekly_counts"))
+first_paint_ms = (time.perf_counter() - started) * 1000
 
 st.header("DATA SUMMARY")
 # ----------Plot/Table #2: Adult & Pediatric & COVID Beds----------
-st.subheader("Adult & Pediatric & COVID Beds: Current vs Previous 4 Weeks")
+st.subheader(report_sections.SECTIONS["beds_summary"])
 """
 A table summarizing the number of adult and pediatric beds available that week,
 the number used, and the number used by patients with COVID,
 compared to the 4 most recent weeks for each state.
+The last columns give the change in total beds used (adult, pediatric and
+ICU) from the previous week, its 4-week rolling average, and how the state's
+fraction of beds used compares to other states that week (z-score).
 Note that you can pick which week using the filter in the sidebar.
 """
-
-beds_df = utils.run_query(
-    queries.bed_summary_5_weeks,
-    params={"week": selected_week}
-)
-st.dataframe(beds_df, use_container_width=True, hide_index=True)
+show(section("beds_summary"))
 
 # ----------Plot/Table #3: Time series of COVID cases----------
-st.subheader("COVID Cases by Type of Hospital Ownership Per Week Over Time")
+st.subheader(report_sections.SECTIONS["covid_by_ownership"])
 """
 Total COVID cases per each type of hospital ownership per week
 Note that you can pick which week using the filter in the sidebar.
 """
-covid_over_time = utils.run_query(
-    queries.covid_by_ownership,
-    params=(selected_week,)
-)
-
-st.dataframe(covid_over_time, use_container_width=True, hide_index=True)
-
-st.line_chart(covid_over_time, x="collection_week", y="covid_cases",
-              color="type_of_ownership", x_label="Week",
-              y_label="Number of hospitalized patients with confirmed COVID",
-              )
+show(section("covid_by_ownership"))
 
 
 # ----------Plot/Table #4: Beds in use by Quality----------
-st.subheader("Proportion of Beds in Use by Hospital Quality")
+st.subheader(report_sections.SECTIONS["beds_by_quality"])
 """
 Proportion of total beds in use, broken down by hospital quality and bed type.
 Note that you can pick which week using the filter in the sidebar.
 """
-beds_by_quality = utils.run_query(
-    queries.beds_fraction_by_quality,
-    params={"week": selected_week}
-)
-
-plot3_df = beds_by_quality.melt(
-    id_vars="quality_rating",
-    value_vars=["adult",
-                "pediatric",
-                "icu",
-                "total"],
-    var_name="bed_type",
-    value_name="avg_fraction_used",
-)
-
-chart3 = alt.Chart(plot3_df).mark_bar().encode(
-    x=alt.X('quality_rating', title="Hospital Quality Rating"),
-    xOffset="bed_type",  # ensures bars appear side by side
-    y=alt.Y('avg_fraction_used', title="Fraction of Beds Used"),
-    color=alt.Color('bed_type', title="Bed Type")
-)
-
-st.altair_chart(chart3)
+show(section("beds_by_quality"))
 
 
 # ----------Plot/Table #5: Beds in use over time----------
-st.subheader("Total Hospital Beds Used Per Week Over Time")
+st.subheader(report_sections.SECTIONS["beds_over_time"])
 """
 The total number of beds used per week up to the selected week, along side
 the number of beds used for COVID patients.
 Note that you can pick which week using the filter in the sidebar.
 """
-beds_over_time = utils.run_query(
-    queries.beds_used_over_time,
-    params={"week": selected_week}
-)
-
-plot4_df = beds_over_time.melt(
-    id_vars="collection_week",
-    value_vars=["all",
-                "covid"],
-    var_name="Bed Type",
-    value_name="beds_used",
-)
-
-st.line_chart(plot4_df, x="collection_week", y="beds_used", color="Bed Type",
-              x_label="Week", y_label="Number of Beds Used",
-              )
+show(section("beds_over_time"))
 
 
 # ----------Plot/Table #6: Map of Hospital Quality----------
-st.subheader("Hospital Quality Ratings Across the US")
+st.subheader(report_sections.SECTIONS["quality_map"])
 """
 A map showing the average hospital quality rating by state, indicated by
 the color of the state.
 """
-state_quality = utils.run_query(
-    queries.avg_quality_by_state,
-    {}
-)
-
-# st.map(plot5_df, latitude="latitude", longitude="longitude", color="color")
-plot5 = px.choropleth(
-    state_quality,
-    locations='state',
-    locationmode="USA-states",
-    color='avg_quality_rating',
-    scope="usa",
-    color_continuous_scale="Viridis"
-)
-
-plot5.update_layout(coloraxis_colorbar=dict(
-    title="Average Quality Rating"
-))
-
-st.plotly_chart(plot5)
+show(section("quality_map"))
 
 
 # ----------Plot/Table #7: Beds in use by emergency services----------
-st.subheader("Beds in Use by Emergency Services (Selected Week)")
+st.subheader(report_sections.SECTIONS["beds_by_emergency"])
 """
 Number of adult, pediatric, ICU, and COVID beds in use in the selected week,
 broken down by state and whether the hospital has emergency services.
 Note that you can pick which week using the filter in the sidebar.
 """
+beds_es = section("beds_by_emergency")
+show({"table": beds_es["table"]})
 
+# Grouped bar chart
+st.markdown("### Beds in Use by Emergency Services (National Totals)")
+show({"vega": beds_es["vega"]})
 
-beds_es_df = utils.run_query(
-    queries.beds_by_emergency_services,
-    params=(selected_week,)
-)
-beds_es_df["emergency_group"] = beds_es_df["emergency_services"].replace({
-    True: "Yes",
-    False: "No"
-})
-beds_es_df = beds_es_df.drop(columns=["emergency_services"])
-st.dataframe(beds_es_df, use_container_width=True, hide_index=True)
-
-agg = (beds_es_df.groupby("emergency_group", as_index=False)[[
-    "adult_beds_in_use", "pediatric_beds_in_use", "icu_beds_in_use",]].sum()
-)
 
-# Long format for Altair
-plot_df = agg.melt(
-    id_vars="emergency_group",
-    value_vars=["adult_beds_in_use",
-                "pediatric_beds_in_use",
-                "icu_beds_in_use",],
-    var_name="bed_type",
-    value_name="beds_in_use",
-)
-plot_df["bed_type"] = plot_df["bed_type"].map({
-    "adult_beds_in_use": "Adult",
-    "pediatric_beds_in_use": "Pediatric",
-    "icu_beds_in_use": "ICU",
-})
+# ----------Plot/Table #8: Nearest hospitals with ICU capacity----------
+st.header("REGIONAL SURGE PLANNING")
+st.subheader("Nearest Hospitals with ICU Capacity (Selected Week)")
+"""
+The hospitals closest to a point that reported free ICU beds in the selected
+week, along with all hospitals within the chosen radius.
+Note that you can pick which week using the filter in the sidebar.
+"""
 
-# Grouped bar chart
-st.markdown("### Beds in Use by Emergency Services (National Totals)")
-chart = (
-    alt.Chart(plot_df)
-    .mark_bar()
-    .encode(
-        x=alt.X("emergency_group:N", title="Emergency Services"),
-        xOffset="bed_type:N",  # ensures bars appear side by side
-        y=alt.Y("beds_in_use:Q", title="Beds in Use"),
-        color=alt.Color("bed_type:N", title="Bed Type"),
-        tooltip=[
-            "emergency_group:N",
-            "bed_type:N",
-            alt.Tooltip("beds_in_use:Q", title="Beds in Use", format=","),
-        ],
+
+@st.cache_resource
+def hospital_index(data_version):
+    return geo.HospitalIndex(
+        utils.run_query(queries.hospital_locations, params={})
+    )
+
+
+@st.fragment
+def surge_planning():
+    """Nearest-hospital panel; its inputs rerun only this fragment"""
+    col_lat, col_lon, col_radius, col_k = st.columns(4)
+    latitude = col_lat.number_input("Latitude", -90.0, 90.0, 40.44,
+                                    format="%.4f")
+    longitude = col_lon.number_input("Longitude", -180.0, 180.0, -79.99,
+                                     format="%.4f")
+    radius_km = col_radius.number_input("Radius (km)", 1.0, 2000.0, 50.0)
+    k = col_k.number_input("Hospitals", 1, 100, 10)
+
+    index = hospital_index(data_version)
+    icu_df = cube_data().icu_capacity_by_hospital(selected_week)
+    nearest = geo.nearest_with_icu_capacity(index, icu_df, latitude, longitude,
+                                            int(k))
+    nearby = index.within(latitude, longitude, radius_km)
+
+    st.dataframe(nearest, use_container_width=True, hide_index=True)
+    st.caption(f"{len(nearby)} hospitals within {radius_km:g} km")
+    st.map(nearby, latitude="latitude", longitude="longitude")
+
+
+surge_planning()
+
+
+# ----------Plot/Table #9: Hospital drill-down----------
+st.header("HOSPITAL DETAIL")
+st.subheader("Hospital-Level Bed Usage")
+"""
+Bed usage for individual hospitals in the selected week, one page at a time.
+Filter by state, ownership and quality rating, and sort by hospital or by the
+fraction of beds in use.
+Note that you can pick which week using the filter in the sidebar.
+"""
+
+
+@st.fragment
+def hospital_drilldown():
+    """Hospital drill-down; paging and filters rerun only this fragment"""
+    data = cube_data()
+    states = data.states()
+    ownership_types = data.ownership_types()
+
+    col_state, col_owner, col_quality = st.columns(3)
+    drill_state = col_state.selectbox("State", [None] + states,
+                                      format_func=lambda x: x or "All")
+    drill_owner = col_owner.selectbox("Ownership", [None] + ownership_types,
+                                      format_func=lambda x: x or "All")
+    drill_quality = col_quality.selectbox(
+        "Quality rating", [None, "1", "2", "3", "4", "5", "Not Available"],
+        format_func=lambda x: x or "All"
+    )
+    col_order, col_history, col_size = st.columns(3)
+    drill_order = col_order.radio(
+        "Sort by", ["occupancy", "hospital"], horizontal=True,
+        format_func=lambda x: {"occupancy": "Fraction of beds used",
+                               "hospital": "Hospital"}[x]
+    )
+    drill_history = col_history.checkbox("Include previous 4 weeks")
+    page_size = col_size.selectbox("Rows per page", [25, 50, 100])
+
+    week_from = selected_week
+    if drill_history:
+        week_from = weeks[min(weeks.index(selected_week) + 4, len(weeks) - 1)]
+    drill_filters = {
+        "week_from": week_from,
+        "week_to": selected_week,
+        "state": drill_state,
+        "ownership": drill_owner,
+        "quality": drill_quality,
+        "order_by": drill_order,
+    }
+
+    # Cursors of the pages visited so far; reset whenever the filters change
+    filter_key = (tuple(drill_filters.items()), page_size)
+    if st.session_state.get("drill_filter_key") != filter_key:
+        st.session_state["drill_filter_key"] = filter_key
+        st.session_state["drill_cursors"] = [utils.FIRST_PAGE]
+    cursors = st.session_state["drill_cursors"]
+
+    page_df, next_cursor = utils.fetch_hospital_page(
+        drill_filters, after=cursors[-1], page_size=page_size
+    )
+    page_df = page_df.merge(
+        hospital_trends(data.matrix, data.version, selected_week)[
+            ["hospital_pk", "week", "beds_used_wow", "beds_used_4wk_avg",
+             "fraction_used_z"]
+        ].rename(columns={"week": "collection_week"}),
+        on=["hospital_pk", "collection_week"],
+        how="left",
     )
-    .properties(height=350)
+    st.dataframe(page_df, use_container_width=True, hide_index=True)
+
+    col_prev, col_page, col_next = st.columns([1, 2, 1])
+    if col_prev.button("Previous page", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun(scope="fragment")
+    col_page.caption(f"Page {len(cursors)}")
+    if col_next.button("Next page", disabled=next_cursor is None):
+        cursors.append(next_cursor)
+        st.rerun(scope="fragment")
+
+
+hospital_drilldown()
+
+
+# Startup timing, logged at debug level so cold-start regressions can be
+# compared with the numbers from measure-startup.py
+logging.getLogger("weekly-report").debug(
+    "first paint %.0f ms, full page %.0f ms",
+    first_paint_ms, (time.perf_counter() - started) * 1000
 )
-st.altair_chart(chart, use_container_width=True)